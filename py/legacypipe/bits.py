@@ -37,6 +37,7 @@ FITBITS = dict(
     RUNNER             = 0x800,
     GAIA_POINTSOURCE   = 0x1000,
     ITERATIVE          = 0x2000,
+    HIT_BUDGET         = 0x4000, # fitting hit the step or CPU budget
 )
 
 # Outlier mask bit values
@@ -0,0 +1,267 @@
+'''
+A model of the CPU time of fitting each blob (one_blob), used to
+decide the order in which blobs are dispatched in stage_fitblobs and
+farm.py.
+
+The model is linear in a handful of per-blob features (see
+BlobCostModel.FEATURES), with non-negative coefficients.  The default
+coefficients are only a rough guess; they can be re-fit from the
+"cpu_blob" column of existing all-models files with
+
+    python -m legacypipe.blobcost -o blobcost.json all-models-*.fits
+
+and the resulting file passed to runbrick with --blob-cost-model.
+
+Any object with a predict(F) method returning one cost per row of the
+features table F can be used in place of a BlobCostModel.
+'''
+import json
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.blobcost')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class BlobCostModel(object):
+    # Features:
+    # - one: constant per-blob overhead
+    # - nsrcs: number of sources in the blob
+    # - totalpix: number of image pixels overlapping the blob, summed over tims
+    # - srcpix: nsrcs * totalpix
+    # - nlargepix: (number of large-galaxy reference sources) * totalpix
+    # - nfrozenpix: (number of frozen galaxies) * totalpix
+    FEATURES = ['one', 'nsrcs', 'totalpix', 'srcpix', 'nlargepix', 'nfrozenpix']
+
+    # Rough defaults, in CPU seconds per unit of each feature.
+    DEFAULT_COEFFS = dict(one=0.1, nsrcs=0.5, totalpix=1e-5, srcpix=1e-6,
+                          nlargepix=1e-4, nfrozenpix=1e-6)
+
+    def __init__(self, coeffs=None):
+        self.coeffs = self.DEFAULT_COEFFS.copy()
+        if coeffs is not None:
+            self.coeffs.update(coeffs)
+
+    def __str__(self):
+        return 'BlobCostModel(%s)' % ', '.join(['%s=%.3g' % (k, self.coeffs[k])
+                                               for k in self.FEATURES])
+
+    def predict(self, F):
+        '''
+        Returns the predicted CPU seconds for each row of the features
+        table *F* (from blob_cost_features).
+        '''
+        cost = np.zeros(len(F), np.float64)
+        for k in self.FEATURES:
+            cost += self.coeffs[k] * F.get(k)
+        return cost
+
+    def fit(self, F, cpu, features=None):
+        '''
+        Fits the coefficients of the given *features* (default: all) to
+        the measured CPU seconds *cpu*, by non-negative least squares.
+        Coefficients of other features are held fixed.
+        '''
+        from scipy.optimize import nnls
+        if features is None:
+            features = self.FEATURES
+        fixed = [k for k in self.FEATURES if not k in features]
+        y = np.array(cpu, np.float64)
+        for k in fixed:
+            y -= self.coeffs[k] * F.get(k)
+        A = np.vstack([F.get(k).astype(np.float64) for k in features]).T
+        # Scale the columns so nnls is well-conditioned.
+        scale = np.sqrt(np.sum(A**2, axis=0))
+        scale[scale == 0] = 1.
+        x,_ = nnls(A / scale[np.newaxis,:], y)
+        x /= scale
+        for k,c in zip(features, x):
+            self.coeffs[k] = float(c)
+        resid = y - A.dot(x)
+        info('Fit blob cost model to', len(y), 'blobs: total CPU', np.sum(cpu),
+             'sec, rms residual', np.sqrt(np.mean(resid**2)), 'sec')
+        info(self)
+
+    def write(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(self.coeffs, f, indent=2)
+
+    @classmethod
+    def read(cls, fn):
+        with open(fn) as f:
+            return cls(coeffs=json.load(f))
+
+def _add_derived_features(F):
+    F.one = np.ones(len(F), np.float32)
+    F.srcpix = F.nsrcs * F.totalpix
+    F.nlargepix = F.nlarge * F.totalpix
+    F.nfrozenpix = F.nfrozen * F.totalpix
+
+def count_large_galaxies(srcs):
+    '''
+    Returns the number of large-galaxy reference sources in *srcs* (the
+    "nlarge" feature of one blob).
+    '''
+    from tractor.galaxy import Galaxy
+    return sum([1 for src in srcs
+                if (getattr(src, 'is_reference_source', False) and
+                    isinstance(src, Galaxy))])
+
+def blob_cost_features(blobslices, blobsrcs, blobmap, targetwcs, tims, cat,
+                       frozen_galaxies):
+    '''
+    Computes the BlobCostModel features for all blobs, returning a
+    fits_table with one row per blob (in *blobslices* order).
+
+    The overlap of each tim with each blob is computed from blob and
+    tim bounding boxes, so this is cheap compared to cutting out the
+    blob subimages.
+    '''
+    from astrometry.util.fits import fits_table
+
+    nblobs = len(blobslices)
+    F = fits_table()
+    F.iblob = np.arange(nblobs, dtype=np.int32)
+    F.npix = np.bincount(blobmap[blobmap >= 0], minlength=nblobs)[:nblobs]
+    bx0 = np.array([sx.start for sy,sx in blobslices], np.float64)
+    bx1 = np.array([sx.stop  for sy,sx in blobslices], np.float64)
+    by0 = np.array([sy.start for sy,sx in blobslices], np.float64)
+    by1 = np.array([sy.stop  for sy,sx in blobslices], np.float64)
+
+    F.ntims = np.zeros(nblobs, np.int32)
+    F.totalpix = np.zeros(nblobs, np.float64)
+    targetscale = targetwcs.pixel_scale()
+    for tim in tims:
+        h,w = tim.shape
+        rr,dd = tim.subwcs.pixelxy2radec([1,1,w,w], [1,h,h,1])
+        _,xx,yy = targetwcs.radec2pixelxy(rr, dd)
+        # overlap area, in target pixels
+        ox = np.clip(np.minimum(bx1, xx.max()) - np.maximum(bx0, xx.min()-1), 0, None)
+        oy = np.clip(np.minimum(by1, yy.max()) - np.maximum(by0, yy.min()-1), 0, None)
+        area = ox * oy
+        F.ntims += (area > 0)
+        F.totalpix += area * (targetscale / tim.subwcs.pixel_scale())**2
+
+    F.nsrcs = np.array([len(I) for I in blobsrcs], np.int32)
+    F.nlarge = np.array([count_large_galaxies([cat[i] for i in I])
+                         for I in blobsrcs], np.int32)
+    F.nfrozen = np.array([len(frozen_galaxies.get(b, [])) for b in range(nblobs)],
+                         np.int32)
+    _add_derived_features(F)
+    return F
+
+def all_models_features(T):
+    '''
+    Computes BlobCostModel features from an all-models table *T*
+    (one row per source), returning (F, cpu_blob), with one row per
+    blob.  The nlarge and nfrozen features come from the blob_nlarge
+    and blob_nfrozen columns; they are zero for files written before
+    those were recorded.
+    '''
+    from astrometry.util.fits import fits_table
+    types = np.array([t.strip() for t in T.type])
+    T = T[(types != 'DUP') * (T.blob >= 0)]
+    blobs,I,counts = np.unique(T.blob, return_index=True, return_counts=True)
+    B = T[I]
+    F = fits_table()
+    F.iblob = blobs
+    F.npix = B.blob_npix
+    F.ntims = B.blob_nimages
+    F.totalpix = B.blob_totalpix.astype(np.float64)
+    F.nsrcs = counts.astype(np.int32)
+    cols = B.get_columns()
+    for k in ['nlarge', 'nfrozen']:
+        if 'blob_' + k in cols:
+            F.set(k, B.get('blob_' + k).astype(np.int32))
+        else:
+            F.set(k, np.zeros(len(F), np.int32))
+    _add_derived_features(F)
+    return F, B.cpu_blob
+
+def train_blob_cost_model(filenames, model=None):
+    '''
+    Fits a BlobCostModel to the blobs in the given all-models files.
+    The large- and frozen-galaxy coefficients are only fit if all the
+    files record those features; otherwise they are held fixed.
+    '''
+    import fitsio
+    from astrometry.util.fits import fits_table, merge_tables
+    if model is None:
+        model = BlobCostModel()
+    FF = []
+    cpu = []
+    columns = ['blob', 'type', 'cpu_blob', 'blob_npix', 'blob_nimages',
+               'blob_totalpix']
+    galcols = ['blob_nlarge', 'blob_nfrozen']
+    have_galaxies = True
+    for fn in filenames:
+        with fitsio.FITS(fn) as F:
+            filecols = [c.lower() for c in F[1].get_colnames()]
+        cols = [c for c in galcols if c in filecols]
+        if len(cols) < len(galcols):
+            have_galaxies = False
+        T = fits_table(fn, columns=columns + cols)
+        F,c = all_models_features(T)
+        debug('Read', len(F), 'blobs from', fn)
+        FF.append(F)
+        cpu.append(c)
+    F = merge_tables(FF)
+    cpu = np.hstack(cpu)
+    features = ['one', 'nsrcs', 'totalpix', 'srcpix']
+    if have_galaxies:
+        features += ['nlargepix', 'nfrozenpix']
+    else:
+        info('Not all files record blob_nlarge, blob_nfrozen; not fitting those')
+    model.fit(F, cpu, features=features)
+    return model
+
+def schedule_blobs(cost, nworkers=None, tail_aware=False):
+    '''
+    Returns the order in which to dispatch blobs, given their
+    predicted *cost*: longest first.
+
+    If *tail_aware*, also returns a boolean array marking the
+    "straggler" blobs, whose predicted cost exceeds the ideal per-worker
+    share of the total (sum(cost) / *nworkers*) -- these blobs alone
+    set the finishing time, so they should get dedicated workers
+    (eg, farm.py's big-blob queue).
+    '''
+    cost = np.asarray(cost)
+    order = np.argsort(-cost, kind='stable')
+    if not tail_aware:
+        return order
+    if nworkers is None or nworkers < 1:
+        nworkers = 1
+    total = np.sum(cost)
+    share = total / nworkers
+    stragglers = (cost > share) if nworkers > 1 else np.zeros(len(cost), bool)
+    # Predicted finishing time, dispatching longest-first to the
+    # first-free worker.
+    import heapq
+    loads = [0.] * nworkers
+    for i in order:
+        heapq.heappush(loads, heapq.heappop(loads) + cost[i])
+    info('Predicted blob-fitting time with', nworkers, 'workers:', max(loads),
+         'sec; ideal', share, 'sec;', np.sum(stragglers), 'straggler blobs')
+    return order, stragglers
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Fit a blob CPU-time model from all-models files')
+    parser.add_argument('-o', '--out', required=True, help='Output model (JSON) filename')
+    parser.add_argument('allmodels', nargs='+', help='all-models FITS files')
+    opt = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    model = train_blob_cost_model(opt.allmodels)
+    model.write(opt.out)
+    print('Wrote', opt.out)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,134 @@
+'''
+Runs the per-CCD calibrations (SourceExtractor, PsfEx, sky) for
+run_calibs so that concurrent bricks do not race to build the same
+files.
+
+Each CCD's calibrations are run while holding a file lock for that
+(camera, expnum, ccdname) in the calib directory's "locks" directory;
+LegacySurveyImage.run_calibs checks for existing files first, so a
+process that waited for the lock finds the files built and does
+nothing.  Within a process, concurrent requests for the same CCD (from
+threads) wait for the one in flight rather than queueing on the lock.
+
+Optionally (*merge*), once the last CCD of an exposure has its
+calibrations, the per-CCD files are merged into the per-exposure
+files, as legacyzpts/merge_calibs.py does.
+'''
+import os
+import threading
+
+import logging
+logger = logging.getLogger('legacypipe.calibservice')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+def calib_key(im):
+    return (im.camera, im.expnum, im.ccdname)
+
+class CalibService(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # calib_key -> threading.Event, for requests in flight
+        self.inflight = {}
+        self.ran = 0
+        self.waited = 0
+
+    def lock_filename(self, im, survey, ccdname=None):
+        if ccdname is None:
+            ccdname = im.ccdname
+        return os.path.join(survey.get_calib_dir(), 'locks',
+                            '%s-%s-%s.lock' % (im.camera, im.expnum, ccdname))
+
+    def run(self, im, kwargs, merge=False):
+        '''
+        Runs im.run_calibs(**kwargs) for image *im*, at most once at a
+        time per CCD across threads and processes.
+        '''
+        from legacypipe.utils import FileLock
+        from astrometry.util.file import trymakedirs
+        key = calib_key(im)
+        with self.lock:
+            ev = self.inflight.get(key)
+            if ev is None:
+                ev = threading.Event()
+                self.inflight[key] = ev
+                mine = True
+            else:
+                mine = False
+        if not mine:
+            debug('Waiting for calibs in flight for', im)
+            ev.wait()
+            self.waited += 1
+            return None
+        try:
+            survey = kwargs.get('survey') or im.survey
+            lockfn = self.lock_filename(im, survey)
+            try:
+                trymakedirs(lockfn, dir=True)
+                flock = FileLock(lockfn)
+                flock.__enter__()
+            except (IOError, OSError) as e:
+                # eg, a read-only calib directory
+                debug('Not locking calibs for', im, ':', e)
+                flock = None
+            try:
+                rtn = im.run_calibs(**kwargs)
+                self.ran += 1
+            finally:
+                if flock is not None:
+                    flock.__exit__()
+            if merge:
+                self.merge_exposure(im, survey)
+            return rtn
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            ev.set()
+
+    def merge_exposure(self, im, survey):
+        '''
+        Merges the per-CCD PsfEx and sky files of *im*'s exposure into
+        the per-exposure files, if all of its CCDs have them and the
+        merged files do not exist yet.
+        '''
+        from legacypipe.utils import FileLock
+        if os.path.exists(im.merged_psffn) and os.path.exists(im.merged_skyfn):
+            return
+        C = survey.find_ccds(expnum=im.expnum, camera=im.camera)
+        if C is None or len(C) == 0:
+            return
+        ims = [survey.get_image_object(ccd) for ccd in C]
+        if not all([os.path.exists(i.psffn) and os.path.exists(i.skyfn) for i in ims]):
+            return
+        from legacyzpts.merge_calibs import merge_psfex, merge_splinesky
+        class duck(object):
+            pass
+        opt = duck()
+        opt.all_found = True
+        with FileLock(self.lock_filename(im, survey, ccdname='merge')):
+            if not os.path.exists(im.merged_skyfn):
+                merge_splinesky(survey, im.expnum, C, im.merged_skyfn, opt)
+            if not os.path.exists(im.merged_psffn):
+                merge_psfex(survey, im.expnum, C, im.merged_psffn, opt)
+        info('Merged calibs for', im.camera, 'expnum', im.expnum)
+
+# Per-process service used by survey.run_calibs.
+calib_service = CalibService()
+
+def dedup_calib_args(args):
+    '''
+    Drops repeated CCDs from a list of (im, kwargs) run_calibs args.
+    '''
+    seen = set()
+    keep = []
+    for im,kw in args:
+        key = calib_key(im)
+        if key in seen:
+            continue
+        seen.add(key)
+        keep.append((im, kw))
+    return keep
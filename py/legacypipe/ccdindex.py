@@ -0,0 +1,165 @@
+'''
+A columnar, memory-mapped index of the survey-ccds tables.
+
+Reading and merging the survey-ccds-*.fits.gz files takes tens of
+seconds and gigabytes for DR-scale tables, and every process of a pool
+does it again.  The index (created once by
+legacypipe/create_ccd_index.py) is a directory holding:
+
+  <column>.npy     -- one array per column, memory-mapped on use;
+  expnum-order.npy, expnum-sorted.npy -- the rows sorted by expnum,
+                      and their expnums, for expnum searches;
+  ccds.kd.fits     -- a kd-tree of the CCD centers, for RA,Dec searches;
+  files.npy, file-index.npy -- the names of the CCDs files the index
+                      was made from, and the file each row came from.
+
+CCDIndex reads only the columns and rows that are asked for; since the
+columns are memory-mapped, the processes of a node share them through
+the page cache.  It pickles as just its directory name.
+
+Surveys that select among the CCDs files (filter_ccds_files,
+filter_ccd_kd_files; eg, runs.DecamSurvey) restrict the index to the
+rows from the files they select, with *select_files*.
+'''
+import os
+
+import numpy as np
+
+INDEX_EXTRA_FILES = ['expnum-order.npy', 'expnum-sorted.npy', 'ccds.kd.fits',
+                     'files.npy', 'file-index.npy']
+
+class CCDIndex(object):
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.columns = sorted([fn[:-4] for fn in os.listdir(dirname)
+                               if fn.endswith('.npy') and not fn in INDEX_EXTRA_FILES])
+        # Names of the CCDs files the rows came from (None for indices
+        # made before they were recorded)
+        self.files = None
+        fn = os.path.join(dirname, 'files.npy')
+        if os.path.exists(fn):
+            self.files = [str(f) for f in np.load(fn)]
+        self._reset()
+
+    def _reset(self):
+        self._cols = {}
+        self._kd = None
+        self._expnum_order = None
+        # Selected rows (boolean mask), or None for all
+        self._keep = None
+        self._keep_files = None
+
+    def __getstate__(self):
+        return dict(dirname=self.dirname, columns=self.columns, files=self.files)
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._reset()
+
+    def __len__(self):
+        return len(self.column(self.columns[0]))
+
+    def select_files(self, files):
+        '''
+        Restricts the rows returned by *rows*, *table* (by default),
+        *search_radec* and *expnum_rows* to those from the CCDs files
+        named *files* (a subset of *self.files*).
+        '''
+        files = sorted(files)
+        if files == sorted(self.files):
+            self._keep = None
+            self._keep_files = None
+            return
+        if files == self._keep_files:
+            return
+        fileindex = np.load(os.path.join(self.dirname, 'file-index.npy'), mmap_mode='r')
+        self._keep = np.in1d(fileindex, [self.files.index(f) for f in files])
+        self._keep_files = files
+
+    def _cut(self, I):
+        if self._keep is None:
+            return I
+        return I[self._keep[I]]
+
+    def rows(self):
+        '''
+        Returns the (selected) rows.
+        '''
+        if self._keep is None:
+            return np.arange(len(self))
+        return np.flatnonzero(self._keep)
+
+    def column(self, c):
+        a = self._cols.get(c)
+        if a is None:
+            a = np.load(os.path.join(self.dirname, c + '.npy'), mmap_mode='r')
+            self._cols[c] = a
+        return a
+
+    def table(self, rows=None, columns=None):
+        '''
+        Returns a fits_table of the given *rows* (index array; default
+        all selected rows) and *columns* (default all).
+        '''
+        from astrometry.util.fits import fits_table
+        if columns is None:
+            columns = self.columns
+        if rows is None and self._keep is not None:
+            rows = self.rows()
+        T = fits_table()
+        for c in columns:
+            a = self.column(c)
+            if rows is None:
+                T.set(c, np.array(a))
+            else:
+                T.set(c, a[rows])
+        return T
+
+    def search_radec(self, ra, dec, radius):
+        '''
+        Returns the rows of CCDs whose centers are within *radius*
+        degrees of *ra*,*dec*.
+        '''
+        from astrometry.libkd.spherematch import tree_open, tree_search_radec
+        if self._kd is None:
+            self._kd = tree_open(os.path.join(self.dirname, 'ccds.kd.fits'))
+        return self._cut(np.sort(tree_search_radec(self._kd, ra, dec, radius)))
+
+    def expnum_rows(self, expnum):
+        '''
+        Returns the rows of CCDs with the given *expnum*.
+        '''
+        if self._expnum_order is None:
+            self._expnum_order = (
+                np.load(os.path.join(self.dirname, 'expnum-order.npy'), mmap_mode='r'),
+                np.load(os.path.join(self.dirname, 'expnum-sorted.npy'), mmap_mode='r'))
+        order,sorted_expnum = self._expnum_order
+        i0 = np.searchsorted(sorted_expnum, expnum, side='left')
+        i1 = np.searchsorted(sorted_expnum, expnum, side='right')
+        return self._cut(np.sort(np.array(order[i0:i1])))
+
+def write_ccd_index(T, dirname, files, fileindex):
+    '''
+    Writes the CCDs table *T*, whose rows came from the CCDs files
+    named *files* (row i from files[fileindex[i]]), as an index in
+    directory *dirname*; the directory appears only once complete.
+    '''
+    import shutil
+    from astrometry.libkd.spherematch import tree_build_radec
+    tmpdir = dirname + '.tmp-%i' % os.getpid()
+    os.makedirs(tmpdir)
+    for c in T.get_columns():
+        a = T.get(c)
+        if a.dtype.kind == 'O':
+            a = np.array(list(a))
+        np.save(os.path.join(tmpdir, c + '.npy'), np.ascontiguousarray(a))
+    order = np.argsort(T.expnum, kind='stable')
+    np.save(os.path.join(tmpdir, 'expnum-order.npy'), order)
+    np.save(os.path.join(tmpdir, 'expnum-sorted.npy'), T.expnum[order])
+    np.save(os.path.join(tmpdir, 'files.npy'), np.array(files))
+    np.save(os.path.join(tmpdir, 'file-index.npy'), np.array(fileindex, np.int16))
+    kd = tree_build_radec(T.ra, T.dec)
+    kd.write(os.path.join(tmpdir, 'ccds.kd.fits'))
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpdir, dirname)
@@ -0,0 +1,195 @@
+'''
+Append-only checkpoint files for blob-fitting results.
+
+A checkpoint file is a short header followed by one framed record per
+finished blob:
+
+    [4-byte magic][uint32 length][uint32 crc32][pickled record]
+
+where the record is the dict(brickname=, iblob=, result=) produced by
+runbrick._bounce_one_blob.  Writing a checkpoint therefore only costs
+as much as the new results, and a reader stops cleanly at a truncated
+or corrupted tail (eg, if the writer was killed mid-record), or at a
+record that cannot be unpickled.
+
+Checkpoint files in the older format (a single pickled list of
+records) can still be read.
+'''
+import os
+import struct
+import pickle
+import zlib
+import time
+
+import logging
+logger = logging.getLogger('legacypipe.checkpoint')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+FILE_MAGIC = b'LPCKPT1\n'
+RECORD_MAGIC = b'BLOB'
+_frame = struct.Struct('<4sII')
+
+def _is_checkpoint_log(fn):
+    with open(fn, 'rb') as f:
+        return f.read(len(FILE_MAGIC)) == FILE_MAGIC
+
+def _read_frames(fn):
+    '''
+    Yields (record, end) for each good record in checkpoint log *fn*,
+    where *end* is the file offset just past it.  Stops (with a
+    warning) at the first truncated or corrupted record, or one that
+    fails to unpickle.
+    '''
+    nread = 0
+    with open(fn, 'rb') as f:
+        f.seek(len(FILE_MAGIC))
+        while True:
+            hdr = f.read(_frame.size)
+            if len(hdr) == 0:
+                break
+            if len(hdr) < _frame.size:
+                print('Checkpoint file', fn, ': truncated record header after',
+                      nread, 'records')
+                break
+            magic,length,crc = _frame.unpack(hdr)
+            if magic != RECORD_MAGIC:
+                print('Checkpoint file', fn, ': bad record magic after',
+                      nread, 'records')
+                break
+            data = f.read(length)
+            if len(data) < length:
+                print('Checkpoint file', fn, ': truncated record after',
+                      nread, 'records')
+                break
+            if zlib.crc32(data) & 0xffffffff != crc:
+                print('Checkpoint file', fn, ': bad record checksum after',
+                      nread, 'records')
+                break
+            try:
+                record = pickle.loads(data)
+            except Exception as e:
+                print('Checkpoint file', fn, ': failed to unpickle record after',
+                      nread, 'records:', e)
+                break
+            del data
+            yield record, f.tell()
+            nread += 1
+    debug('Read', nread, 'records from checkpoint file', fn)
+
+def checkpoint_good_length(fn):
+    '''
+    Returns the length of the part of checkpoint log *fn* holding good
+    records, ie, the offset just past the last good record.  (This
+    unpickles the records, to check them.)
+    '''
+    end = len(FILE_MAGIC)
+    for _,end in _read_frames(fn):
+        pass
+    return end
+
+def read_checkpoint(fn):
+    '''
+    Yields the records in checkpoint file *fn*, in the order they were
+    written.  Reading stops (with a warning) at the first truncated,
+    corrupted or unpicklable record.
+    '''
+    if not _is_checkpoint_log(fn):
+        # Old format: a pickled list of records.
+        from astrometry.util.file import unpickle_from_file
+        for r in unpickle_from_file(fn):
+            yield r
+        return
+    for r,_ in _read_frames(fn):
+        yield r
+
+class CheckpointWriter(object):
+    '''
+    Appends records to a checkpoint file.  Records are written to the
+    (buffered) file immediately, and flushed & fsync'ed to disk at
+    most every *sync_period* seconds, or when *sync()* or *close()* is
+    called.
+
+    If *overwrite* is True, any existing file is replaced; otherwise
+    records are appended to it, after cutting off any truncated,
+    corrupted or unpicklable tail (which would hide the new records
+    from readers).  An old-format file is converted; if it cannot be
+    read, a new (empty) file is started.
+    '''
+    def __init__(self, fn, overwrite=False, sync_period=0.):
+        from astrometry.util.file import trymakedirs
+        self.fn = fn
+        self.sync_period = sync_period
+        d = os.path.dirname(fn)
+        if len(d) and not os.path.exists(d):
+            trymakedirs(d)
+        if (not overwrite) and os.path.exists(fn) and not _is_checkpoint_log(fn):
+            # Convert an old-format checkpoint file.
+            try:
+                R = list(read_checkpoint(fn))
+            except Exception as e:
+                print('Checkpoint file', fn, ': failed to read old-format file:',
+                      e, '-- starting a new one')
+                R = []
+            write_checkpoint(R, fn)
+        if overwrite or not os.path.exists(fn) or os.path.getsize(fn) == 0:
+            self.f = open(fn, 'wb')
+            self.f.write(FILE_MAGIC)
+        else:
+            good = checkpoint_good_length(fn)
+            if good < os.path.getsize(fn):
+                print('Checkpoint file', fn, ': cutting', os.path.getsize(fn) - good,
+                      'bytes of bad records before appending')
+                with open(fn, 'r+b') as f:
+                    f.truncate(good)
+            self.f = open(fn, 'ab')
+        self.last_sync = time.time()
+        self.nunsynced = 0
+
+    def append(self, record):
+        data = pickle.dumps(record, -1)
+        self.f.write(_frame.pack(RECORD_MAGIC, len(data),
+                                 zlib.crc32(data) & 0xffffffff))
+        self.f.write(data)
+        self.nunsynced += 1
+        if self.sync_period is not None:
+            if time.time() - self.last_sync >= self.sync_period:
+                self.sync()
+
+    def sync(self):
+        if self.nunsynced == 0:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        debug('Synced', self.nunsynced, 'new records to checkpoint', self.fn)
+        self.nunsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.f is None:
+            return
+        self.sync()
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_checkpoint(R, fn):
+    '''
+    Writes the list of records *R* as a new checkpoint file *fn*
+    (atomically, via a temp file).
+    '''
+    tmpfn = os.path.join(os.path.dirname(fn), 'tmp-' + os.path.basename(fn))
+    with CheckpointWriter(tmpfn, overwrite=True, sync_period=None) as w:
+        for r in R:
+            w.append(r)
+    os.rename(tmpfn, fn)
+    debug('Wrote checkpoint to', fn)
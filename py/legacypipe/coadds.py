@@ -4,7 +4,8 @@ import fitsio
 from astrometry.util.fits import fits_table
 from astrometry.util.resample import resample_with_wcs, OverlapError
 from legacypipe.bits import DQ_BITS
-from legacypipe.survey import tim_get_resamp
+from legacypipe.survey import tim_get_resamp, tim_get_resamp_map
+from legacypipe.survey import tim_resample_lanczos
 from legacypipe.utils import copy_header_with_wcs
 
 import logging
@@ -885,13 +886,16 @@ def _resample_one(args):
     else:
         imgs = []
 
-    try:
-        Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
-            targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
-    except OverlapError:
-        return None
-    if len(Yo) == 0:
-        return None
+    if lanczos:
+        R = tim_resample_lanczos(tim, targetwcs, imgs)
+        if R is None:
+            return None
+        Yo,Xo,Yi,Xi,rimgs = R
+    else:
+        R = tim_get_resamp_map(tim, targetwcs)
+        if R is None:
+            return None
+        Yo,Xo,Yi,Xi = R.indices()
     mo = None
     bmo = None
     if lanczos:
@@ -0,0 +1,47 @@
+import os
+import numpy as np
+from astrometry.util.fits import fits_table, merge_tables
+
+#  This script creates the survey-ccds-index directory (see
+# legacypipe/ccdindex.py) from survey-ccds-*.fits.gz (zeropoints) files
+#
+
+def create_ccd_index(infns, outdir, ccd_cuts):
+    from legacypipe.survey import LegacySurveyData, add_ccd_corners
+    from legacypipe.ccdindex import write_ccd_index
+
+    TT = []
+    # Which file each row came from, so that surveys can select files
+    # (see LegacySurveyData.get_ccd_index)
+    fileindex = []
+    for i,fn in enumerate(infns):
+        T = fits_table(fn)
+        print('Read', len(T), 'from', fn)
+        if ccd_cuts:
+            T.cut(T.ccd_cuts == 0)
+            print('Cut to', len(T), 'on ccd_cuts')
+        TT.append(T)
+        fileindex.append(np.zeros(len(T), np.int16) + i)
+    if len(TT) > 1:
+        T = merge_tables(TT, columns='fillzero')
+    else:
+        T = TT[0]
+    del TT
+    fileindex = np.hstack(fileindex)
+    print('Total of', len(T), 'CCDs')
+    # Strip strings once here, rather than on every read
+    T = LegacySurveyData().cleanup_ccds_table(T)
+    # Precompute the CCD corners for ccds_touching_wcs
+    T = add_ccd_corners(T)
+    write_ccd_index(T, outdir, [os.path.basename(fn) for fn in infns], fileindex)
+    print('Wrote', outdir)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infn', nargs='+', help='Input filenames (CCDs files)')
+    parser.add_argument('--out', required=True,
+                        help='Output directory (eg, $LEGACY_SURVEY_DIR/survey-ccds-index)')
+    parser.add_argument('--no-cut', dest='ccd_cuts', default=True, action='store_false')
+    opt = parser.parse_args()
+    create_ccd_index(opt.infn, opt.out, opt.ccd_cuts)
@@ -1,6 +1,7 @@
 import os
 from astrometry.libkd.spherematch import *
 from astrometry.util.fits import fits_table
+from legacypipe.survey import add_ccd_corners
 import numpy as np
 import tempfile
 
@@ -17,6 +18,8 @@ def create_kdtree(infn, outfn, ccd_cuts):
     if ccd_cuts:
         T.cut(T.ccd_cuts == 0)
         print('Cut to', len(T), 'on ccd_cuts')
+    # Precompute the CCD corners for ccds_touching_wcs
+    T = add_ccd_corners(T)
     tfn = os.path.join(tempdir, 'ccds.fits')
     T.writeto(tfn)
 
@@ -321,6 +321,7 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     '''
     from scipy.ndimage.measurements import label, find_objects
     from scipy.ndimage.morphology import binary_dilation, binary_fill_holes
+    from legacypipe.utils import region_batches, paint_batch
 
     H,W = detmaps[0].shape
     allzero = True
@@ -467,14 +468,15 @@ def sed_matched_detection(sedname, sed, detmaps, detivs, bands,
     else:
         this_veto_map = veto_map.copy()
 
-    for x,y,r in zip(xomit, yomit, romit):
-        xlo = int(np.clip(np.floor(x - r), 0, W-1))
-        xhi = int(np.clip(np.ceil (x + r), 0, W-1))
-        ylo = int(np.clip(np.floor(y - r), 0, H-1))
-        yhi = int(np.clip(np.ceil (y + r), 0, H-1))
-        this_veto_map[ylo:yhi+1, xlo:xhi+1] |= (np.hypot(
-            (x - np.arange(xlo, xhi+1))[np.newaxis, :],
-            (y - np.arange(ylo, yhi+1))[:, np.newaxis]) < r)
+    # (painted in batches of same-sized circles)
+    xo = np.asarray(xomit)
+    yo = np.asarray(yomit)
+    ro = np.asarray(romit)
+    for J,gx,gy in region_batches(xo, yo, ro, shape=this_veto_map.shape):
+        paint_batch(this_veto_map, True, gx, gy, np.hypot(
+            (xo[J][:,np.newaxis] - gx)[:, np.newaxis, :],
+            (yo[J][:,np.newaxis] - gy)[:, :, np.newaxis]) <
+                    ro[J][:,np.newaxis,np.newaxis])
 
     if ps is not None:
         plt.clf()
@@ -43,7 +43,11 @@ These processes communicate with each other over multiprocessing.Queue
 objects:
 
 - "inqueue" goes from input_threads to network_thread and contains
-  "work packets" that will be sent to the workers.
+  "work packets" that will be sent to the workers.  The network_thread
+  sorts them into a priority queue per brick (BrickSchedule), and
+  interleaves the bricks (--brick-policy); up to --bricks-in-flight
+  bricks are queued or running at once, and each is checkpointed and
+  marked done in QDO as soon as its own blobs are finished.
 - "outqueue" goes from network_thread to output_thread and contains
   results received from workers.
 - "checkpointqueue" goes from input_threads to output_thread, and is
@@ -66,25 +70,33 @@ The overall data flow is:
   function.)  It calls the "get_blob_iter" function to produce a
   series of work packets (one for each blob, containing subimages and
   sources to be fit).  Each work packet gets put on the "input_queue".
+  Work packets are compressed, and objects shared by many blobs (eg,
+  the per-tim image objects and PSF model arrays) are sent to each
+  worker only once (see legacypipe/workpacket.py).
 
-- a worker.py client sends a message to the farm.py socket.  The first
-  time it calls, it sends an empty message.
+- a worker.py client connects to the farm.py socket and asks for a
+  few work packets ("credits"; worker.py --prefetch).
 
-- the network_thread receives the message, and replies with a work
-  packet (that it has pulled off the input_queue).
+- the network_thread sends each waiting worker a work packet (that it
+  has pulled off the input_queue), one per credit.
 
 - the worker.py calls the one_blob() function to perform the work in
-  its work packet.  It sends the result to the farm.py socket.  (And
-  receives in reply its next work assignment.)
-
-- the network_thread receives the message containing the results (and
-  replies with the next work packet for the worker).  It puts the
-  result on the output_queue.
-
-- the output_thread pops a result off the output_queue, and if it
+  its work packet, while the next packets wait in its local queue.  It
+  sends the result to the farm.py socket as soon as it is done; each
+  result earns the worker another credit.
+
+- the network_thread receives the message containing the results,
+  acknowledges it, and puts the result on the output_queue.  Workers
+  resend results that are not acknowledged.  Workers also send
+  heartbeats; if a worker goes silent for --worker-timeout seconds,
+  its outstanding work packets are sent to other workers (and only
+  the first result for each packet is kept).
+
+- the output_thread pops a result off the output_queue and appends it
+  to the brick's checkpoint file (see legacypipe/checkpoint.py), which
+  is synced to disk every --checkpoint-period seconds.  If it
   determines that this is the final result for this brick, then it
-  will write the output checkpoint file and mark the brick as finished
-  in QDO.
+  will close the checkpoint file and mark the brick as finished in QDO.
 
 
 
@@ -117,10 +129,10 @@ Bottlenecks in the current setup (as I understand them) are:
   them share a single queue.  There is no particular reason they need
   to share a queue; we would then have to implement a simple
   round-robin scheme to pull work from the different input_queues.
-- currently, the worker.py processes are synchronous: they ask for
-  work, wait for the reply, do the work, and send in the result.  We
-  could keep a short queue (per worker or even for the set of workers
-  sharing a node) to reduce this latency.
+- the worker.py processes keep a short queue of prefetched work
+  packets, so they do not wait for a network round trip between
+  blobs; but the work prefetched by a worker that dies is only
+  redelivered after --worker-timeout.
 
 Last I checked, I could keep up with about 64 KNL nodes x 68 worker.py
 processes with 8 input_thread processes, but efficiency was starting
@@ -137,7 +149,7 @@ import multiprocessing as mp
 import queue
 import zmq
 
-from legacypipe.runbrick import _blob_iter, _write_checkpoint
+from legacypipe.runbrick import _blob_iter
 
 import logging
 logger = logging.getLogger('farm')
@@ -173,6 +185,18 @@ def main():
                         help='Network port (TCP) for big blobs, if --big=queue')
     parser.add_argument('--big-command-port', default=5566, type=int,
                         help='Network port (TCP) for big blob commands, if --big=queue')
+    parser.add_argument('--bricks-in-flight', type=int, default=4,
+                        help='Number of bricks whose blobs may be queued or running at once')
+    parser.add_argument('--brick-policy', default='fair', choices=['fair', 'deadline'],
+                        help='How to interleave blobs from the bricks in flight: "fair" (to the brick with the fewest blobs running) or "deadline" (oldest brick first)')
+    parser.add_argument('--worker-timeout', type=float, default=60.,
+                        help='Seconds of silence after which a worker is presumed dead and its blobs are sent to others')
+    parser.add_argument('--blob-cost-model', default=None,
+                        help='Queue blobs in order of CPU time predicted by this model file (from legacypipe.blobcost), or "default"; default is by size')
+    parser.add_argument('--tail-aware', default=False, action='store_true',
+                        help='With --blob-cost-model and --big=queue, send blobs predicted to outlast the rest of their brick to the big queue')
+    parser.add_argument('--tail-workers', type=int, default=64,
+                        help='Number of workers expected per brick, for --tail-aware')
     parser.add_argument('-v', '--verbose', dest='verbose', action='count',
                         default=0, help='Make more verbose')
     opt = parser.parse_args()
@@ -188,9 +212,15 @@ def main():
 
     queuename = opt.queue
 
-    # inqueue: for holding blob-work-packets
-    #inqueue = queue.PriorityQueue(maxsize=10000)
-    # Effectively, run a brick at a time, prioritizing as usual...
+    if opt.blob_cost_model is not None:
+        from legacypipe.blobcost import BlobCostModel
+        if opt.blob_cost_model == 'default':
+            opt.blob_cost_model = BlobCostModel()
+        else:
+            opt.blob_cost_model = BlobCostModel.read(opt.blob_cost_model)
+
+    # inqueue: for holding blob-work-packets (the network thread
+    # prioritizes them, per brick)
     inqueue = mp.Queue(maxsize=10000)
 
     # bigqueue: like inqueue, but for big blobs.
@@ -215,32 +245,37 @@ def main():
     # that a brick has been finished.
     finished_bricks = mp.Queue()
 
+    # Each brick holds a slot from being taken from QDO until it is finished.
+    brick_slots = mp.Semaphore(opt.bricks_in_flight)
+
     inthreads = []
     for i in range(opt.inthreads):
         inthread = mp.Process(target=input_thread,
                               args=(queuename, inqueue, bigqueue, checkpointqueue,
-                                    blobsizes, opt, i),
+                                    blobsizes, brick_slots, opt, i),
                               daemon=True)
         inthreads.append(inthread)
         inthread.start()
 
     outthread = mp.Process(target=output_thread,
                                  args=(queuename, outqueue, checkpointqueue, blobsizes,
-                                       finished_bricks, opt),
+                                       finished_bricks, brick_slots, opt),
                                  daemon=True)
     outthread.start()
 
     ctx = None
     networkthread = mp.Process(target=network_thread,
                                args=(ctx, opt.port, opt.command_port, inqueue, outqueue,
-                                     finished_bricks, 'main'),
+                                     finished_bricks, 'main', opt.worker_timeout,
+                                     opt.brick_policy),
                                daemon=True)
     networkthread.start()
 
     if opt.big == 'queue':
         bignetworkthread = mp.Process(target=network_thread,
                                             args=(ctx, opt.big_port, opt.big_command_port,
-                                                  bigqueue, outqueue, None, 'big'),
+                                                  bigqueue, outqueue, None, 'big',
+                                                  opt.worker_timeout, opt.brick_policy),
                                       daemon=True)
         bignetworkthread.start()
     else:
@@ -253,7 +288,22 @@ def main():
         bignetworkthread.join()
 
 
-def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks, qname):
+def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks, qname,
+                   worker_timeout=60., policy='fair', stop=None):
+    '''
+    Hands out work packets from *inqueue* to workers (see worker.py
+    for the protocol) and puts their results on *outqueue*.  Packets
+    from different bricks are interleaved according to *policy* (see
+    BrickSchedule).
+
+    Each worker asks for some number of packets ahead of time
+    ("credits"), and earns one more credit for each result it
+    returns.  Workers that have not been heard from (results or
+    heartbeats) for *worker_timeout* seconds are presumed dead, and
+    their outstanding packets are sent to other workers.
+
+    *stop*: an Event; if given, return once it is set (for testing).
+    '''
     # Set my process name
     try:
         import setproctitle
@@ -263,10 +313,13 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
 
     # Set up ZeroMQ socket for communicating with workers
     import socket
+    from collections import deque, OrderedDict
+    from legacypipe.workpacket import ObjectCache
     me = socket.gethostname()
-    if ctx is None:
+    own_ctx = (ctx is None)
+    if own_ctx:
         ctx = zmq.Context()
-    sock = ctx.socket(zmq.REP)
+    sock = ctx.socket(zmq.ROUTER)
     addr = 'tcp://*:' + str(port)
     sock.bind(addr)
     print('Listening on tcp://%s:%i for work (queue: %s)' % (me, port, qname))
@@ -279,22 +332,44 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
         command_sock.bind(caddr)
         print('Listening on tcp://%s:%i for commands (queue: %s)' % (me, command_port, qname))
 
-    nowork = pickle.dumps(None, -1)
-    havework = False
-    work = None
     worksent = 0
     resultsreceived = 0
 
     all_finished_bricks = {}
 
+    # (br,iblob) -> (worker, time sent, work packet)
     outstanding_work = {}
+    # (br,iblob) -> work packet, for packets taken back from dead workers
+    redeliver = OrderedDict()
+    # worker -> ObjectCache mirroring the shared objects it holds
+    worker_objects = {}
+    # Work packets waiting to be sent, by brick
+    schedule = BrickSchedule(policy)
+    # brick -> number of packets outstanding at workers
+    brick_outstanding = Counter()
+    # One entry per credit: the (ZeroMQ routing ids of) workers waiting for work.
+    ready = deque()
+    # worker -> number of packets sent since its last b'ready'; each
+    # result for one of them earns a credit.
+    worker_sent = Counter()
+    # workers sent a b'reset' and not yet heard b'ready' from
+    reset_sent = set()
+    # worker -> time of last message
+    last_seen = {}
+    # worker -> job id
+    worker_names = {}
+    # workers we have given up on
+    dead_workers = set()
     cputimes = {}
 
     last_printout = time.time()
     last_print_workqueue = time.time()
     last_check_command = time.time()
 
-    nworkpackets = nworkbytes = 0
+    # Bytes of work packets sent; and of shared objects sent, and not
+    # sent because the worker already had them.
+    nworkpackets = nworkbytes = nredelivered = 0
+    nobjbytes = nobjsaved = 0
     nwaitingCounter = Counter()
 
     # For keeping track of how much time is spent in different parts of my job
@@ -305,7 +380,7 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
     t_decode = 0
     t_out = 0
 
-    while True:
+    while stop is None or not stop.is_set():
         tnow = time.time()
         t1 = tnow
 
@@ -318,12 +393,14 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
                     print('Message on command socket:', pymsg)
                     if pymsg[0] == 'reset':
                         ncan = 0
-                        for (br,ib) in outstanding_work.keys():
+                        for (br,ib) in list(outstanding_work.keys()) + list(redeliver.keys()):
                             worksent -= 1
                             print('Network thread: cancelling', br,ib)
                             outqueue.put((br, ib, 'cancel'))
                             ncan += 1
                         outstanding_work = {}
+                        redeliver.clear()
+                        brick_outstanding.clear()
                         reply = (True, 'cancelled %i blobs' % ncan)
                     else:
                         print('Unrecognized message on command socket:', pymsg)
@@ -335,32 +412,82 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
                     break
             last_check_command = tnow
 
+        # Take back the work of workers we have not heard from.
+        for worker,tlast in list(last_seen.items()):
+            if tnow - tlast < worker_timeout:
+                continue
+            print('Worker', worker_names.get(worker), 'silent for %.0f s; presumed dead' %
+                  (tnow - tlast))
+            del last_seen[worker]
+            dead_workers.add(worker)
+            ready = deque([w for w in ready if w != worker])
+            del worker_sent[worker]
+            for k,(w,_,work) in list(outstanding_work.items()):
+                if w == worker:
+                    del outstanding_work[k]
+                    brick_outstanding[k[0]] -= 1
+                    redeliver[k] = work
+                    nredelivered += 1
+
         debug('Network thread: work queue:', inqueue.qsize(), 'out queue:', outqueue.qsize(), 'work sent:', worksent, ', received:', resultsreceived, 'outstanding:', worksent-resultsreceived)
 
-        # Retrieve the next work assignment from my input_threads.
-        if not havework:
+        # Move newly-queued work packets into the per-brick schedule.
+        for i in range(1000):
             try:
-                #arg = inqueue.get(block=False)
-                arg = inqueue.get(block=True, timeout=0.1)
-                (br,iblob,work) = arg.item
-                havework = True
-                debug('Next work packet:', len(work), 'bytes')
+                arg = inqueue.get(block=False)
             except queue.Empty:
-                work = nowork
-                havework = False
-                print('Work queue is empty.')
+                break
+            (br,iblob,work) = arg.item
+            schedule.add(br, iblob, arg.priority, work)
+
+        # Hand out work to workers with credits; redelivered packets first.
+        while len(ready):
+            if len(redeliver):
+                k,work = redeliver.popitem(last=False)
+                (br,iblob) = k
+            else:
+                nxt = schedule.pop(brick_outstanding)
+                if nxt is None:
+                    break
+                (br,iblob,work) = nxt
+            worker = ready.popleft()
+            (packet, deps, objs) = work
+            cache = worker_objects[worker]
+            new = cache.missing(deps)
+            cache.update(deps, objs, keep_values=False)
+            msg = [worker, b'work', pickle.dumps(deps, -1), packet]
+            for h in new:
+                msg.extend([h.encode(), objs[h]])
+            t2 = time.time()
+            sock.send_multipart(msg)
+            t_send += (time.time() - t2)
+            nworkpackets += 1
+            nworkbytes += len(packet)
+            for h in deps:
+                if h in new:
+                    nobjbytes += len(objs[h])
+                else:
+                    nobjsaved += len(objs[h])
+            worksent += 1
+            worker_sent[worker] += 1
+            outstanding_work[(br,iblob)] = (worker, time.time(), work)
+            brick_outstanding[br] += 1
+            debug('Sent work packet:', len(packet), 'bytes +', len(new), 'of', len(deps), 'objects')
 
         t1a = time.time()
 
         if tnow - last_print_workqueue > 2:
-            print('Work queue:', inqueue.qsize(), 'Work packets sent:', nworkpackets, 'bytes:', nworkbytes)
+            print('Work queue:', inqueue.qsize(), 'scheduled:', len(schedule), 'bricks:', schedule.nbricks(), 'Work packets sent:', nworkpackets, 'bytes:', nworkbytes, 'redelivered:', nredelivered, 'credits waiting:', len(ready))
+            print('Shared-object bytes sent:', nobjbytes, 'already held by workers:', nobjsaved,
+                  '; total sent %.1f MB/s' % ((nworkbytes + nobjbytes) / 1e6 / max(1., tnow - last_print_workqueue)))
             nw = list(nwaitingCounter.keys())
             nw.sort()
-            print('Histogram of number of packets waiting in socket:')
+            print('Histogram of number of messages waiting in socket:')
             for n in nw:
                 print('  ', n, ':', nwaitingCounter[n])
             nwaitingCounter.clear()
-            nworkpackets = nworkbytes = 0
+            nworkpackets = nworkbytes = nredelivered = 0
+            nobjbytes = nobjsaved = 0
             last_print_workqueue = tnow
 
         if tnow - last_printout > 15:
@@ -379,7 +506,6 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
 
             print()
             print('Work queue:', inqueue.qsize(), 'out queue:', outqueue.qsize(), 'work sent:', worksent, ', received:', resultsreceived, 'outstanding:', worksent-resultsreceived)
-            #print('Outstanding work:')
             c = Counter()
             ct = Counter()
             oldest = {}
@@ -390,25 +516,16 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
             worker_cpu  = Counter()
             worker_nblobs = Counter()
             for k,v in cputimes.items():
-                (br,ib) = k
                 (worker,cpu,wall,overhead) = v
                 worker_wall[worker] += wall
                 worker_cpu [worker] += cpu
                 worker_overhead[worker] += overhead
                 worker_nblobs[worker] += 1
-                try:
-                    del outstanding_work[k]
-                except KeyError:
-                    pass
             cputimes = {}
 
-            ## outstanding_work[(br,iblob)] = (worker, tnow)
             for k,v in outstanding_work.items():
-                (worker,tstart) = v
+                (worker,tstart,_) = v
                 (br,ib) = k
-                # if i < 10:
-                #     print('  brick,blob', br,ib, 'worker', worker.decode(),
-                #           'started %.1f s ago' % (tnow-tstart))
                 c[br] += 1
                 ct[br] += (tnow-tstart)
                 if not br in oldest:
@@ -416,8 +533,6 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
                 if not worker in workers_telapsed:
                     workers_telapsed[worker] = []
                 workers_telapsed[worker].append(tnow-tstart)
-            # if len(outstanding_work) > 10:
-            #     print('  ....')
             print('Outstanding bricks:')
             for b,n in c.most_common():
                 print('  ', b, 'waiting for', n, 'blobs')
@@ -427,40 +542,20 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
             print('Oldest blob per brick:')
             for b,t in oldest.items():
                 print('  ', b, ': %.1f s' % t)
-            kk = list(workers_telapsed.keys())
-            kk.sort()
-            #print('Workers:')
-            ntotal = 0
-            for k in kk:
-                t = workers_telapsed[k]
-                ntotal += len(t)
-                #print('  ', k.decode(), ':', len(t), 'tasks, started %.1f to %.1f s ago' % (min(t), max(t)))
-            print('Workers:', len(kk), 'Total tasks:', ntotal, 'average %.1f' % (ntotal/max(1,len(kk))))
-
-            kk = list(worker_wall.keys())
-            kk.sort()
+            ntotal = sum([len(t) for t in workers_telapsed.values()])
+            print('Workers:', len(last_seen), 'busy:', len(workers_telapsed),
+                  'Total tasks:', ntotal,
+                  'average %.1f' % (ntotal/max(1,len(workers_telapsed))))
+
             print('Completed work since last printout:')
-            total_wall = 0
-            total_cpu = 0
-            total_overhead = 0
-            total_blobs = 0
-            for k in kk:
-                # if worker_wall[k] == 0:
-                #     pct = 0
-                # else:
-                #     pct = 100. * worker_cpu[k] / (worker_wall[k] + worker_overhead[k])
-                #print('   %s: %i blobs, overhead %.1fs, wall time %.1f s, CPU time %.1f --> %.1f %%' %
-                #      (k.decode(), worker_nblobs[k], worker_overhead[k], worker_wall[k], worker_cpu[k], pct))
-                total_wall += worker_wall[k]
-                total_cpu  += worker_cpu[k]
-                total_overhead += worker_overhead[k]
-                total_blobs += worker_nblobs[k]
+            total_wall = sum(worker_wall.values())
+            total_cpu = sum(worker_cpu.values())
+            total_overhead = sum(worker_overhead.values())
+            total_blobs = sum(worker_nblobs.values())
             tb = max(total_blobs, 1)
             pct = 100. * total_cpu / max(1, total_wall + total_overhead)
             print('Total %i blobs, overhead %.1f s/blob, wall %.1f s/blob, cpu %.1f s/blob --> %.1f %%' %
                   (total_blobs, total_overhead/tb, total_wall/tb, total_cpu/tb, pct))
-                   
-
 
             print('Time spent in:')
             print('  input: %.1f' % t_in)
@@ -474,74 +569,91 @@ def network_thread(ctx, port, command_port, inqueue, outqueue, finished_bricks,
 
             last_printout = tnow
 
-        debug('Waiting for request')
-
-        #if not havework or command_sock is not None:
-        #     events = sock.poll(5000)
-        #     if events == 0:
-        #         # recv timed out; check work queue again
-        #         continue
-
+        debug('Waiting for messages')
 
         events = sock.poll(timeout=0)
         nwaitingCounter[events] += 1
-
-        events = sock.poll(timeout=5000)
-        #print('Messages waiting:', events)
         if events == 0:
-            # recv timed out; check work queue again
-            continue
-
+            # (check the work queue again soon if workers are waiting for it)
+            events = sock.poll(timeout=(100 if len(ready) else 1000))
         t1b = time.time()
+        t_in += (t1a - t1)
+        t_poll += (t1b - t1a)
 
-        parts = sock.recv_multipart()
-
-        t2 = time.time()
-
-        assert(len(parts) == 3)
-        worker = parts[0]
-        meta   = parts[1]
-        result = parts[2]
-        debug('Request: from', worker, ':', len(result), 'bytes')
-        try:
-            sock.send(work) #, flags=zmq.NOBLOCK)
-            if havework:
-                nworkpackets += 1
-                nworkbytes += len(work)
-
-                worksent += 1
-                tnow = time.time()
-                havework = False
-                outstanding_work[(br,iblob)] = (worker, tnow)
-        except:
-            print('Network thread: sock.send(work) failed:')
-            import traceback
-            traceback.print_exc()
-
-        t3 = time.time()
+        # Handle all waiting messages.
+        while events:
+            t2 = time.time()
+            parts = sock.recv_multipart()
+            t3 = time.time()
+            t_recv += (t3 - t2)
+            events = sock.poll(timeout=0)
+
+            worker = parts[0]
+            kind = parts[1]
+            if kind == b'ready':
+                dead_workers.discard(worker)
+                reset_sent.discard(worker)
+            elif worker in dead_workers or not worker in worker_objects:
+                # We gave up on it (and dropped its credits), or have
+                # never heard b'ready' from it (eg, we restarted, or
+                # it reconnected with a new routing id): have it start
+                # over.  Once is enough, until it says b'ready'.
+                if not worker in reset_sent:
+                    sock.send_multipart([worker, b'reset'])
+                    reset_sent.add(worker)
+            if not worker in dead_workers:
+                last_seen[worker] = t3
+            worker_names[worker] = parts[2]
+
+            if kind == b'ready':
+                n,cachebytes = pickle.loads(parts[3])
+                debug('Worker', parts[2], 'ready for', n, 'packets')
+                # The worker starts over: it has *n* credits, and an
+                # empty object cache.
+                ready = deque([w for w in ready if w != worker])
+                ready.extend([worker] * n)
+                del worker_sent[worker]
+                worker_objects[worker] = ObjectCache(cachebytes)
+                continue
+            if kind == b'heartbeat':
+                continue
+            if kind != b'result':
+                print('Unrecognized message from worker', parts[2], ':', kind)
+                continue
 
-        if result == nowork:
-            debug('Empty result')
-            continue
-        else:
-            debug('Non-empty result')
+            (meta, result) = parts[3:5]
+            (brick,iblob,cpu,wall,overhead) = pickle.loads(meta)
+            k = (brick, iblob)
+            sock.send_multipart([worker, b'ack', pickle.dumps(k, -1)])
+            if worker_sent[worker] > 0 and not worker in dead_workers:
+                # earned credit
+                worker_sent[worker] -= 1
+                ready.append(worker)
+            # Only pass on the first result for each packet
+            if k in outstanding_work:
+                del outstanding_work[k]
+                brick_outstanding[brick] -= 1
+            elif k in redeliver:
+                del redeliver[k]
+            else:
+                debug('Dropping duplicate or cancelled result for', k)
+                continue
             resultsreceived += 1
-        # Parse metadata of the result.
-        (brick,iblob,cpu,wall,overhead) = pickle.loads(meta)
-        cputimes[(brick, iblob)] = (worker, cpu, wall, overhead)
-        t4 = time.time()
-        outqueue.put((brick, iblob, result))
-        t5 = time.time()
-
-        t_in += (t1a - t1)
-        t_poll += (t1b - t1a)
-        t_recv += (t2 - t1b)
-        t_send += (t3 - t2)
-        t_decode += (t4 - t3)
-        t_out += (t5 - t4)
+            cputimes[k] = (worker, cpu, wall, overhead)
+            t4 = time.time()
+            outqueue.put((brick, iblob, result))
+            t5 = time.time()
+            t_decode += (t4 - t3)
+            t_out += (t5 - t4)
+
+    sock.close(linger=0)
+    if command_sock is not None:
+        command_sock.close(linger=0)
+    if own_ctx:
+        ctx.term()
 
 def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
-                  finished_bricks, opt):
+                  finished_bricks, brick_slots, opt):
     try:
         import setproctitle
         setproctitle.setproctitle('farm: output')
@@ -560,14 +672,32 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
     # Local mapping of brickname -> [set of cancelled blob ids]
     brick_cancelled = {}
 
+    # brickname -> CheckpointWriter, appending newly-computed results.
+    # (Results read from an existing checkpoint by the input thread are
+    # already in the file.)
+    brick_checkpoints = {}
+
+    def get_checkpoint_writer(brick):
+        from legacypipe.checkpoint import CheckpointWriter
+        if not brick in brick_checkpoints:
+            checkpoint_fn = opt.checkpoint % dict(brick=brick, brickpre=brick[:3])
+            brick_checkpoints[brick] = CheckpointWriter(checkpoint_fn, sync_period=None)
+        return brick_checkpoints[brick]
+
+    def read_blobsizes():
+        new = []
+        try:
+            while True:
+                br, nb, tid = blobsizes.get(block=False)
+                brick_info[br] = (nb,tid)
+                new.append(br)
+        except queue.Empty:
+            pass
+        return new
+
     def get_brick_nblobs(brick, defnblobs=None):
         if not brick in brick_info:
-            try:
-                while True:
-                    br, nb, tid = blobsizes.get(block=False)
-                    brick_info[br] = (nb,tid)
-            except queue.Empty:
-                pass
+            read_blobsizes()
         return brick_info.get(brick, (defnblobs,None))
 
     def check_brick_done(brick):
@@ -578,36 +708,31 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
         if len(allresults[brick]) + ncancelled < nblobs:
             return
         # Done this brick!  Set qdo state=Succeeded
-        checkpoint_fn = opt.checkpoint % dict(brick=brick)
-        R = [dict(brickname=brick, iblob=iblob, result=res) for
-             iblob,res in allresults[brick].items()]
-        print('Writing final checkpoint', checkpoint_fn)
-        _write_checkpoint(R, checkpoint_fn)
+        ckpt = brick_checkpoints.pop(brick, None)
+        if ckpt is not None:
+            print('Closing final checkpoint', ckpt.fn)
+            ckpt.close()
         print('Setting QDO task to Succeeded:', brick)
         q.set_task_state(taskid, qdo.Task.SUCCEEDED)
+        nr = len(allresults[brick])
         del allresults[brick]
-        finished_bricks.put((brick, len(R)))
+        finished_bricks.put((brick, nr))
+        brick_slots.release()
 
     last_checkpoint = time.time()
-    last_checkpoint_size = {}
 
     while True:
         tnow = time.time()
         dt = tnow - last_checkpoint
         if dt > opt.checkpoint_period:
-            for brick,brickresults in allresults.items():
-                if brick in last_checkpoint_size:
-                    if len(brickresults) == last_checkpoint_size[brick]:
-                        #print('Brick', brick, 'has not changed since last checkpoint was written')
-                        continue
-                checkpoint_fn = opt.checkpoint % dict(brick=brick)
-                R = [dict(brickname=brick, iblob=iblob, result=res) for
-                     iblob,res in brickresults.items()]
-                last_checkpoint_size[brick] = len(brickresults)
+            for brick,ckpt in brick_checkpoints.items():
+                if ckpt.nunsynced == 0:
+                    #print('Brick', brick, 'has not changed since last checkpoint was written')
+                    continue
                 nblobs,_ = get_brick_nblobs(brick, '(unknown)')
-                print('Writing interim checkpoint', checkpoint_fn, ':', len(brickresults), 'of',
-                      nblobs, 'results')
-                _write_checkpoint(R, checkpoint_fn)
+                print('Syncing interim checkpoint', ckpt.fn, ':', ckpt.nunsynced, 'new;',
+                      len(allresults.get(brick, [])), 'of', nblobs, 'results')
+                ckpt.sync()
             last_checkpoint = tnow
 
         # Read any checkpointed results sent by the input thread
@@ -627,6 +752,11 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
             nblobs,_ = get_brick_nblobs(brick, '(unknown)')
             #print('Brick', brick, ': now', len(allresults[brick]), 'of', nblobs, 'done')
             check_brick_done(brick)
+        # A brick whose results all came from its checkpoint can be
+        # done as soon as its number of blobs arrives.
+        for brick in read_blobsizes():
+            if brick in allresults:
+                check_brick_done(brick)
 
         try:
             brick,iblob,msg = outqueue.get(timeout=60)
@@ -652,6 +782,8 @@ def output_thread(queuename, outqueue, checkpointqueue, blobsizes,
             if not brick in allresults:
                 allresults[brick] = {}
             allresults[brick][iblob] = result
+            get_checkpoint_writer(brick).append(dict(brickname=brick, iblob=iblob,
+                                                     result=result))
 
         check_brick_done(brick)
 
@@ -677,7 +809,16 @@ def get_blob_iter(skipblobs=None,
                   refstars=None,
                   T_clusters=None,
                   custom_brick=False,
+                  blob_cost_model=None,
+                  blob_costs=None,
+                  tail_aware=False,
+                  tail_workers=None,
                   **kwargs):
+    '''
+    If *blob_cost_model* is given, blobs are ordered by predicted CPU
+    time, and the predicted time of each blob is stored in the
+    *blob_costs* dict (if given), as (cost, is_straggler).
+    '''
     if skipblobs is None:
         skipblobs = []
 
@@ -687,6 +828,18 @@ def get_blob_iter(skipblobs=None,
     frozen_galaxies = get_frozen_galaxies(T, blobsrcs, blobs, targetwcs, cat)
     refmap = get_blobiter_ref_map(refstars, T_clusters, less_masking, targetwcs)
 
+    blob_order = None
+    if blob_cost_model is not None:
+        from legacypipe.runbrick import _blob_cost_order
+        blob_order,cost,stragglers = _blob_cost_order(
+            blob_cost_model, blobslices, blobsrcs, blobs, targetwcs, tims, cat,
+            frozen_galaxies, nworkers=tail_workers, tail_aware=True)
+        if not tail_aware:
+            stragglers = set()
+        if blob_costs is not None:
+            for iblob in blob_order:
+                blob_costs[iblob] = (cost[iblob], iblob in stragglers)
+
     # Create the iterator over blobs to process
     blobiter = _blob_iter(brickname, blobslices, blobsrcs, blobs,
                           targetwcs, tims,
@@ -698,9 +851,66 @@ def get_blob_iter(skipblobs=None,
                           brick,
                           frozen_galaxies,
                           max_blobsize=max_blobsize, custom_brick=custom_brick,
-                          skipblobs=skipblobs)
+                          skipblobs=skipblobs, blob_order=blob_order)
     return blobiter
 
+class BrickSchedule(object):
+    '''
+    Work packets waiting to be sent, with a priority queue per brick.
+
+    Within a brick, packets go out in priority order (lowest first).
+    Across bricks, the *policy* is:
+    - "fair": the brick with the fewest packets outstanding at workers
+      (ties going to the brick that arrived first), so that a brick
+      waiting on a few long blobs does not hold up the others;
+    - "deadline": the brick that arrived first, so that bricks finish
+      in order.
+    '''
+    def __init__(self, policy='fair'):
+        assert(policy in ['fair', 'deadline'])
+        self.policy = policy
+        # brick -> heap of (priority, seq, iblob, work)
+        self.pending = {}
+        # brick -> arrival order
+        self.arrival = {}
+        self.seq = 0
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def nbricks(self):
+        return len(self.pending)
+
+    def add(self, brick, iblob, priority, work):
+        import heapq
+        if not brick in self.pending:
+            self.pending[brick] = []
+            self.arrival.setdefault(brick, self.seq)
+        self.seq += 1
+        heapq.heappush(self.pending[brick], (priority, self.seq, iblob, work))
+        self.n += 1
+
+    def pop(self, outstanding):
+        '''
+        Returns the next (brick, iblob, work) to send, or None; *outstanding*
+        is the number of packets outstanding per brick.
+        '''
+        import heapq
+        if self.n == 0:
+            return None
+        if self.policy == 'fair':
+            brick = min(self.pending.keys(),
+                        key=lambda b: (outstanding.get(b, 0), self.arrival[b]))
+        else:
+            brick = min(self.pending.keys(), key=lambda b: self.arrival[b])
+        h = self.pending[brick]
+        _,_,iblob,work = heapq.heappop(h)
+        if len(h) == 0:
+            del self.pending[brick]
+        self.n -= 1
+        return brick, iblob, work
+
 class PrioritizedItem(object):
     def __init__(self, priority=0, item=None):
         self.priority = priority
@@ -751,12 +961,11 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
     # Check for and read existing checkpoint file.
     checkpoint_fn = opt.checkpoint % dict(brick=brickname, brickpre=brickname[:3])
     if os.path.exists(checkpoint_fn):
+        from legacypipe.checkpoint import read_checkpoint
         debug('Reading checkpoint file', checkpoint_fn)
-        R = unpickle_from_file(checkpoint_fn)
-        print('Read', len(R), 'from checkpoint file')
-
+        # Results are streamed to the output thread as they are read.
         skipblobs = []
-        for r in R:
+        for r in read_checkpoint(checkpoint_fn):
             br = r['brickname']
             assert(br == brickname)
             iblob = r['iblob']
@@ -764,16 +973,29 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
             checkpointqueue.put((brickname, iblob, result))
             skipblobs.append(iblob)
             nchk += 1
+        print('Read', nchk, 'from checkpoint file')
         kwargs.update(skipblobs=skipblobs)
 
     # (brickname is in the kwargs read from the pickle!)
     assert(kwargs['brickname'] == brickname)
-    blobiter = get_blob_iter(**kwargs)
+    blob_costs = {}
+    blobiter = get_blob_iter(blob_cost_model=opt.blob_cost_model, blob_costs=blob_costs,
+                             tail_aware=opt.tail_aware, tail_workers=opt.tail_workers,
+                             **kwargs)
 
     big_npix = opt.big_pix
     if opt.big == 'keep':
         big_npix = 10000 * 10000
 
+    # Per-tim objects shared by the blobs; sent to each worker once.
+    from legacypipe.workpacket import PacketEncoder
+    encoder = PacketEncoder()
+    encoder.share(kwargs['targetwcs'])
+    for tim in kwargs['tims']:
+        encoder.share(tim.getPhotoCal())
+        encoder.share(tim.imobj)
+    npacketbytes = 0
+
     nq = 0
     for arg in blobiter:
         if arg is None:
@@ -788,6 +1010,10 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
         blobw = args[6]
         blobh = args[7]
         priority = -(blobw*blobh)
+        straggler = False
+        if iblob in blob_costs:
+            cost,straggler = blob_costs[iblob]
+            priority = -cost
 
         if opt.big == 'drop' and blobw*blobh > big_npix:
             print('Dropping a blob of size', blobw, 'x', blobh)
@@ -798,10 +1024,14 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
         if opt.big == 'queue' and blobw*blobh > big_npix:
             print('Blob of size', blobw, 'x', blobh, 'goes on big queue')
             dest_queue = bigqueue
+        elif opt.big == 'queue' and straggler:
+            print('Blob', iblob, 'with predicted CPU time %.0f sec goes on big queue' % -priority)
+            dest_queue = bigqueue
 
-        picl = pickle.dumps(arg, -1)
+        packet = encoder.encode(arg)
+        npacketbytes += len(packet[0])
 
-        qitem = PrioritizedItem(priority=priority, item=(br, iblob, picl))
+        qitem = PrioritizedItem(priority=priority, item=(br, iblob, packet))
 
         #debug('Queuing blob', (nq+1), 'for brick', brickname, '- queue size ~', inqueue.qsize())
         #mypid = os.getpid()
@@ -809,10 +1039,13 @@ def queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt):
         nq += 1
         dest_queue.put(qitem)
 
+    print('Queued', nq, 'blobs for brick', brickname, ': %.1f MB of packets,' % (npacketbytes/1e6),
+          '%.1f MB of shared objects' % (sum([len(b) for b in encoder.objects.values()])/1e6))
     # Finished queuing all blobs for this brick -- record how many blobs we sent out.
     return nchk + nq
 
-def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, opt, input_num):
+def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, brick_slots,
+                 opt, input_num):
 
     try:
         import setproctitle
@@ -825,15 +1058,24 @@ def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, opt,
     q = qdo.connect(queuename)
 
     while True:
+        # Wait until fewer than --bricks-in-flight bricks are running.
+        brick_slots.acquire()
         task = q.get(timeout=10)
         if task is None:
             #- no more tasks in queue so break
+            brick_slots.release()
             break
         try:
             brickname = task.task
             debug('Brick', brickname)
             # WORK
             nblobs = queue_work(brickname, inqueue, bigqueue, checkpointqueue, opt)
+            if nblobs == 0:
+                # Nothing for the output thread to wait for: done now.
+                print('Brick', brickname, 'has no blobs; setting QDO task to Succeeded')
+                task.set_state(qdo.Task.SUCCEEDED)
+                brick_slots.release()
+                continue
             blobsizes.put((brickname, nblobs, task.id))
             #
             debug('Finished', brickname, 'with', nblobs, 'blobs')
@@ -842,6 +1084,7 @@ def input_thread(queuename, inqueue, bigqueue, checkpointqueue, blobsizes, opt,
             import traceback
             traceback.print_exc()
             task.set_state(qdo.Task.FAILED, err=1)
+            brick_slots.release()
 
 if __name__ == '__main__':
     #mp.set_start_method('spawn')
@@ -194,11 +194,19 @@ def main(survey=None, opt=None, args=None):
         if not all_hdus:
             assert(len(T) == 1)
 
+    # For several CCDs of one exposure, read each overlapping brick's
+    # catalog and outlier-mask file once, rather than once per CCD.
+    inputs = [(None, None)] * len(T)
+    if len(T) > 1 and len(set(T.expnum)) == 1:
+        inputs = read_exposure_inputs(T, survey, catsurvey_north, catsurvey_south,
+                                      opt.catalog_resolve_dec_ngc,
+                                      read_catalogs=(opt.catalog is None))
+
     args = []
-    for ccd in T:
+    for ccd,(brick_catalogs,outlier_masks) in zip(T, inputs):
         args.append((survey,
                      catsurvey_north, catsurvey_south, opt.catalog_resolve_dec_ngc,
-                     ccd, opt, zoomslice, ps))
+                     ccd, opt, zoomslice, ps, brick_catalogs, outlier_masks))
 
     if opt.threads:
         from astrometry.util.multiproc import multiproc
@@ -272,61 +280,154 @@ def bounce_one_ccd(X):
     # for multiprocessing
     return run_one_ccd(*X)
 
-def get_catalog_in_wcs(chipwcs, catsurvey_north, catsurvey_south=None, resolve_dec=None,
-                       margin=20):
-    TT = []
+def _catalog_surveys(catsurvey_north, catsurvey_south):
     surveys = [(catsurvey_north, True)]
     if catsurvey_south is not None:
         surveys.append((catsurvey_south, False))
+    return surveys
 
-    for catsurvey,north in surveys:
-        bricks = bricks_touching_wcs(chipwcs, survey=catsurvey)
+def _bricks_touching(chipwcs, catsurvey, resolve_dec, margin=20):
+    bricks = bricks_touching_wcs(chipwcs, survey=catsurvey, margin=margin)
+    if resolve_dec is not None:
+        from astrometry.util.starutil_numpy import radectolb
+        bricks.gal_l, bricks.gal_b = radectolb(bricks.ra, bricks.dec)
+    return bricks
+
+def read_brick_catalog(catsurvey, b, north, resolve_dec):
+    '''
+    Reads the columns of the tractor catalog for brick *b* needed for
+    forced photometry, keeping brick_primary, non-DUP sources on the
+    right side of the resolve line (if *resolve_dec*).  Returns None if
+    the brick is on the wrong side of the resolve line or its catalog
+    does not exist.
+    '''
+    # Skip bricks that are entirely on the wrong side of the resolve line (NGC only)
+    if resolve_dec is not None:
+        # Northern survey, brick too far south (max dec is below the resolve line)
+        if north and b.dec2 <= resolve_dec:
+            return None
+        # Southern survey, brick too far north (min dec is above the resolve line), but only in the North Galactic Cap
+        if not(north) and b.dec1 >= resolve_dec and b.gal_b > 0:
+            return None
+    # there is some overlap with this brick... read the catalog.
+    fn = catsurvey.find_file('tractor', brick=b.brickname)
+    if not os.path.exists(fn):
+        print('WARNING: catalog', fn, 'does not exist.  Skipping!')
+        return None
+    print('Reading', fn)
+    T = fits_table(fn, columns=[
+        'ra', 'dec', 'brick_primary', 'type', 'release',
+        'brickid', 'brickname', 'objid', 'flux_r',
+        'sersic', 'shape_r', 'shape_e1', 'shape_e2',
+        'ref_epoch', 'pmra', 'pmdec', 'parallax'
+        ])
+    if resolve_dec is not None:
+        if north:
+            T.cut(T.dec >= resolve_dec)
+            print('Cut to', len(T), 'north of the resolve line')
+        elif b.gal_b > 0:
+            # Northern galactic cap only: cut Southern survey
+            T.cut(T.dec <  resolve_dec)
+            print('Cut to', len(T), 'south of the resolve line')
+    T.cut(T.brick_primary)
+    print('Cut to', len(T), 'on brick_primary')
+    # drop DUP sources
+    I, = np.nonzero([t.strip() != 'DUP' for t in T.type])
+    T.cut(I)
+    print('Cut to', len(T), 'after removing DUP')
+    return T
 
-        if resolve_dec is not None:
-            from astrometry.util.starutil_numpy import radectolb
-            bricks.gal_l, bricks.gal_b = radectolb(bricks.ra, bricks.dec)
+def _sources_in_wcs(T, chipwcs, margin):
+    # Returns a copy of catalog *T* cut to sources inside *chipwcs* + *margin*
+    _,xx,yy = chipwcs.radec2pixelxy(T.ra, T.dec)
+    W,H = chipwcs.get_width(), chipwcs.get_height()
+    I, = np.nonzero((xx >= -margin) * (xx <= (W+margin)) *
+                    (yy >= -margin) * (yy <= (H+margin)))
+    hdr = getattr(T, '_header', None)
+    T = T[I]
+    T._header = hdr
+    return T
+
+def read_exposure_inputs(ccds, survey, catsurvey_north, catsurvey_south, resolve_dec,
+                         read_catalogs=True, margin=200):
+    '''
+    For forced photometry of several CCDs of one exposure: reads the
+    tractor catalog (if *read_catalogs*) and outlier-mask file of each
+    brick touching any of the *ccds* once.
+
+    Returns a list, one per CCD, of (brick_catalogs, outlier_masks) to
+    pass to run_one_ccd.  These are selected using the approximate CCD
+    WCSes from the CCDs table, with a generous *margin* (in pixels);
+    run_one_ccd makes the final selection with the image's own WCS.
+    '''
+    from legacypipe.outliers import read_exposure_outlier_masks
+    wcses = [survey.get_approx_wcs(ccd) for ccd in ccds]
+
+    brick_catalogs = [None] * len(ccds)
+    if read_catalogs:
+        brick_catalogs = [{} for ccd in ccds]
+        for catsurvey,north in _catalog_surveys(catsurvey_north, catsurvey_south):
+            ccdbricks = [_bricks_touching(wcs, catsurvey, resolve_dec, margin=margin)
+                         for wcs in wcses]
+            cats = {}
+            for bricks,cat,wcs in zip(ccdbricks, brick_catalogs, wcses):
+                for b in bricks:
+                    if not b.brickname in cats:
+                        cats[b.brickname] = read_brick_catalog(catsurvey, b, north,
+                                                               resolve_dec)
+                    T = cats[b.brickname]
+                    if T is not None:
+                        T = _sources_in_wcs(T, wcs, margin)
+                    cat[(north, b.brickname)] = T
+            del cats
+        print('Read catalogs for', len(set(sum([list(c.keys()) for c in brick_catalogs], []))),
+              'bricks for', len(ccds), 'CCDs')
+
+    outlier_masks = []
+    masks = {}
+    for ccd,wcs in zip(ccds, wcses):
+        catsurvey = _outlier_mask_survey(ccd, catsurvey_north, catsurvey_south)
+        om = {}
+        for b in bricks_touching_wcs(wcs, survey=catsurvey, margin=margin):
+            key = (id(catsurvey), b.brickname)
+            if not key in masks:
+                fn = catsurvey.find_file('outliers_mask', brick=b.brickname, output=False)
+                masks[key] = read_exposure_outlier_masks(fn, ccd.camera.strip(), ccd.expnum)
+            m = masks[key]
+            # None: no file; False: no mask for this CCD
+            om[b.brickname] = None if m is None else m.get(ccd.ccdname.strip(), False)
+        outlier_masks.append(om)
+    del masks
+    return list(zip(brick_catalogs, outlier_masks))
+
+def _outlier_mask_survey(ccd, catsurvey_north, catsurvey_south):
+    # Outliers masks are computed within a survey (north/south for dr8), and are stored
+    # in a brick-oriented way, in the results directories.
+    north_ccd = (ccd.camera.strip() != 'decam')
+    catsurvey = catsurvey_north
+    if not north_ccd and catsurvey_south is not None:
+        catsurvey = catsurvey_south
+    return catsurvey
 
+def get_catalog_in_wcs(chipwcs, catsurvey_north, catsurvey_south=None, resolve_dec=None,
+                       margin=20, brick_catalogs=None):
+    '''
+    *brick_catalogs*: optional dict, (north, brickname) -> catalog from
+    read_exposure_inputs; bricks not in it are read from disk.
+    '''
+    TT = []
+    for catsurvey,north in _catalog_surveys(catsurvey_north, catsurvey_south):
+        bricks = _bricks_touching(chipwcs, catsurvey, resolve_dec)
         for b in bricks:
-            # Skip bricks that are entirely on the wrong side of the resolve line (NGC only)
-            if resolve_dec is not None:
-                # Northern survey, brick too far south (max dec is below the resolve line)
-                if north and b.dec2 <= resolve_dec:
-                    continue
-                # Southern survey, brick too far north (min dec is above the resolve line), but only in the North Galactic Cap
-                if not(north) and b.dec1 >= resolve_dec and b.gal_b > 0:
-                     continue
-            # there is some overlap with this brick... read the catalog.
-            fn = catsurvey.find_file('tractor', brick=b.brickname)
-            if not os.path.exists(fn):
-                print('WARNING: catalog', fn, 'does not exist.  Skipping!')
+            key = (north, b.brickname)
+            if brick_catalogs is not None and key in brick_catalogs:
+                T = brick_catalogs[key]
+            else:
+                T = read_brick_catalog(catsurvey, b, north, resolve_dec)
+            if T is None:
                 continue
-            print('Reading', fn)
-            T = fits_table(fn, columns=[
-                'ra', 'dec', 'brick_primary', 'type', 'release',
-                'brickid', 'brickname', 'objid', 'flux_r',
-                'sersic', 'shape_r', 'shape_e1', 'shape_e2',
-                'ref_epoch', 'pmra', 'pmdec', 'parallax'
-                ])
-            if resolve_dec is not None:
-                if north:
-                    T.cut(T.dec >= resolve_dec)
-                    print('Cut to', len(T), 'north of the resolve line')
-                elif b.gal_b > 0:
-                    # Northern galactic cap only: cut Southern survey
-                    T.cut(T.dec <  resolve_dec)
-                    print('Cut to', len(T), 'south of the resolve line')
-            _,xx,yy = chipwcs.radec2pixelxy(T.ra, T.dec)
-            W,H = chipwcs.get_width(), chipwcs.get_height()
-            I, = np.nonzero((xx >= -margin) * (xx <= (W+margin)) *
-                            (yy >= -margin) * (yy <= (H+margin)))
-            T.cut(I)
+            T = _sources_in_wcs(T, chipwcs, margin)
             print('Cut to', len(T), 'sources within image + margin')
-            T.cut(T.brick_primary)
-            print('Cut to', len(T), 'on brick_primary')
-            # drop DUP sources
-            I, = np.nonzero([t.strip() != 'DUP' for t in T.type])
-            T.cut(I)
-            print('Cut to', len(T), 'after removing DUP')
             if len(T):
                 TT.append(T)
     if len(TT) == 0:
@@ -338,7 +439,11 @@ def get_catalog_in_wcs(chipwcs, catsurvey_north, catsurvey_south=None, resolve_d
     return T
 
 def run_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
-                ccd, opt, zoomslice, ps):
+                ccd, opt, zoomslice, ps, brick_catalogs=None, outlier_masks=None):
+    '''
+    *brick_catalogs*, *outlier_masks*: optional, pre-read inputs from
+    read_exposure_inputs.
+    '''
     tlast = Time()
 
     print('Opt:', opt)
@@ -361,16 +466,21 @@ def run_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
 
     # Apply outlier masks
     if True:
-        # Outliers masks are computed within a survey (north/south for dr8), and are stored
-        # in a brick-oriented way, in the results directories.
-        north_ccd = (ccd.camera.strip() != 'decam')
-        catsurvey = catsurvey_north
-        if not north_ccd and catsurvey_south is not None:
-            catsurvey = catsurvey_south
+        catsurvey = _outlier_mask_survey(ccd, catsurvey_north, catsurvey_south)
         chipwcs = tim.subwcs
         bricks = bricks_touching_wcs(chipwcs, survey=catsurvey)
         for b in bricks:
-            from legacypipe.outliers import read_outlier_mask_file
+            from legacypipe.outliers import (read_outlier_mask_file,
+                                             apply_outlier_mask, unpack_outlier_mask)
+            if outlier_masks is not None and b.brickname in outlier_masks:
+                m = outlier_masks[b.brickname]
+                if m is None or m is False:
+                    # (no file, or no mask for this CCD)
+                    print('WARNING: failed to read outliers mask file for brick', b.brickname)
+                else:
+                    masked,x0,y0 = unpack_outlier_mask(m)
+                    apply_outlier_mask(tim, masked, x0, y0)
+                continue
             print('Reading outlier mask for brick', b.brickname)
             ok = read_outlier_mask_file(catsurvey, [tim], b.brickname, subimage=False, output=False,
                                         ps=ps)
@@ -382,7 +492,7 @@ def run_one_ccd(survey, catsurvey_north, catsurvey_south, resolve_dec,
     else:
         chipwcs = tim.subwcs
         T = get_catalog_in_wcs(chipwcs, catsurvey_north, catsurvey_south=catsurvey_south,
-                               resolve_dec=resolve_dec)
+                               resolve_dec=resolve_dec, brick_catalogs=brick_catalogs)
         if T is None:
             print('No sources to photometer.')
             return None
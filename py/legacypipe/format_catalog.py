@@ -340,10 +340,10 @@ def format_all_models(T, newcat, BB, bands, allbands, force_keep=None):
               'ra','dec',
               'cpu_arch', 'cpu_source', 'cpu_blob', 'ninblob',
               'blob_width', 'blob_height', 'blob_npix', 'blob_nimages',
-              'blob_totalpix',
+              'blob_totalpix', 'blob_nlarge', 'blob_nfrozen',
               'blob_symm_width', 'blob_symm_height',
               'blob_symm_npix', 'blob_symm_nimages',
-              'hit_limit', 'hit_r_limit', 'hit_ser_limit',
+              'hit_limit', 'hit_r_limit', 'hit_ser_limit', 'hit_budget',
               'fit_background', 'forced_pointsource']:
         TT.set(k, T.get(k))
     TT.type = np.array([fits_typemap[type(src)] for src in newcat])
@@ -9,9 +9,11 @@ class GaiaCatalog(HealpixedCatalog):
         fnpattern = os.path.join(self.gaiadir, 'chunk-%(hp)05d.fits')
         super(GaiaCatalog, self).__init__(fnpattern)
 
-    def get_catalog_radec_box(self, ralo, rahi, declo, dechi):
+    def get_catalog_radec_box(self, ralo, rahi, declo, dechi, columns=None):
         import numpy as np
 
+        if columns is not None:
+            columns = list(columns) + [c for c in ['ra','dec'] if not c in columns]
         wrap = False
         if rahi < ralo:
             # wrap-around?
@@ -19,19 +21,33 @@ class GaiaCatalog(HealpixedCatalog):
             wrap = True
 
         # Prepare RA,Dec grid to pick up overlapping healpixes
-        rr,dd = np.meshgrid(np.linspace(ralo,  rahi,  2+int(( rahi- ralo)/0.1)),
-                            np.linspace(declo, dechi, 2+int((dechi-declo)/0.1)))
-        healpixes = set()
-        for r,d in zip(rr.ravel(), dd.ravel()):
-            healpixes.add(self.healpix_for_radec(r, d))
+        spacing = self.healpix_side() / 8.
+        # (cos(Dec) at the box edges nearest to and farthest from the equator)
+        mindec = 0. if declo <= 0 <= dechi else min(abs(declo), abs(dechi))
+        cosmax = np.cos(np.deg2rad(mindec))
+        cosmin = max(np.cos(np.deg2rad(max(abs(declo), abs(dechi)))), 1e-3)
+        rr,dd = np.meshgrid(
+            np.linspace(ralo,  rahi, 2+int(( rahi- ralo)*cosmax/spacing)),
+            np.linspace(declo, dechi, 2+int((dechi-declo)/spacing)))
+        def near(r, d):
+            m = 2. * spacing
+            if d < declo - m or d > dechi + m:
+                return False
+            if max(abs(declo), abs(dechi)) + m >= 90.:
+                return True
+            dr = (r - ralo) % 360.
+            return dr <= (rahi - ralo) + m/cosmin or dr >= 360. - m/cosmin
+        healpixes = self.healpixes_touching(rr.ravel() % 360., dd.ravel(), near)
+
+        def inbox(T):
+            ok = (T.dec >= declo) * (T.dec <= dechi)
+            if wrap:
+                ok *= np.logical_or(T.ra >= ralo, T.ra <= (rahi - 360.))
+            else:
+                ok *= (T.ra  >= ralo ) * (T.ra  <= rahi)
+            return np.flatnonzero(ok)
         # Read catalog in those healpixes
-        cat = self.get_healpix_catalogs(healpixes)
-        cat.cut((cat.dec >= declo) * (cat.dec <= dechi))
-        if wrap:
-            cat.cut(np.logical_or(cat.ra <= ralo, cat.ra >= (rahi - 360.)))
-        else:
-            cat.cut((cat.ra  >= ralo ) * (cat.ra  <= rahi))
-        return cat
+        return self.get_healpix_catalogs(healpixes, columns=columns, cut=inbox)
 
     @staticmethod
     def catalog_nantozero(gaia):
@@ -14,6 +14,8 @@ from astrometry.util.util import Tan
 from astrometry.util.fits import fits_table
 from tractor.psf import PixelizedPSF
 
+from legacypipe.tilecache import read_cutout, read_header, read_table
+
 import logging
 logger = logging.getLogger('legacypipe.galex')
 def info(*args):
@@ -493,7 +495,7 @@ def galex_tiles_touching_wcs(targetwcs, galex_dir):
     fn = os.path.join(galex_dir, 'galex-images.fits')
     #print('Reading', fn)
     # galex "bricks" (actually just GALEX tiles)
-    galex_tiles = fits_table(fn)
+    galex_tiles = read_table(fn)
     galex_tiles.rename('ra_cent', 'ra')
     galex_tiles.rename('dec_cent', 'dec')
     galex_tiles.rename('have_n', 'has_n')
@@ -553,11 +555,9 @@ def galex_tractor_image(tile, band, galex_dir, radecbox, bandname):
     debug('Reading GALEX subimage x0,y0', x0,y0, 'size', x1-x0, y1-y0)
     gwcs = gwcs.get_subimage(x0, y0, x1 - x0, y1 - y0)
     twcs = ConstantFitsWcs(gwcs)
-    roislice = (slice(y0, y1), slice(x0, x1))
-    
-    fitsimg = fitsio.FITS(imfn)[0]
-    hdr = fitsimg.read_header()
-    img = fitsimg[roislice]
+
+    hdr = read_header(imfn)
+    img = read_cutout(imfn, 0, y0, y1, x0, x1)
 
     inverr = np.ones_like(img)
     inverr[img == 0.] = 0.
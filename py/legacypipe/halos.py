@@ -28,13 +28,51 @@ def subtract_one_real(X):
     if tim.imobj.camera != 'decam':
         print('Warning: Stellar halo subtraction is only implemented for DECam')
         return 0.
+    # The tim's PSF model carries the inner Moffat parameters, if any;
+    # no need to read the PsfEx file again.
+    psf = tim.psf if hasattr(tim.psf, 'moffat') else None
     return decam_halo_model(refs, tim.time.toMjd(), tim.subwcs,
-                            tim.imobj.pixscale, tim.band, tim.imobj, moffat)
+                            tim.imobj.pixscale, tim.band, tim.imobj, moffat,
+                            psf=psf)
 
 def moffat(rr, alpha, beta):
     return (beta-1.)/(np.pi * alpha**2)*(1. + (rr/alpha)**2)**(-beta)
 
-def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat):
+def decam_halo_profile(band, ccdname):
+    '''
+    Returns the parameters of the outer halo profile for a DECam CCD in
+    *band*: ('moffat', (alpha, beta, weight)) for z band, or
+    ('power', f) for g and r.
+    '''
+    if band == 'z':
+        '''
+        For z band, the outer PSF is a weighted Moffat profile. For most
+        CCDs, the Moffat parameters (with radius in arcsec and SB in nmgy per
+        sq arcsec) and the weight are (for a 22.5 magnitude star):
+            alpha, beta, weight = 17.650, 1.7, 0.0145
+
+        However, a small subset of DECam CCDs (which are N20, S8,
+        S10, S18, S21 and S27) have a more compact outer PSF in z
+        band, which can still be characterized by a weigthed
+        Moffat with the following parameters:
+            alpha, beta, weight = 16, 2.3, 0.0095
+        '''
+        if ccdname.strip() in ['N20', 'S8', 'S10', 'S18', 'S21', 'S27']:
+            return 'moffat', (16, 2.3, 0.0095)
+        return 'moffat', (17.650, 1.7, 0.0145)
+    fd = dict(g=0.00045,
+              r=0.00033)
+    return 'power', fd[band]
+
+def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat,
+                     psf=None):
+    '''
+    Renders the halos of stars *refs* (in nanomaggies) into an image
+    with *wcs*.  Each star is rendered only within the bounding box of
+    its halo radius.  The inner Moffat parameters come from *psf* (a
+    PSF model with a "moffat" attribute) if given, else from
+    *imobj*'s PsfEx model.
+    '''
     from legacypipe.survey import radec_at_mjd
     assert(np.all(refs.ref_epoch > 0))
     rr,dd = radec_at_mjd(refs.ra, refs.dec, refs.ref_epoch.astype(float),
@@ -44,23 +82,37 @@ def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat):
 
     have_inner_moffat = False
     if include_moffat:
-        psf = imobj.read_psf_model(0,0, pixPsf=True)
+        if psf is None:
+            psf = imobj.read_psf_model(0,0, pixPsf=True)
         if hasattr(psf, 'moffat'):
             have_inner_moffat = True
             inner_alpha, inner_beta = psf.moffat
             debug('Read inner Moffat parameters', (inner_alpha, inner_beta),
                   'from PsfEx file')
 
+    kind,params = decam_halo_profile(band, imobj.ccdname)
+
     H,W = wcs.shape
     H = int(H)
     W = int(W)
     halo = np.zeros((H,W), np.float32)
-    for ref,flux,ra,dec in zip(refs, fluxes, rr, dd):
-        _,x,y = wcs.radec2pixelxy(ra, dec)
-        x -= 1.
-        y -= 1.
-
-        rad_arcsec = ref.radius * 3600.
+    if len(refs) == 0:
+        return halo
+    _,xx,yy = wcs.radec2pixelxy(rr, dd)
+    xx = np.atleast_1d(xx) - 1.
+    yy = np.atleast_1d(yy) - 1.
+    radius = refs.radius
+
+    # Inner apodization: ramp from 0 up to 1 between Rongpu's "R3"
+    # and "R4" radii
+    apr_i0 = 7. / pixscale
+    apr_i1 = 8. / pixscale
+
+    for i in range(len(refs)):
+        x = xx[i]
+        y = yy[i]
+        flux = fluxes[i]
+        rad_arcsec = radius[i] * 3600.
         # We subtract halos out to N x their masking radii.
         rad_arcsec *= 4.0
         # Rongpu says only apply within:
@@ -73,6 +125,7 @@ def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat):
         yhi = int(np.clip(np.ceil (y + pixrad), 0, H-1))
         if xlo == xhi or ylo == yhi:
             continue
+        slc = (slice(ylo, yhi+1), slice(xlo, xhi+1))
 
         rads = np.hypot(np.arange(ylo, yhi+1)[:,np.newaxis] - y,
                         np.arange(xlo, xhi+1)[np.newaxis,:] - x)
@@ -80,50 +133,25 @@ def decam_halo_model(refs, mjd, wcs, pixscale, band, imobj, include_moffat):
         # Outer apodization
         apr = maxr*0.5
         apodize = np.clip((rads - maxr) / (apr - maxr), 0., 1.)
-
-        # Inner apodization: ramp from 0 up to 1 between Rongpu's "R3"
-        # and "R4" radii
-        apr_i0 = 7. / pixscale
-        apr_i1 = 8. / pixscale
         apodize *= np.clip((rads - apr_i0) / (apr_i1 - apr_i0), 0., 1.)
+        rarcsec = rads*pixscale
 
-        if band == 'z':
-            '''
-            For z band, the outer PSF is a weighted Moffat profile. For most
-            CCDs, the Moffat parameters (with radius in arcsec and SB in nmgy per
-            sq arcsec) and the weight are (for a 22.5 magnitude star):
-                alpha, beta, weight = 17.650, 1.7, 0.0145
-
-            However, a small subset of DECam CCDs (which are N20, S8,
-            S10, S18, S21 and S27) have a more compact outer PSF in z
-            band, which can still be characterized by a weigthed
-            Moffat with the following parameters:
-                alpha, beta, weight = 16, 2.3, 0.0095
-            '''
-            if imobj.ccdname.strip() in ['N20', 'S8', 'S10', 'S18', 'S21', 'S27']:
-                alpha, beta, weight = 16, 2.3, 0.0095
-            else:
-                alpha, beta, weight = 17.650, 1.7, 0.0145
-
+        if kind == 'moffat':
+            alpha, beta, weight = params
             if x < 0 or y < 0 or x > W-1 or y > H-1:
                 # Reduce the weight by half for z-band halos that are off the chip.
                 weight *= 0.5
-
             # The 'pixscale**2' is because Rongpu's formula is in nanomaggies/arcsec^2
-            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * weight *
-                                           moffat(rads*pixscale, alpha, beta) * pixscale**2)
-
+            halo[slc] += (flux * apodize * weight *
+                          moffat(rarcsec, alpha, beta) * pixscale**2)
         else:
-             fd = dict(g=0.00045,
-                       r=0.00033)
-             f = fd[band]
-
-             halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * f * (rads*pixscale)**-2
-                                            * pixscale**2)
+            f = params
+            halo[slc] += (flux * apodize * f * rarcsec**-2
+                          * pixscale**2)
 
         if have_inner_moffat:
             weight = 1.
-            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * weight *
-                                           moffat(rads*pixscale, inner_alpha, inner_beta) * pixscale**2)
+            halo[slc] += (flux * apodize * weight *
+                          moffat(rarcsec, inner_alpha, inner_beta) * pixscale**2)
 
     return halo
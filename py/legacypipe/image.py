@@ -890,6 +890,30 @@ class LegacySurveyImage(object):
         wcs.plver = phdr.get('PLVER', '').strip()
         return wcs
 
+    def read_merged_calib_row(self, fn, old_calibs_ok=False):
+        '''
+        Returns the row for this CCD in merged calibration file *fn*
+        (read through merged_calib_cache), or None if there is not
+        exactly one such row, or False if the file fails the PLVER,
+        PLPROCID, EXPNUM consistency validation.
+        '''
+        T,index,validated = merged_calib_cache.get(fn, self.camera, self.expnum,
+                                                   self.plver)
+        I = index.get((self.expnum, self.ccdname), [])
+        debug('Found', len(I), 'matching CCDs in merged calib file', fn)
+        if len(I) != 1:
+            return None
+        vkey = (self.expnum, self.plver, self.plprocid, old_calibs_ok)
+        if not vkey in validated:
+            validated[vkey] = validate_version(
+                fn, 'table', self.expnum, self.plver, self.plprocid,
+                data=T, old_calibs_ok=old_calibs_ok)
+        if not validated[vkey]:
+            return False
+        # (index with an array, so the row's arrays are copies, not
+        # views of the cached table)
+        return T[np.array(I)][0]
+
     def read_sky_model(self, slc=None, old_calibs_ok=False,
                        template_meta=None, **kwargs):
         '''
@@ -903,18 +927,12 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
-            debug('Found', len(I), 'matching CCDs in merged sky file')
-            if len(I) != 1:
+            row = self.read_merged_calib_row(fn, old_calibs_ok=old_calibs_ok)
+            if row is None:
                 continue
-            if not validate_version(
-                    fn, 'table', self.expnum, self.plver, self.plprocid,
-                    data=T, old_calibs_ok=old_calibs_ok):
+            if row is False:
                 raise RuntimeError('Sky file %s did not pass consistency validation (PLVER, PLPROCID, EXPNUM)' % fn)
-            Ti = T[I[0]]
+            Ti = row
         if Ti is None:
             raise RuntimeError('Failed to find sky model in files: %s' % ', '.join(tryfns))
 
@@ -983,18 +1001,12 @@ class LegacySurveyImage(object):
         for fn in tryfns:
             if not os.path.exists(fn):
                 continue
-            T = fits_table(fn)
-            I, = np.nonzero((T.expnum == self.expnum) *
-                            np.array([c.strip() == self.ccdname
-                                      for c in T.ccdname]))
-            debug('Found', len(I), 'matching CCDs')
-            if len(I) != 1:
+            row = self.read_merged_calib_row(fn, old_calibs_ok=old_calibs_ok)
+            if row is None:
                 continue
-            if not validate_version(
-                    fn, 'table', self.expnum, self.plver, self.plprocid,
-                    data=T, old_calibs_ok=old_calibs_ok):
+            if row is False:
                 raise RuntimeError('Merged PSFEx file %s did not pass consistency validation (PLVER, PLPROCID, EXPNUM)' % fn)
-            Ti = T[I[0]]
+            Ti = row
             break
         if Ti is None:
             raise RuntimeError('Failed to find PsfEx model in files: %s' % ', '.join(tryfns))
@@ -1150,7 +1162,14 @@ class LegacySurveyImage(object):
 
     def run_sky(self, splinesky=True, git_version=None, ps=None, survey=None,
                 gaia=True, release=0, survey_blob_mask=None,
-                halos=True, subtract_largegalaxies=True):
+                halos=True, subtract_largegalaxies=True,
+                sky_masks=None, fine_sky=True):
+        '''
+        sky_masks: legacypipe.skymasks.ExposureSkyMasks, the reference
+        sources shared by this exposure's CCDs.
+        fine_sky: also fit a sky on a 2x finer grid, for the "sky_fine"
+        diagnostic (otherwise 0).
+        '''
         from scipy.ndimage.morphology import binary_dilation
         from astrometry.util.file import trymakedirs
         from astrometry.util.miscutils import estimate_mode
@@ -1296,11 +1315,14 @@ class LegacySurveyImage(object):
             x0,x1 = sx.start, sx.stop
             wcs = wcs.get_subimage(x0, y0, int(x1-x0), int(y1-y0))
         # Grab reference sources
-        refs,_ = get_reference_sources(survey, wcs, self.pixscale, None,
-                                       tycho_stars=True, gaia_stars=gaia,
-                                       large_galaxies=True,
-                                       star_clusters=True,
-                                       clean_columns=False)
+        if sky_masks is not None:
+            refs = sky_masks.get_refs(wcs)
+        else:
+            refs,_ = get_reference_sources(survey, wcs, self.pixscale, None,
+                                           tycho_stars=True, gaia_stars=gaia,
+                                           large_galaxies=True,
+                                           star_clusters=True,
+                                           clean_columns=False)
         refgood = (get_reference_map(wcs, refs) == 0)
 
         sub_sga_version = '  '
@@ -1388,26 +1410,8 @@ class LegacySurveyImage(object):
         if survey_blob_mask is not None:
             # Read DR8 blob maps for all overlapping bricks and project them
             # into this CCD's pixel space.
-            from legacypipe.survey import bricks_touching_wcs, wcs_for_brick
-            from astrometry.util.resample import resample_with_wcs, OverlapError
-
-            bricks = bricks_touching_wcs(wcs, survey=survey_blob_mask)
-            H,W = wcs.shape
-            allblobs = np.zeros((int(H),int(W)), bool)
-            for brick in bricks:
-                fn = survey_blob_mask.find_file('blobmap',brick=brick.brickname)
-                if not os.path.exists(fn):
-                    print('Warning: blob map for brick', brick.brickname,
-                          'does not exist:', fn)
-                    continue
-                blobs = fitsio.read(fn)
-                blobs = (blobs >= 0)
-                brickwcs = wcs_for_brick(brick)
-                try:
-                    Yo,Xo,Yi,Xi,_ = resample_with_wcs(wcs, brickwcs)
-                except OverlapError:
-                    continue
-                allblobs[Yo,Xo] |= blobs[Yi,Xi]
+            from legacypipe.skymasks import get_blob_mask
+            allblobs = get_blob_mask(wcs, survey_blob_mask)
             ng = np.sum(good)
             if plots:
                 blobgood = np.logical_not(allblobs)
@@ -1439,12 +1443,14 @@ class LegacySurveyImage(object):
         fmasked = float(np.sum((good * refgood) == 0)) / (H*W)
 
         # DEBUG -- compute a splinesky on a finer grid and compare it.
-        fineskyobj = SplineSky.BlantonMethod(img - initsky, good * refgood,
-                                             boxsize//2,
-                                             min_fraction=0.25)
-        fineskyobj.offset(initsky)
-        fineskyobj.addTo(skypix, -1.)
-        fine_rms = np.sqrt(np.mean(skypix**2))
+        fine_rms = 0.
+        if fine_sky or plots:
+            fineskyobj = SplineSky.BlantonMethod(img - initsky, good * refgood,
+                                                 boxsize//2,
+                                                 min_fraction=0.25)
+            fineskyobj.offset(initsky)
+            fineskyobj.addTo(skypix, -1.)
+            fine_rms = np.sqrt(np.mean(skypix**2))
 
         if plots:
             import pylab as plt
@@ -1631,7 +1637,8 @@ class LegacySurveyImage(object):
                    splinesky=True, ps=None, survey=None,
                    gaia=True, old_calibs_ok=False,
                    survey_blob_mask=None, halos=True,
-                   subtract_largegalaxies=True):
+                   subtract_largegalaxies=True,
+                   sky_masks=None, fine_sky=True):
         '''
         Run calibration pre-processing steps.
         '''
@@ -1670,7 +1677,8 @@ class LegacySurveyImage(object):
         if psfex:
             self.run_psfex(git_version=git_version, ps=ps)
         if sky:
-            self.run_sky(splinesky=splinesky, git_version=git_version, ps=ps, survey=survey, gaia=gaia, survey_blob_mask=survey_blob_mask, halos=halos, subtract_largegalaxies=subtract_largegalaxies)
+            self.run_sky(splinesky=splinesky, git_version=git_version, ps=ps, survey=survey, gaia=gaia, survey_blob_mask=survey_blob_mask, halos=halos, subtract_largegalaxies=subtract_largegalaxies,
+                         sky_masks=sky_masks, fine_sky=fine_sky)
 
 def psfex_single_to_merged(infn, expnum, ccdname):
     # returns table T
@@ -1792,6 +1800,58 @@ def fix_weight_quantization(wt, weightfn, ext, slc):
     wt[wt <= zscale[:,np.newaxis]*0.5] = 0.
     return True
 
+class MergedCalibCache(object):
+    '''
+    A bounded, per-process cache of merged (per-exposure) calibration
+    tables -- PsfEx and splinesky -- so that the table for an exposure
+    is read once rather than once per CCD.
+
+    Entries are keyed by (camera, expnum, plver, filename), hold the
+    table with an index of its rows by (expnum, ccdname), and are
+    re-read if the file's modification time changes.
+
+    The cache is a module global (merged_calib_cache), so it is not
+    pickled along with LegacySurveyData or image objects; each
+    multiprocessing worker fills its own.
+    '''
+    def __init__(self, maxsize=16):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, fn, camera, expnum, plver):
+        '''
+        Returns (T, index, validated) for merged calibration file *fn*:
+        the table, a dict from (expnum, ccdname) to row numbers, and a
+        dict for memoizing validate_version results.
+        '''
+        key = (camera, expnum, plver, fn)
+        mtime = os.stat(fn).st_mtime_ns
+        e = self.entries.get(key, None)
+        if e is not None and e[0] == mtime:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return e[1:]
+        self.misses += 1
+        T = fits_table(fn)
+        index = {}
+        for i,(x,c) in enumerate(zip(T.expnum, T.ccdname)):
+            index.setdefault((x, c.strip()), []).append(i)
+        self.entries[key] = (mtime, T, index, {})
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        debug('Read merged calib file', fn, ': cache hits', self.hits,
+              'misses', self.misses)
+        return self.entries[key][1:]
+
+merged_calib_cache = MergedCalibCache()
+
 def validate_version(fn, filetype, expnum, plver, plprocid,
                      data=None, ext=1, cpheader=False,
                      old_calibs_ok=False, quiet=False):
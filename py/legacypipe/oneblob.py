@@ -12,6 +12,7 @@ from tractor import Tractor, PointSource, Image, Catalog, Patch
 from tractor.galaxy import (DevGalaxy, ExpGalaxy,
                             disable_galaxy_cache, enable_galaxy_cache)
 from tractor.patch import ModelMask
+from tractor.ellipses import EllipseE
 from tractor.sersic import SersicGalaxy
 
 from legacypipe.survey import (RexGalaxy,
@@ -33,6 +34,19 @@ def debug(*args):
 def is_debug():
     return logger.isEnabledFor(logging.DEBUG)
 
+def thread_time_available():
+    # time.thread_time is new in Python 3.7
+    return hasattr(time, 'thread_time')
+
+def thread_cpu_time():
+    '''
+    CPU time of the calling thread; before Python 3.7, of the whole
+    process (including any other threads).
+    '''
+    if thread_time_available():
+        return time.thread_time()
+    return time.process_time()
+
 # Determines the order of elements in the DCHISQ array.
 MODEL_NAMES = ['psf', 'rex', 'dev', 'exp', 'ser']
 
@@ -74,7 +88,13 @@ def one_blob(X):
         return None
     (nblob, iblob, Isrcs, brickwcs, bx0, by0, blobw, blobh, blobmask, timargs,
      srcs, bands, plots, ps, reoptimize, iterative, use_ceres, refmap,
-     large_galaxies_force_pointsource, less_masking, frozen_galaxies) = X
+     large_galaxies_force_pointsource, less_masking, frozen_galaxies) = X[:21]
+    # Optional settings: "threads" for fitting sources within this
+    # blob; "max_steps", "dchisq_snr", "cpu_budget" convergence limits (see
+    # OneBlob).
+    opts = {}
+    if len(X) > 21:
+        opts = X[21]
 
     debug('Fitting blob number %i: blobid %i, nsources %i, size %i x %i, %i images, %i frozen galaxies' %
           (nblob, iblob, len(Isrcs), blobw, blobh, len(timargs), len(frozen_galaxies)))
@@ -120,7 +140,10 @@ def one_blob(X):
     ob = OneBlob('%i'%(nblob+1), blobwcs, blobmask, timargs, srcs, bands,
                  plots, ps, use_ceres, refmap,
                  large_galaxies_force_pointsource,
-                 less_masking, frozen_galaxies)
+                 less_masking, frozen_galaxies, threads=opts.get('threads', 1),
+                 max_steps=opts.get('max_steps', None),
+                 dchisq_snr=opts.get('dchisq_snr', None),
+                 cpu_budget=opts.get('cpu_budget', None))
     B = ob.run(B, reoptimize=reoptimize, iterative_detection=iterative)
 
     _,x1,y1 = blobwcs.radec2pixelxy(
@@ -141,6 +164,10 @@ def one_blob(X):
     B.blob_npix   = np.zeros(len(B), np.int32) + np.sum(blobmask)
     B.blob_nimages= np.zeros(len(B), np.int16) + len(timargs)
     B.blob_totalpix = np.zeros(len(B), np.int32) + ob.total_pix
+    # (blob-cost model features; see legacypipe.blobcost)
+    from legacypipe.blobcost import count_large_galaxies
+    B.blob_nlarge  = np.zeros(len(B), np.int16) + count_large_galaxies(srcs)
+    B.blob_nfrozen = np.zeros(len(B), np.int16) + len(frozen_galaxies)
     B.cpu_arch = np.zeros(len(B), dtype='U3')
     B.cpu_arch[:] = get_cpu_arch()
     B.cpu_blob = np.empty(len(B), np.float32)
@@ -160,8 +187,37 @@ class OneBlob(object):
     def __init__(self, name, blobwcs, blobmask, timargs, srcs, bands,
                  plots, ps, use_ceres, refmap,
                  large_galaxies_force_pointsource,
-                 less_masking, frozen_galaxies):
+                 less_masking, frozen_galaxies, threads=1,
+                 max_steps=None, dchisq_snr=None,
+                 cpu_budget=None):
+        '''
+        Convergence limits for fitting each source:
+
+        *max_steps*: maximum number of optimizer steps.  (Fits that
+         have not converged after *max_steps* steps take one more, which
+         marks them as having hit the limit.)
+
+        *dchisq_snr*: stop optimizing when the chi-squared improvement
+         falls below this fraction of the source's (S/N)^2 (if that is
+         larger than the usual 0.1).
+
+        *cpu_budget*: CPU seconds for this blob; once exceeded, the
+         remaining sources keep their current model types and only
+         their fluxes are fit.  This is the CPU time of the whole
+         process, so it counts all the threads fitting this blob's
+         sources (see *threads*) -- the blob's total CPU time.
+
+        Sources that hit *max_steps* or *cpu_budget* are marked in the
+        "hit_budget" column.
+        '''
+        self.cpu_start = time.process_time()
         self.name = name
+        # Threads for fitting non-overlapping sources concurrently in
+        # model selection (big blobs only).
+        self.threads = threads
+        # Are sources being fit in threads right now?  (See
+        # _enable_galaxy_cache.)
+        self.in_threads = False
         self.blobwcs = blobwcs
         self.pixscale = self.blobwcs.pixel_scale()
         self.blobmask = blobmask
@@ -190,7 +246,13 @@ class OneBlob(object):
         if self.bigblob:
             debug('Big blob:', name)
         self.trargs = dict()
+        # Serial multiproc, shared by the detection-map computations
+        from astrometry.util.multiproc import multiproc
+        self.mp1 = multiproc()
         self.frozen_galaxy_mods = []
+        # Final model patches of fit sources, shared by the SourceModels
+        # objects below; see SourceModels.
+        self.model_cache = {}
 
         if len(frozen_galaxies):
             debug('Subtracting frozen galaxy models...')
@@ -237,6 +299,13 @@ class OneBlob(object):
         self.trargs.update(optimizer=ConstrainedDenseOptimizer())
         self.optargs.update(dchisq = 0.1)
 
+        self.max_steps = max_steps
+        if max_steps is not None:
+            # (see hit_max_steps)
+            self.optargs.update(steps=max_steps + 1)
+        self.dchisq_snr = dchisq_snr
+        self.cpu_budget = cpu_budget
+
     def run(self, B, reoptimize=False, iterative_detection=True,
             compute_metrics=True):
         trun = tlast = Time()
@@ -252,6 +321,7 @@ class OneBlob(object):
         B.hit_limit          = np.zeros(N, bool)
         B.hit_ser_limit      = np.zeros(N, bool)
         B.hit_r_limit        = np.zeros(N, bool)
+        B.hit_budget         = np.zeros(N, bool)
         B.blob_symm_width    = np.zeros(N, np.int16)
         B.blob_symm_height   = np.zeros(N, np.int16)
         B.blob_symm_npix     = np.zeros(N, np.int32)
@@ -306,9 +376,10 @@ class OneBlob(object):
         #  src.getModelPatch(tim)
         if len(cat) > 1:
             self._optimize_individual_sources_subtract(
-                cat, Ibright, B.cpu_source)
+                cat, Ibright, B.cpu_source, B.hit_budget)
         else:
-            self._optimize_individual_sources(tr, cat, Ibright, B.cpu_source)
+            self._optimize_individual_sources(tr, cat, Ibright, B.cpu_source,
+                                              B.hit_budget)
 
         if self.plots:
             self._plots(tr, 'After source fitting')
@@ -386,9 +457,10 @@ class OneBlob(object):
             Ibright = _argsort_by_brightness(cat, self.bands, ref_first=True)
             if len(cat) > 1:
                 self._optimize_individual_sources_subtract(
-                    cat, Ibright, B.cpu_source)
+                    cat, Ibright, B.cpu_source, B.hit_budget)
             else:
-                self._optimize_individual_sources(tr, cat, Ibright, B.cpu_source)
+                self._optimize_individual_sources(tr, cat, Ibright, B.cpu_source,
+                                                  B.hit_budget)
 
             if self.plots:
                 import pylab as plt
@@ -438,9 +510,12 @@ class OneBlob(object):
                 cat = Catalog(*B.sources)
                 tr.catalog = cat
 
-            M = _compute_source_metrics(B.sources, self.tims, self.bands, tr)
+            models = SourceModels(cache=self.model_cache)
+            M = _compute_source_metrics(B.sources, self.tims, self.bands, tr,
+                                        models=models)
             for k,v in M.items():
                 B.set(k, v)
+            del models
 
         info('Blob', self.name, 'finished, total:', Time()-trun)
         return B
@@ -448,13 +523,11 @@ class OneBlob(object):
     def compute_segmentation_map(self):
         from functools import reduce
         from legacypipe.detection import detection_maps
-        from astrometry.util.multiproc import multiproc
         from scipy.ndimage.morphology import binary_dilation
 
         # Compute per-band detection maps
-        mp = multiproc()
         detmaps,detivs,satmaps = detection_maps(
-            self.tims, self.blobwcs, self.bands, mp)
+            self.tims, self.blobwcs, self.bands, self.mp1)
 
         # same as in runbrick.py
         saturated_pix = reduce(np.logical_or,
@@ -602,7 +675,7 @@ class OneBlob(object):
         #   -subtract final model (from each tim)
         # -Replace original images
 
-        models = SourceModels()
+        models = SourceModels(cache=self.model_cache)
         # Remember original tim images
         models.save_images(self.tims)
 
@@ -618,58 +691,10 @@ class OneBlob(object):
         B.all_model_hit_r_limit   = np.array([{} for i in range(N)])
         B.all_model_opt_steps     = np.array([{} for i in range(N)])
 
-        # Model selection for sources, in decreasing order of brightness
-        for numi,srci in enumerate(Ibright):
-            src = cat[srci]
-            debug('Model selection for source %i of %i in blob %s; sourcei %i' %
-                  (numi+1, len(Ibright), self.name, srci))
-            cpu0 = time.process_time()
-
-            if src.freezeparams:
-                info('Frozen source', src, '-- keeping as-is!')
-                B.sources[srci] = src
-                continue
-
-            # Add this source's initial model back in.
-            models.add(srci, self.tims)
-
-            if self.plots_single:
-                import pylab as plt
-                plt.figure(2)
-                coimgs,_ = quick_coadds(self.tims, self.bands, self.blobwcs,
-                                        fill_holes=False)
-                rgb = get_rgb(coimgs,self.bands)
-                plt.imsave('blob-%s-%s-bdata.png' % (self.name, srci), rgb,
-                           origin='lower')
-                plt.figure(1)
-
-            # Model selection for this source.
-            keepsrc = self.model_selection_one_source(src, srci, models, B)
-
-            # Definitely keep ref stars (Gaia & Tycho)
-            if keepsrc is None and getattr(src, 'reference_star', False):
-                info('Dropped reference star:', src)
-                src.brightness = src.initial_brightness
-                info('Reset brightness to', src.brightness)
-                src.force_keep_source = True
-                keepsrc = src
-
-            B.sources[srci] = keepsrc
-            B.force_keep_source[srci] = getattr(keepsrc, 'force_keep_source', False)
-            cat[srci] = keepsrc
-
-            models.update_and_subtract(srci, keepsrc, self.tims)
-
-            if self.plots_single:
-                plt.figure(2)
-                coimgs,_ = quick_coadds(self.tims, self.bands, self.blobwcs,
-                                           fill_holes=False)
-                dimshow(get_rgb(coimgs,self.bands), ticks=False)
-                plt.savefig('blob-%s-%i-sub.png' % (self.name, srci))
-                plt.figure(1)
-
-            cpu1 = time.process_time()
-            B.cpu_source[srci] += (cpu1 - cpu0)
+        if self.threads > 1 and self.bigblob and not self.plots:
+            self._model_selection_parallel(cat, Ibright, B, models)
+        else:
+            self._model_selection_serial(cat, Ibright, B, models)
 
         # At this point, we have subtracted our best model fits for each source
         # to be kept; the tims contain residual images.
@@ -722,11 +747,118 @@ class OneBlob(object):
         del models
         return B
 
+    def _model_selection_serial(self, cat, Ibright, B, models):
+        # Model selection for sources, in decreasing order of brightness
+        for numi,srci in enumerate(Ibright):
+            src = cat[srci]
+            debug('Model selection for source %i of %i in blob %s; sourcei %i' %
+                  (numi+1, len(Ibright), self.name, srci))
+            cpu0 = time.process_time()
+
+            if src.freezeparams:
+                info('Frozen source', src, '-- keeping as-is!')
+                B.sources[srci] = src
+                continue
+
+            # Add this source's initial model back in.
+            models.add(srci, self.tims)
+
+            if self.plots_single:
+                import pylab as plt
+                plt.figure(2)
+                coimgs,_ = quick_coadds(self.tims, self.bands, self.blobwcs,
+                                        fill_holes=False)
+                rgb = get_rgb(coimgs,self.bands)
+                plt.imsave('blob-%s-%s-bdata.png' % (self.name, srci), rgb,
+                           origin='lower')
+                plt.figure(1)
+
+            # Model selection for this source.
+            keepsrc = self.model_selection_one_source(src, srci, models, B)
+
+            self._keep_selected_model(srci, src, keepsrc, cat, B, models)
+
+            if self.plots_single:
+                plt.figure(2)
+                coimgs,_ = quick_coadds(self.tims, self.bands, self.blobwcs,
+                                           fill_holes=False)
+                dimshow(get_rgb(coimgs,self.bands), ticks=False)
+                plt.savefig('blob-%s-%i-sub.png' % (self.name, srci))
+                plt.figure(1)
+
+            cpu1 = time.process_time()
+            B.cpu_source[srci] += (cpu1 - cpu0)
+
+    def _keep_selected_model(self, srci, src, keepsrc, cat, B, models):
+        # Definitely keep ref stars (Gaia & Tycho)
+        if keepsrc is None and getattr(src, 'reference_star', False):
+            info('Dropped reference star:', src)
+            src.brightness = src.initial_brightness
+            info('Reset brightness to', src.brightness)
+            src.force_keep_source = True
+            keepsrc = src
+
+        B.sources[srci] = keepsrc
+        B.force_keep_source[srci] = getattr(keepsrc, 'force_keep_source', False)
+        cat[srci] = keepsrc
+
+        models.update_and_subtract(srci, keepsrc, self.tims)
+
+    def _model_selection_parallel(self, cat, Ibright, B, models):
+        '''
+        Model selection with sources fit concurrently by *self.threads*
+        threads (big blobs only, where each source is fit on cut-outs
+        around its own model).
+
+        Sources are fit in "waves": a wave takes sources in brightness
+        order whose initial models do not overlap in any tim (with each
+        other, or with brighter sources left for a later wave).  All
+        sources in a wave see the images as left by the previous waves,
+        and their results are applied in brightness order once the wave
+        is done, so the results do not depend on thread scheduling.
+        tractor's (process-global) galaxy cache is off meanwhile.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        Ifit = []
+        for srci in Ibright:
+            src = cat[srci]
+            if src.freezeparams:
+                info('Frozen source', src, '-- keeping as-is!')
+                B.sources[srci] = src
+                continue
+            Ifit.append(srci)
+
+        waves = _non_overlapping_waves(models, Ifit)
+        debug('Blob', self.name, ': model selection for', len(Ifit), 'sources in',
+              len(waves), 'waves, with', self.threads, 'threads')
+
+        def fit_one(srci):
+            # (process_time would include the other threads)
+            cpu0 = thread_cpu_time()
+            keepsrc = self.model_selection_one_source(cat[srci], srci, models, B)
+            return keepsrc, thread_cpu_time() - cpu0
+
+        disable_galaxy_cache()
+        self.in_threads = True
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                for wave in waves:
+                    # Add these sources' initial models back in.
+                    for srci in wave:
+                        models.add(srci, self.tims)
+                    R = list(pool.map(fit_one, wave))
+                    for srci,(keepsrc,cpu) in zip(wave, R):
+                        cpu0 = thread_cpu_time()
+                        self._keep_selected_model(srci, cat[srci], keepsrc, cat, B, models)
+                        B.cpu_source[srci] += cpu + thread_cpu_time() - cpu0
+        finally:
+            self.in_threads = False
+
     def iterative_detection(self, Bold, models):
         # Compute per-band detection maps
         from scipy.ndimage.morphology import binary_dilation
         from legacypipe.detection import sed_matched_filters, detection_maps, run_sed_matched_filters
-        from astrometry.util.multiproc import multiproc
 
         if self.plots:
             coimgs,_ = quick_coadds(self.tims, self.bands, self.blobwcs,
@@ -737,9 +869,8 @@ class OneBlob(object):
             plt.title('Iterative detection: residuals')
             self.ps.savefig()
 
-        mp = multiproc()
         detmaps,detivs,satmaps = detection_maps(
-            self.tims, self.blobwcs, self.bands, mp)
+            self.tims, self.blobwcs, self.bands, self.mp1)
 
         # from runbrick.py
         satmaps = [binary_dilation(satmap > 0, iterations=4) for satmap in satmaps]
@@ -927,7 +1058,13 @@ class OneBlob(object):
 
         return Bnew
 
-    def model_selection_one_source(self, src, srci, models, B):
+    def _source_context(self, src, srci, models, B):
+        '''
+        Builds the SourceContext of *src* for model selection: its
+        images, model masks and symmetric sub-blob (masking out the
+        other sources), which are shared by all the candidate models.
+        Returns None if the source is to be dropped.
+        '''
 
         if self.bigblob:
             mods = [mod[srci] for mod in models.models]
@@ -989,13 +1126,11 @@ class OneBlob(object):
         mask_others = True
         if mask_others:
             from legacypipe.detection import detection_maps
-            from astrometry.util.multiproc import multiproc
             from scipy.ndimage.morphology import binary_dilation, binary_fill_holes
             from scipy.ndimage.measurements import label
             # Compute per-band detection maps
-            mp = multiproc()
             detmaps,detivs,_ = detection_maps(
-                srctims, srcwcs, self.bands, mp)
+                srctims, srcwcs, self.bands, self.mp1)
             # Compute the symmetric area that fits in this 'tim'
             pos = src.getPosition()
             _,xx,yy = srcwcs.radec2pixelxy(pos.ra, pos.dec)
@@ -1143,41 +1278,10 @@ class OneBlob(object):
             dilated = dilated[yl:yh+1, xl:xh+1]
             flipblobs = flipblobs[yl:yh+1, xl:xh+1]
 
-            saved_srctim_ies = []
-            keep_srctims = []
-            mm = []
-            totalpix = 0
-            for tim in srctims:
-                # Zero out inverse-errors for all pixels outside
-                # 'dilated'.
-                try:
-                    Yo,Xo,Yi,Xi,_ = resample_with_wcs(
-                        tim.subwcs, srcwcs, intType=np.int16)
-                except OverlapError:
-                    continue
-                ie = tim.getInvError()
-                newie = np.zeros_like(ie)
-
-                good, = np.nonzero(dilated[Yi,Xi] * (ie[Yo,Xo] > 0))
-                if len(good) == 0:
-                    debug('Tim has inverr all == 0')
-                    continue
-                yy = Yo[good]
-                xx = Xo[good]
-                newie[yy,xx] = ie[yy,xx]
-                xl,xh = xx.min(), xx.max()
-                yl,yh = yy.min(), yy.max()
-                totalpix += len(xx)
-
-                d = { src: ModelMask(xl, yl, 1+xh-xl, 1+yh-yl) }
-                mm.append(d)
-
-                saved_srctim_ies.append(ie)
-                tim.inverr = newie
-                keep_srctims.append(tim)
-
-            srctims = keep_srctims
-            modelMasks = mm
+            ctx = SourceContext(srctims, modelMasks, srcwcs, srcwcs_x0y0,
+                                srcblobmask)
+            totalpix = ctx.mask(src, dilated)
+            srctims = ctx.srctims
 
             B.blob_symm_nimages[srci] = len(srctims)
             B.blob_symm_npix[srci] = totalpix
@@ -1232,10 +1336,26 @@ class OneBlob(object):
             #     plt.title(tim.name)
             # plt.suptitle('Model Masks')
             # self.ps.savefig()
+        else:
+            ctx = SourceContext(srctims, modelMasks, srcwcs, srcwcs_x0y0,
+                                srcblobmask)
+        return ctx
+
+    def model_selection_one_source(self, src, srci, models, B):
+        # The images, masks and sub-blob are set up once and shared
+        # by all the models tried below.
+        ctx = self._source_context(src, srci, models, B)
+        if ctx is None:
+            return None
+        srctims = ctx.srctims
+        srcwcs = ctx.srcwcs
+        srcwcs_x0y0 = ctx.x0y0
+        srcblobmask = ctx.srcblobmask
 
         if self.bigblob and self.plots_per_source:
             # This is a local source-WCS plot of the data going into the
             # fit.
+            import pylab as plt
             plt.clf()
             coimgs,_ = quick_coadds(srctims, self.bands, srcwcs, fill_holes=False)
             dimshow(get_rgb(coimgs, self.bands))
@@ -1243,7 +1363,7 @@ class OneBlob(object):
             self.ps.savefig()
 
         srctractor = self.tractor(srctims, [src])
-        srctractor.setModelMasks(modelMasks)
+        srctractor.setModelMasks(ctx.modelMasks)
         srccat = srctractor.getCatalog()
 
         _,ix,iy = srcwcs.radec2pixelxy(src.getPosition().ra,
@@ -1254,9 +1374,7 @@ class OneBlob(object):
         sh,sw = srcwcs.shape
         if ix < 0 or iy < 0 or ix >= sw or iy >= sh or not srcblobmask[iy,ix]:
             debug('Source is starting outside blob -- skipping.')
-            if mask_others:
-                for ie,tim in zip(saved_srctim_ies, srctims):
-                    tim.inverr = ie
+            ctx.unmask()
             return None
 
         from tractor import Galaxy
@@ -1302,7 +1420,7 @@ class OneBlob(object):
             srctractor.thawParam('images')
             skyparams = srctractor.images.getParams()
 
-        enable_galaxy_cache()
+        self._enable_galaxy_cache()
 
         # Compute the log-likehood without a source here.
         srccat[0] = None
@@ -1357,6 +1475,14 @@ class OneBlob(object):
             trymodels.extend([('rex', rex), ('dev', dev), ('exp', exp),
                               ('ser', None)])
 
+        # Out of CPU time for this blob?  Then only re-fit the fluxes
+        # of the source's current model.
+        fluxes_only = self.over_budget()
+        if fluxes_only:
+            debug('Blob', self.name, 'is over its CPU budget; fitting fluxes only')
+            trymodels = [(oldmodel, dict(psf=psf, rex=rex, dev=dev, exp=exp)[oldmodel])]
+            B.hit_budget[srci] = True
+
         cputimes = {}
         for name,newsrc in trymodels:
             cpum0 = time.process_time()
@@ -1374,8 +1500,9 @@ class OneBlob(object):
 
             if name == 'ser' and newsrc is None:
                 # Start at the better of exp or dev.
-                smod = _select_model(chisqs, nparams, galaxy_margin)
-                if smod not in ['dev', 'exp']:
+                smod = _sersic_start(chisqs, nparams, galaxy_margin)
+                if smod is None:
+                    debug('Not fitting SER: DEV and EXP are not preferred')
                     continue
                 if smod == 'dev':
                     newsrc = ser = SersicGalaxy(
@@ -1406,9 +1533,9 @@ class OneBlob(object):
 
             # Use the same modelMask shapes as the original source ('src').
             # Need to create newsrc->mask mappings though:
-            mm = remap_modelmask(modelMasks, src, newsrc)
+            mm = remap_modelmask(ctx.modelMasks, src, newsrc)
             srctractor.setModelMasks(mm)
-            enable_galaxy_cache()
+            self._enable_galaxy_cache()
 
             if fit_background:
                 # Reset sky params
@@ -1416,7 +1543,7 @@ class OneBlob(object):
                 srctractor.thawParam('images')
 
             # First-round optimization (during model selection)
-            R = srctractor.optimize_loop(**self.optargs)
+            R = self._optimize_source(srctractor, newsrc, fluxes_only=fluxes_only)
             #print('Fit result:', newsrc)
             #print('Steps:', R['steps'])
             hit_limit = R.get('hit_limit', False)
@@ -1445,20 +1572,14 @@ class OneBlob(object):
                         hit_r_limit = True
                         debug('Hit radius limit')
 
-            _,ix,iy = srcwcs.radec2pixelxy(newsrc.getPosition().ra,
-                                           newsrc.getPosition().dec)
-            ix = int(ix-1)
-            iy = int(iy-1)
-            sh,sw = srcblobmask.shape
-            if ix < 0 or iy < 0 or ix >= sw or iy >= sh or not srcblobmask[iy,ix]:
-                # Exited blob!
+            if not ctx.in_blob(newsrc.getPosition()):
+                # Exited blob!  The remaining models are fit on the
+                # unmasked images.
                 debug('Source exited sub-blob!')
-                if mask_others:
-                    for ie,tim in zip(saved_srctim_ies, srctims):
-                        tim.inverr = ie
+                ctx.unmask()
                 continue
 
-            disable_galaxy_cache()
+            self._disable_galaxy_cache()
 
             if self.plots_per_source:
                 # save RGB images for the model
@@ -1494,7 +1615,10 @@ class OneBlob(object):
             fracin = dict([(b, []) for b in self.bands])
             fluxes = dict([(b, newsrc.getBrightness().getFlux(b))
                            for b in self.bands])
-            for tim,mod in zip(srctims, srctractor.getModelImages(sky=False)):
+            # (these model images are re-used for the chi-squared below,
+            # if the source parameters are not changed in between)
+            modimgs = list(srctractor.getModelImages(sky=False))
+            for tim,mod in zip(srctims, modimgs):
                 f = (mod * (tim.getInvError() > 0)).sum() / fluxes[tim.band]
                 fracin[tim.band].append(f)
             for band in self.bands:
@@ -1505,6 +1629,7 @@ class OneBlob(object):
                     debug('Source', newsrc, ': setting flux in band', band,
                           'to zero based on fracin = %.3g' % f)
                     newsrc.getBrightness().setFlux(band, 0.)
+                    modimgs = None
 
             # Compute inverse-variances
             # This uses the second-round modelMasks.
@@ -1522,6 +1647,7 @@ class OneBlob(object):
                     reset = True
             if reset:
                 newsrc.setParams(params)
+                modimgs = None
                 allderivs = srctractor.getDerivs()
                 ivars = _compute_invvars(allderivs)
                 assert(len(ivars) == nsrcparams)
@@ -1536,7 +1662,8 @@ class OneBlob(object):
 
             # Use the original 'srctractor' here so that the different
             # models are evaluated on the same pixels.
-            ch = _per_band_chisqs(srctractor, self.bands)
+            ch = _per_band_chisqs(srctractor, self.bands, mods=modimgs)
+            del modimgs
             chisqs[name] = _chisq_improvement(newsrc, ch, chisqs_none)
             cpum1 = time.process_time()
             B.all_model_cpu[srci][name] = cpum1 - cpum0
@@ -1547,10 +1674,8 @@ class OneBlob(object):
             if name == 'ser':
                 B.hit_ser_limit[srci] = hit_ser_limit
 
-        if mask_others:
-            for tim,ie in zip(srctims, saved_srctim_ies):
-                # revert tim to original (unmasked-by-others)
-                tim.inverr = ie
+        # revert tims to original (unmasked-by-others)
+        ctx.unmask()
 
         # After model selection, revert the sky
         # (srctims=tims when not bigblob)
@@ -1576,6 +1701,8 @@ class OneBlob(object):
 
         B.hit_limit    [srci] = B.all_model_hit_limit    [srci].get(keepmod, False)
         B.hit_r_limit  [srci] = B.all_model_hit_r_limit  [srci].get(keepmod, False)
+        if self.hit_max_steps(B.all_model_opt_steps[srci].get(keepmod, -1)):
+            B.hit_budget[srci] = True
         if keepmod != 'ser':
             B.hit_ser_limit[srci] = False
 
@@ -1623,12 +1750,56 @@ class OneBlob(object):
 
         return keepsrc
 
-    def _optimize_individual_sources(self, tr, cat, Ibright, cputime):
+    def _enable_galaxy_cache(self):
+        # tractor's galaxy cache is a process-global object, not safe
+        # to share between threads, so it stays off while sources are
+        # fit in threads.  (It only saves recomputing model patches;
+        # the fits are the same without it.)
+        if not self.in_threads:
+            enable_galaxy_cache()
+
+    def _disable_galaxy_cache(self):
+        if not self.in_threads:
+            disable_galaxy_cache()
+
+    def over_budget(self):
+        # (process time: all threads, as in the blob's cpu_blob)
+        return (self.cpu_budget is not None and
+                time.process_time() - self.cpu_start > self.cpu_budget)
+
+    def hit_max_steps(self, steps):
+        # optimize_loop reports the index of its last step.  It is
+        # allowed max_steps+1 steps, so a fit that converged within
+        # max_steps steps (even on the last one) reports at most
+        # max_steps-1.
+        return self.max_steps is not None and steps >= self.max_steps
+
+    def _optimize_source(self, tractor, src, fluxes_only=False):
+        '''
+        Runs *tractor*.optimize_loop for *src*, within the convergence
+        limits; if *fluxes_only*, the other parameters of *src* are
+        frozen.
+        '''
+        optargs = self.optargs
+        if self.dchisq_snr:
+            dchisq = self.dchisq_snr * _source_snr2(src, self.tims)
+            if dchisq > optargs['dchisq']:
+                optargs = optargs.copy()
+                optargs.update(dchisq=dchisq)
+        if fluxes_only:
+            src.freezeAllBut('brightness')
+        R = tractor.optimize_loop(**optargs)
+        if fluxes_only:
+            src.thawAllParams()
+        return R
+
+    def _optimize_individual_sources(self, tr, cat, Ibright, cputime,
+                                     hit_budget):
         # Single source (though this is coded to handle multiple sources)
         # Fit sources one at a time, but don't subtract other models
         cat.freezeAllParams()
 
-        models = SourceModels()
+        models = SourceModels(cache=self.model_cache)
         models.create(self.tims, cat)
         enable_galaxy_cache()
 
@@ -1641,7 +1812,11 @@ class OneBlob(object):
                 continue
             modelMasks = models.model_masks(0, cat[i])
             tr.setModelMasks(modelMasks)
-            tr.optimize_loop(**self.optargs)
+            fluxes_only = self.over_budget()
+            R = self._optimize_source(tr, src, fluxes_only=fluxes_only)
+            if fluxes_only or self.hit_max_steps(R.get('steps', -1)):
+                hit_budget[i] = True
+            self.model_cache.pop(src, None)
             cpu1 = time.process_time()
             cputime[i] += (cpu1 - cpu0)
 
@@ -1654,7 +1829,7 @@ class OneBlob(object):
         return tr
 
     def _optimize_individual_sources_subtract(self, cat, Ibright,
-                                              cputime):
+                                              cputime, hit_budget):
         # -Remember the original images
         # -Compute initial models for each source (in each tim)
         # -Subtract initial models from images
@@ -1664,7 +1839,7 @@ class OneBlob(object):
         #   -subtract final model (from each tim)
         # -Replace original images
 
-        models = SourceModels()
+        models = SourceModels(cache=self.model_cache)
         # Remember original tim images
         models.save_images(self.tims)
         # Create & subtract initial models for each tim x each source
@@ -1736,7 +1911,10 @@ class OneBlob(object):
 
             # First-round optimization
             #print('First-round initial log-prob:', srctractor.getLogProb())
-            srctractor.optimize_loop(**self.optargs)
+            fluxes_only = self.over_budget()
+            R = self._optimize_source(srctractor, src, fluxes_only=fluxes_only)
+            if fluxes_only or self.hit_max_steps(R.get('steps', -1)):
+                hit_budget[srci] = True
             #print('First-round final log-prob:', srctractor.getLogProb())
 
             if is_galaxy:
@@ -1856,13 +2034,19 @@ class OneBlob(object):
 
     def create_tims(self, timargs):
         from legacypipe.bits import DQ_BITS
+        from legacypipe.sharedtims import get_pixels
         # In order to make multiprocessing easier, the one_blob method
         # is passed all the ingredients to make local tractor Images
         # rather than the Images themselves.  Here we build the
-        # 'tims'.
+        # 'tims'.  The pixels may be references to shared memory
+        # (see sharedtims.py); the image is modified in place (models
+        # are subtracted), so it gets a private copy.
         tims = []
         for (img, inverr, dq, twcs, wcsobj, pcal, sky, subpsf, name,
              band, sig1, imobj) in timargs:
+            img = get_pixels(img, copy=True)
+            inverr = get_pixels(inverr)
+            dq = get_pixels(dq)
             # Mask out inverr for pixels that are not within the blob.
             try:
                 Yo,Xo,Yi,Xi,_ = resample_with_wcs(wcsobj, self.blobwcs,
@@ -1963,7 +2147,130 @@ def _argsort_by_brightness(cat, bands, ref_first=False):
 def is_reference_source(src):
     return getattr(src, 'is_reference_source', False)
 
-def _compute_source_metrics(srcs, tims, bands, tr):
+def _compute_source_metrics(srcs, tims, bands, tr, models=None):
+    '''
+    Computes the fracflux, fracin, fracmasked and rchisq metrics for
+    *srcs*.
+
+    *models*: SourceModels, used to get cached model patches; if None,
+    all source models are rendered.
+
+    For each tim, the source model patches are packed into flat arrays
+    (pixel index, value, patch number), and the per-source sums are
+    computed with np.bincount; this gives the same results as
+    _compute_source_metrics_loop (to float32 rounding).
+    '''
+    import warnings
+    shape = (len(srcs), len(bands))
+    rchi2_num      = np.zeros(shape, np.float32)
+    rchi2_den      = np.zeros(shape, np.float32)
+    fracflux_num   = np.zeros(shape, np.float32)
+    fracflux_den   = np.zeros(shape, np.float32)
+    fracin_num     = np.zeros(shape, np.float32)
+    fracin_den     = np.zeros(shape, np.float32)
+    fracmasked_num = np.zeros(shape, np.float32)
+    fracmasked_den = np.zeros(shape, np.float32)
+
+    for itim,tim in enumerate(tims):
+        if not tim.band in bands:
+            continue
+        iband = bands.index(tim.band)
+        H,W = tim.getModelShape()
+        mod = np.zeros((H,W), tr.modtype)
+        pcal = tim.getPhotoCal()
+
+        # Source index, counts, and flat pixels of each (non-empty) patch
+        isrcs = []
+        counts = []
+        pixels = []
+        values = []
+        for isrc,src in enumerate(srcs):
+            if models is not None:
+                patch = models.get_patch(itim, tim, src)
+            else:
+                patch = tr.getModelPatch(tim, src)
+            if patch is None or patch.patch is None:
+                continue
+            c = np.sum([np.abs(pcal.brightnessToCounts(b))
+                        for b in src.getBrightnesses()])
+            if c == 0:
+                continue
+            patch.clipTo(W,H)
+            if patch.patch is None:
+                continue
+            patch.addTo(mod)
+            isrcs.append(isrc)
+            counts.append(c)
+            ph,pw = patch.shape
+            if ph == 0 or pw == 0:
+                pixels.append(np.zeros(0, int))
+                values.append(np.zeros(0, np.float32))
+                continue
+            pixels.append((np.arange(patch.y0, patch.y0+ph)[:,np.newaxis] * W +
+                           np.arange(patch.x0, patch.x0+pw)[np.newaxis,:]).ravel())
+            values.append(patch.patch.ravel())
+        if len(isrcs) == 0:
+            continue
+        isrcs = np.array(isrcs)
+        counts = np.array(counts)
+        npatch = len(isrcs)
+        owner = np.repeat(np.arange(npatch), [len(p) for p in pixels])
+        pixels = np.hstack(pixels)
+        values = np.hstack(values)
+        absval = np.abs(values)
+        def patchsum(x):
+            return np.bincount(owner, weights=x, minlength=npatch)
+
+        psum  = patchsum(values)
+        psum2 = patchsum(values**2)
+        ie = tim.getInvError().ravel()[pixels]
+        # (mod - patch) is the flux from other sources; see
+        # _compute_source_metrics_loop for the definitions of the metrics.
+        modpix = mod.ravel()[pixels]
+        ok = (psum2 != 0)
+        I = isrcs[ok]
+        fin = np.abs(psum[ok] / counts[ok])
+        fracflux_num[I,iband] += (fin *
+                                  patchsum((modpix - values) * absval)[ok] / psum2[ok])
+        fracflux_den[I,iband] += fin
+        fracmasked_num[I,iband] += (patchsum((ie == 0) * absval)[ok] /
+                                    np.abs(counts[ok]))
+        fracmasked_den[I,iband] += fin
+        fracin_num[I,iband] += np.abs(psum[ok])
+        fracin_den[I,iband] += np.abs(counts[ok])
+
+        # chi-squared, only needed in the patch pixels
+        sky = np.zeros((H,W), tr.modtype)
+        tim.getSky().addTo(sky)
+        modpix += sky.ravel()[pixels]
+        chisq = ((tim.getImage().ravel()[pixels] - modpix) * ie)**2
+        rchi2_num[isrcs,iband] += patchsum(chisq * values) / counts
+        rchi2_den[isrcs,iband] += psum / counts
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        fracflux   = fracflux_num   / fracflux_den
+        rchi2      = rchi2_num      / rchi2_den
+        fracmasked = fracmasked_num / fracmasked_den
+
+    # Eliminate NaNs (these happen when, eg, we have no coverage in one band but
+    # sources detected in another band, hence denominator is zero)
+    fracflux  [  fracflux_den == 0] = 0.
+    rchi2     [     rchi2_den == 0] = 0.
+    fracmasked[fracmasked_den == 0] = 0.
+
+    # fracin_{num,den} are in flux * nimages units
+    tinyflux = 1e-9
+    fracin     = fracin_num     / np.maximum(tinyflux, fracin_den)
+
+    return dict(fracin=fracin, fracflux=fracflux, rchisq=rchi2,
+                fracmasked=fracmasked)
+
+def _compute_source_metrics_loop(srcs, tims, bands, tr, models=None):
+    '''
+    Straightforward (slow) version of _compute_source_metrics, kept as
+    the reference for its tests.
+    '''
     import warnings
     # rchi2 quality-of-fit metric
     rchi2_num    = np.zeros((len(srcs),len(bands)), np.float32)
@@ -1982,7 +2289,7 @@ def _compute_source_metrics(srcs, tims, bands, tr):
     fracmasked_den = np.zeros((len(srcs),len(bands)), np.float32)
 
     for iband,band in enumerate(bands):
-        for tim in tims:
+        for itim,tim in enumerate(tims):
             if tim.band != band:
                 continue
             mod = np.zeros(tim.getModelShape(), tr.modtype)
@@ -1993,7 +2300,10 @@ def _compute_source_metrics(srcs, tims, bands, tr):
             # For each source, compute its model and record its flux
             # in this image.  Also compute the full model *mod*.
             for isrc,src in enumerate(srcs):
-                patch = tr.getModelPatch(tim, src)
+                if models is not None:
+                    patch = models.get_patch(itim, tim, src)
+                else:
+                    patch = tr.getModelPatch(tim, src)
                 if patch is None or patch.patch is None:
                     continue
                 counts[isrc] = np.sum([np.abs(pcal.brightnessToCounts(b))
@@ -2125,6 +2435,56 @@ def _initialize_models(src):
         oldmodel = 'exp'
     return oldmodel, psf, rex, dev, exp
 
+def _non_overlapping_waves(models, I):
+    '''
+    Groups the sources *I* (in order) into waves of sources whose
+    models (in the SourceModels *models*) do not overlap in any tim;
+    a source only joins a wave if it does not overlap any earlier
+    source that has not yet been placed.
+    '''
+    I = list(I)
+    ntims = len(models.models)
+    N = max(I) + 1 if len(I) else 0
+    valid = np.zeros((ntims, N), bool)
+    x0 = np.zeros((ntims, N), int)
+    x1 = np.zeros((ntims, N), int)
+    y0 = np.zeros((ntims, N), int)
+    y1 = np.zeros((ntims, N), int)
+    for itim,mods in enumerate(models.models):
+        for i in I:
+            mod = mods[i]
+            if mod is None:
+                continue
+            mh,mw = mod.shape
+            if mh == 0 or mw == 0:
+                continue
+            valid[itim,i] = True
+            x0[itim,i] = mod.x0
+            y0[itim,i] = mod.y0
+            x1[itim,i] = mod.x0 + mw
+            y1[itim,i] = mod.y0 + mh
+
+    def overlaps(i, J):
+        if len(J) == 0:
+            return False
+        J = np.array(J)
+        return np.any(valid[:,i,np.newaxis] * valid[:,J] *
+                      (x0[:,i,np.newaxis] < x1[:,J]) * (x0[:,J] < x1[:,i,np.newaxis]) *
+                      (y0[:,i,np.newaxis] < y1[:,J]) * (y0[:,J] < y1[:,i,np.newaxis]))
+
+    waves = []
+    while len(I):
+        wave = []
+        rest = []
+        for i in I:
+            if overlaps(i, wave) or overlaps(i, rest):
+                rest.append(i)
+            else:
+                wave.append(i)
+        waves.append(wave)
+        I = rest
+    return waves
+
 def _get_subimages(tims, mods, src):
     subtims = []
     modelMasks = []
@@ -2179,13 +2539,132 @@ def _get_subtim(tim, x0, x1, y0, y1):
         subtim.dq = None
     return subtim
 
+def _model_signature(src):
+    # Model type and all parameters of a source, to check that a cached
+    # model patch is still current.  Galaxy shapes are compared as
+    # EllipseE, because _convert_ellipses changes their parameterization
+    # (not the model) between fitting and computing the blob metrics.
+    if not isinstance(src, (DevGalaxy, ExpGalaxy, SersicGalaxy)):
+        return (type(src),) + tuple(src.getAllParams())
+    shape = src.shape
+    if type(shape) is not EllipseE:
+        shape = shape.toEllipseE()
+    sig = ((type(src),) + tuple(src.getPosition().getAllParams()) +
+           tuple(src.getBrightness().getAllParams()) + tuple(shape.getAllParams()))
+    if isinstance(src, SersicGalaxy):
+        sig += tuple(src.sersicindex.getAllParams())
+    return sig
+
+class SourceContext(object):
+    '''
+    The images, model masks and sub-blob used to fit one source in
+    model selection, set up once and shared by all the models tried.
+
+    *mask* zeroes the images' inverse-errors outside the source's
+    symmetric sub-blob (keeping the originals); *unmask* reverts them.
+    '''
+    def __init__(self, srctims, modelMasks, srcwcs, x0y0, srcblobmask):
+        self.srctims = srctims
+        self.modelMasks = modelMasks
+        self.srcwcs = srcwcs
+        self.x0y0 = x0y0
+        self.srcblobmask = srcblobmask
+        self.saved_ies = []
+
+    def mask(self, src, dilated):
+        '''
+        Masks the images outside *dilated* (a boolean map in *srcwcs*),
+        dropping images with no pixels left, and sets model masks
+        bounding the remaining pixels.  Returns the number of pixels.
+        '''
+        keep_srctims = []
+        mm = []
+        totalpix = 0
+        for tim in self.srctims:
+            # Zero out inverse-errors for all pixels outside
+            # 'dilated'.
+            try:
+                Yo,Xo,Yi,Xi,_ = resample_with_wcs(
+                    tim.subwcs, self.srcwcs, intType=np.int16)
+            except OverlapError:
+                continue
+            ie = tim.getInvError()
+            newie = np.zeros_like(ie)
+
+            good, = np.nonzero(dilated[Yi,Xi] * (ie[Yo,Xo] > 0))
+            if len(good) == 0:
+                debug('Tim has inverr all == 0')
+                continue
+            yy = Yo[good]
+            xx = Xo[good]
+            newie[yy,xx] = ie[yy,xx]
+            xl,xh = xx.min(), xx.max()
+            yl,yh = yy.min(), yy.max()
+            totalpix += len(xx)
+
+            d = { src: ModelMask(xl, yl, 1+xh-xl, 1+yh-yl) }
+            mm.append(d)
+
+            self.saved_ies.append(ie)
+            tim.inverr = newie
+            keep_srctims.append(tim)
+
+        self.srctims = keep_srctims
+        self.modelMasks = mm
+        return totalpix
+
+    def unmask(self):
+        '''
+        Reverts the images to their original inverse-errors.  (This just
+        swaps references; no pixels are copied.)
+        '''
+        for tim,ie in zip(self.srctims, self.saved_ies):
+            tim.inverr = ie
+        self.saved_ies = []
+
+    def in_blob(self, pos):
+        '''
+        Is *pos* (RaDecPos) inside the sub-blob?
+        '''
+        _,ix,iy = self.srcwcs.radec2pixelxy(pos.ra, pos.dec)
+        ix = int(ix-1)
+        iy = int(iy-1)
+        sh,sw = self.srcblobmask.shape
+        return bool(ix >= 0 and iy >= 0 and ix < sw and iy < sh and
+                    self.srcblobmask[iy,ix])
+
 class SourceModels(object):
     '''
     This class maintains a list of the model patches for a set of sources
     in a set of images.
+
+    The final model patches of fit sources (from *update_and_subtract*)
+    are also kept in *cache*, a dict that can be shared between the
+    SourceModels used for one blob, so they can be re-used without
+    re-rendering (see *get_patch*).
     '''
-    def __init__(self):
+    def __init__(self, cache=None):
         self.filledModelMasks = True
+        # src -> (signature, [patch per tim])
+        if cache is None:
+            cache = {}
+        self.cache = cache
+
+    def get_patch(self, itim, tim, src):
+        '''
+        Returns the model patch for *src* in *tim* (number *itim*),
+        from the cache if the source has not changed since it was fit.
+        '''
+        c = self.cache.get(src, None)
+        if c is not None:
+            sig,patches = c
+            if sig == _model_signature(src):
+                p = patches[itim]
+                if p is None:
+                    return None
+                # (a new Patch object, so callers can clip it)
+                return Patch(p.x0, p.y0, p.patch)
+        return src.getModelPatch(tim)
 
     def save_images(self, tims):
         self.orig_images = [tim.getImage() for tim in tims]
@@ -2235,6 +2714,8 @@ class SourceModels(object):
                 mod.addTo(tim.getImage())
 
     def update_and_subtract(self, i, src, tims, tim_ies=None, ps=None):
+        if src is not None:
+            self.cache[src] = (_model_signature(src), [None] * len(tims))
         for itim,(tim,mods) in enumerate(zip(tims, self.models)):
             if src is None:
                 mods[i] = None
@@ -2246,6 +2727,7 @@ class SourceModels(object):
             mods[i] = mod
             if mod is None:
                 continue
+            self.cache[src][1][itim] = mod
 
             if tim_ies is not None:
                 # Apply an extra mask (ie, the mask_others segmentation mask)
@@ -2425,6 +2907,18 @@ def _select_model(chisqs, nparams, galaxy_margin):
     keepmod = 'ser'
     return keepmod
 
+def _sersic_start(chisqs, nparams, galaxy_margin):
+    '''
+    Returns the model ('dev' or 'exp') to start the SER fit from, or
+    None if SER cannot be selected: it is only considered by
+    *_select_model* as an upgrade from DEV or EXP, so it is not fit
+    unless one of them beats PSF and REX by the galaxy margin.
+    '''
+    smod = _select_model(chisqs, nparams, galaxy_margin)
+    if smod in ['dev', 'exp']:
+        return smod
+    return None
+
 def _chisq_improvement(src, chisqs, chisqs_none):
     '''
     chisqs, chisqs_none: dict of band->chisq
@@ -2445,9 +2939,28 @@ def _chisq_improvement(src, chisqs, chisqs_none):
             dchisq -= np.abs(d)
     return dchisq
 
-def _per_band_chisqs(tractor, bands):
+def _source_snr2(src, tims):
+    # Approximate point-source (S/N)^2 of *src* in *tims*
+    bright = src.getBrightness()
+    snr2 = 0.
+    for tim in tims:
+        psfnorm = 1. / (2. * np.sqrt(np.pi) * tim.psf_sigma)
+        snr2 += (bright.getFlux(tim.band) * psfnorm / tim.sig1)**2
+    return snr2
+
+def _per_band_chisqs(tractor, bands, mods=None):
+    '''
+    *mods*: optional list of (current, sky-free) model images for
+    tractor.images, to avoid re-rendering them.
+    '''
     chisqs = dict([(b,0) for b in bands])
-    for img in tractor.images:
-        chi = tractor.getChiImage(img=img)
+    for i,img in enumerate(tractor.images):
+        if mods is None:
+            chi = tractor.getChiImage(img=img)
+        else:
+            mod = mods[i]
+            img.getSky().addTo(mod)
+            chi = (img.getImage() - mod) * img.getInvError()
+            chi[np.logical_not(np.isfinite(chi))] = 0.
         chisqs[img.band] = chisqs[img.band] + (chi ** 2).sum()
     return chisqs
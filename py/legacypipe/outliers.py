@@ -58,18 +58,12 @@ def read_outlier_mask_file(survey, tims, brickname, subimage=True, output=True,
                 tim.dq |= ((mask & maskbits) > 0) * DQ_BITS['outlier']
                 tim.inverr[(mask & maskbits) > 0] = 0.
         else:
-            from astrometry.util.miscutils import get_overlapping_region
             mh,mw = mask.shape
             th,tw = tim.shape
-            my,ty = get_overlapping_region(tim.y0, tim.y0 + th - 1, y0, y0 + mh - 1)
-            mx,tx = get_overlapping_region(tim.x0, tim.x0 + tw - 1, x0, x0 + mw - 1)
-            # have to shift the "m" slices down by x0,y0
-            my = slice(my.start - y0, my.stop - y0)
-            mx = slice(mx.start - x0, mx.stop - x0)
+            my,mx,ty,tx = _outlier_mask_overlap(tim, x0, y0, mh, mw)
             if apply_masks:
                 # Apply this mask!
-                tim.dq[ty, tx] |= ((mask[my, mx] & maskbits) > 0) * DQ_BITS['outlier']
-                tim.inverr[ty, tx][(mask[my, mx] & maskbits) > 0] = 0.
+                apply_outlier_mask(tim, (mask & maskbits) > 0, x0, y0)
 
             if ps is not None:
                 import pylab as plt
@@ -94,6 +88,65 @@ def read_outlier_mask_file(survey, tims, brickname, subimage=True, output=True,
 
     return True
 
+def _outlier_mask_overlap(tim, x0, y0, mh, mw):
+    # Slices of an (mh,mw) full-CCD outlier mask at (x0,y0), and of *tim*,
+    # where they overlap.
+    from astrometry.util.miscutils import get_overlapping_region
+    th,tw = tim.shape
+    my,ty = get_overlapping_region(tim.y0, tim.y0 + th - 1, y0, y0 + mh - 1)
+    mx,tx = get_overlapping_region(tim.x0, tim.x0 + tw - 1, x0, x0 + mw - 1)
+    # have to shift the "m" slices down by x0,y0
+    my = slice(my.start - y0, my.stop - y0)
+    mx = slice(mx.start - x0, mx.stop - x0)
+    return my,mx,ty,tx
+
+def apply_outlier_mask(tim, masked, x0, y0):
+    '''
+    Applies boolean outlier mask *masked*, whose first pixel is at
+    (*x0*, *y0*) in full-CCD coordinates, to full-CCD tim *tim*.
+    '''
+    from legacypipe.bits import DQ_BITS
+    mh,mw = masked.shape
+    my,mx,ty,tx = _outlier_mask_overlap(tim, x0, y0, mh, mw)
+    tim.dq[ty, tx] |= masked[my, mx] * DQ_BITS['outlier']
+    tim.inverr[ty, tx][masked[my, mx]] = 0.
+
+def read_exposure_outlier_masks(fn, camera, expnum):
+    '''
+    Reads the outlier masks for all CCDs of one exposure from outlier-mask
+    file *fn* (for one brick), opening the file once.
+
+    Returns None if the file does not exist; otherwise a dict from
+    CCD name to (x0, y0, shape, flat indices of masked pixels), which
+    unpack_outlier_mask turns back into a boolean mask.
+    '''
+    if not os.path.exists(fn):
+        return None
+    maskbits = get_bits_to_mask()
+    prefix = '%s-%s-' % (camera, expnum)
+    masks = {}
+    F = fitsio.FITS(fn)
+    for hdu in F:
+        extname = hdu.get_extname()
+        if not extname.startswith(prefix):
+            continue
+        mask = hdu.read()
+        hdr = hdu.read_header()
+        masks[extname[len(prefix):]] = (hdr['X0'], hdr['Y0'], mask.shape,
+                                        np.flatnonzero((mask & maskbits) > 0))
+    F.close()
+    debug('Read', len(masks), 'outlier masks for exposure', camera, expnum, 'from', fn)
+    return masks
+
+def unpack_outlier_mask(m):
+    '''
+    Returns (masked, x0, y0) for an entry from read_exposure_outlier_masks.
+    '''
+    x0,y0,shape,I = m
+    masked = np.zeros(shape, bool)
+    masked.flat[I] = True
+    return masked, x0, y0
+
 def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_header,
                         mp=None, plots=False, ps=None, make_badcoadds=True,
                         refstars=None):
@@ -253,7 +306,7 @@ def mask_outlier_pixels(survey, tims, bands, targetwcs, brickname, version_heade
 def compare_one(X):
     from scipy.ndimage.filters import gaussian_filter
     from scipy.ndimage.morphology import binary_dilation
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    from legacypipe.survey import tim_get_resamp_map, tim_resample_lanczos
 
     (tim,sig,targetwcs, coimg,cow, veto, make_badcoadds, plots,ps) = X
 
@@ -263,17 +316,14 @@ def compare_one(X):
     H,W = targetwcs.shape
 
     img = gaussian_filter(tim.getImage(), sig)
-    try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
-    except OverlapError:
-        return None
+    R = tim_resample_lanczos(tim, targetwcs, [img])
     del img
+    if R is None:
+        return None
+    Yo,Xo,Yi,Xi,[rimg] = R
+    del R
     blurnorm = 1./(2. * np.sqrt(np.pi) * sig)
     wt = tim.getInvvar()[Yi,Xi] / np.float32(blurnorm**2)
-    if Xi.dtype != np.int16:
-        Yi = Yi.astype(np.int16)
-        Xi = Xi.astype(np.int16)
 
     # Compare against reference image...
     maskedpix = np.zeros(tim.shape, np.uint8)
@@ -406,11 +456,10 @@ def compare_one(X):
 
     # Actually do the masking!
     # Resample "hot" (in brick coords) back to tim coords.
-    try:
-        mYo,mXo,mYi,mXi,_ = resample_with_wcs(
-            tim.subwcs, targetwcs, intType=np.int16)
-    except OverlapError:
+    R = tim_get_resamp_map(tim, targetwcs, reverse=True)
+    if R is None:
         return None
+    mYo,mXo,mYi,mXi = R.indices()
     Ibad, = np.nonzero(hot[mYi,mXi])
     Ibad2, = np.nonzero(cold[mYi,mXi])
     info(tim, ': masking', len(Ibad), 'positive outlier pixels and', len(Ibad2), 'negative outlier pixels')
@@ -422,17 +471,17 @@ def compare_one(X):
 
 def blur_resample_one(X):
     from scipy.ndimage.filters import gaussian_filter
-    from astrometry.util.resample import resample_with_wcs,OverlapError
+    from legacypipe.survey import tim_resample_lanczos
 
     tim,sig,targetwcs = X
 
     img = gaussian_filter(tim.getImage(), sig)
-    try:
-        Yo,Xo,Yi,Xi,[rimg] = resample_with_wcs(
-            targetwcs, tim.subwcs, [img], intType=np.int16)
-    except OverlapError:
-        return None
+    R = tim_resample_lanczos(tim, targetwcs, [img])
     del img
+    if R is None:
+        return None
+    Yo,Xo,Yi,Xi,[rimg] = R
+    del R
     blurnorm = 1./(2. * np.sqrt(np.pi) * sig)
     wt = tim.getInvvar()[Yi,Xi] / (blurnorm**2)
     return (Yo, Xo, rimg*wt, wt, tim.dq[Yi,Xi])
@@ -5,8 +5,113 @@ Find all the PS1 stars in a given DECaLS CCD.
 """
 
 import os
+from collections import OrderedDict
 import numpy as np
 
+class HealpixChunkCache(object):
+    '''
+    A per-process LRU cache of healpix chunk tables, keyed by filename
+    and bounded by the total size of the cached columns (*maxbytes*).
+
+    An entry read with all columns also serves requests for any
+    subset of its columns.  Requested columns that the file does not
+    have are skipped.  Cached tables are shared; callers get copies
+    (see _subtable).
+    '''
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        # fn -> (mtime, columns (tuple or None for all), table, nbytes)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fn, columns=None):
+        '''
+        Returns the (shared, not-to-be-modified) table for chunk *fn*,
+        containing at least the given *columns* (default all).
+        '''
+        from astrometry.util.fits import fits_table
+        mtime = os.stat(fn).st_mtime_ns
+        e = self.entries.get(fn, None)
+        if e is not None:
+            emtime,ecols,T,_ = e
+            if emtime == mtime and (ecols is None or
+                                    (columns is not None and set(columns) <= set(ecols))):
+                self.entries.move_to_end(fn)
+                self.hits += 1
+                return T
+            # stale, or lacking some of the requested columns
+            self._remove(fn)
+        self.misses += 1
+        print('Reading', fn)
+        readcols = columns
+        if columns is not None:
+            import fitsio
+            F = fitsio.FITS(fn)
+            have = set([c.lower() for c in F[1].get_colnames()])
+            F.close()
+            readcols = [c for c in columns if c in have]
+        T = fits_table(fn, columns=readcols)
+        nbytes = sum([T.get(c).nbytes for c in T.get_columns()])
+        if nbytes <= self.maxbytes:
+            self.entries[fn] = (mtime, columns, T, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxbytes:
+                self._remove(next(iter(self.entries)))
+        return T
+
+    def _remove(self, fn):
+        _,_,_,nbytes = self.entries.pop(fn)
+        self.nbytes -= nbytes
+
+    def resize(self, maxbytes):
+        self.maxbytes = maxbytes
+        while self.nbytes > self.maxbytes:
+            self._remove(next(iter(self.entries)))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, nbytes=self.nbytes,
+                    entries=len(self.entries), maxbytes=self.maxbytes)
+
+# Shared by all HealpixedCatalogs in this process (so each pool worker
+# has its own); the default budget can be set (in MB) with the
+# HEALPIX_CACHE_MB environment variable.
+healpix_chunk_cache = HealpixChunkCache(
+    int(float(os.environ.get('HEALPIX_CACHE_MB', 256)) * 1e6))
+
+def set_healpix_cache_size(nbytes):
+    '''
+    Sets the byte budget of the healpix chunk cache; 0 disables it.
+    '''
+    healpix_chunk_cache.resize(nbytes)
+
+def healpix_cache_stats():
+    '''
+    Returns a dict of the healpix chunk cache hits, misses, nbytes,
+    entries and maxbytes.
+    '''
+    return healpix_chunk_cache.stats()
+
+def _subtable(T, columns=None, I=None):
+    '''
+    Returns a copy of table *T*, with only the given *columns* (those
+    it has), and only rows *I* (default all).
+    '''
+    from astrometry.util.fits import fits_table
+    tcols = T.get_columns()
+    if columns is None:
+        columns = tcols
+    else:
+        columns = [c for c in columns if c in tcols]
+    if I is None:
+        I = np.arange(len(T))
+    S = fits_table()
+    for c in columns:
+        S.set(c, T.get(c)[I])
+    S._header = getattr(T, '_header', None)
+    return S
+
 class HealpixedCatalog(object):
     def __init__(self, fnpattern, nside=32):
         '''
@@ -25,41 +130,118 @@ class HealpixedCatalog(object):
         ipring = healpix_xy_to_ring(hpxy, self.nside)
         return ipring
 
-    def get_healpix_catalog(self, healpix):
-        from astrometry.util.fits import fits_table
+    def healpix_side(self):
+        '''
+        Returns the mean side length of a healpix, in degrees.
+        '''
+        return np.rad2deg(np.sqrt(4.*np.pi / (12 * self.nside**2)))
+
+    def healpixes_touching(self, ra, dec, near):
+        '''
+        Returns the set of (ring-numbered) healpixes overlapping a region.
+
+        *ra*, *dec*: points covering the region (its boundary and
+        interior), spaced by at most 1/8 of healpix_side().
+
+        *near*: function (ra, dec) -> bool, True for points within two
+        sample spacings of the region.
+
+        The sample points alone can miss a healpix whose corner pokes
+        into the region between two of them.  That corner is shared
+        with healpixes that do contain sample points, so we check the
+        corners of every healpix found and add all the healpixes
+        around any corner near the region.
+        '''
+        from astrometry.util.util import (radecdegtohealpix, healpix_to_radecdeg,
+                                          healpix_xy_to_ring)
+        nside = self.nside
+        found = set([radecdegtohealpix(r, d, nside) for r,d in zip(ra, dec)])
+        eps = 1e-3 * self.healpix_side()
+        angles = np.deg2rad(np.arange(0, 360, 22.5))
+        corners = set()
+        todo = list(found)
+        while len(todo):
+            hp = todo.pop()
+            for dx,dy in [(0,0), (0,1), (1,0), (1,1)]:
+                r,d = healpix_to_radecdeg(hp, nside, dx, dy)
+                key = (round(r, 8), round(d, 8))
+                if key in corners:
+                    continue
+                corners.add(key)
+                if not near(r, d):
+                    continue
+                if abs(d) > 90. - eps:
+                    # pole
+                    pr = np.rad2deg(angles)
+                    pd = np.sign(d) * (90. - eps) + np.zeros_like(pr)
+                else:
+                    pr = r + eps * np.cos(angles) / np.cos(np.deg2rad(d))
+                    pd = d + eps * np.sin(angles)
+                for rr,dd in zip(pr % 360., pd):
+                    p = radecdegtohealpix(rr, dd, nside)
+                    if not p in found:
+                        found.add(p)
+                        todo.append(p)
+        return set([healpix_xy_to_ring(hp, nside) for hp in found])
+
+    def get_healpix_catalog(self, healpix, columns=None):
+        '''
+        Returns the catalog in the given (ring-numbered) *healpix*,
+        with only the given *columns* (default all).
+        '''
         fname = self.fnpattern % dict(hp=healpix)
-        print('Reading', fname)
-        return fits_table(fname)
+        T = healpix_chunk_cache.get(fname, columns=columns)
+        return _subtable(T, columns=columns)
+
+    def get_healpix_catalogs(self, healpixes, columns=None, cut=None):
+        '''
+        Returns the merged catalogs in the given *healpixes*.
 
-    def get_healpix_catalogs(self, healpixes):
+        *cut*: optional function (table) -> row indices, applied to
+        each chunk before it is copied out of the cache.
+        '''
         from astrometry.util.fits import merge_tables
         cats = []
-        for hp in healpixes:
-            cats.append(self.get_healpix_catalog(hp))
+        for hp in sorted(healpixes):
+            fname = self.fnpattern % dict(hp=hp)
+            T = healpix_chunk_cache.get(fname, columns=columns)
+            cats.append(_subtable(T, columns=columns,
+                                  I=(None if cut is None else cut(T))))
         if len(cats) == 1:
             return cats[0]
         return merge_tables(cats)
 
-    def get_catalog_in_wcs(self, wcs, step=100., margin=10):
-        # Grid the CCD in pixel space
+    def get_catalog_in_wcs(self, wcs, step=None, margin=10, columns=None):
+        '''
+        Returns the catalog entries within *margin* pixels of *wcs*,
+        with their pixel positions in "x" and "y".  *step* is the
+        maximum spacing (in pixels) of the points used to find the
+        healpixes touching the image (default: 1/8 of a healpix).
+        '''
+        if columns is not None:
+            columns = list(columns) + [c for c in ['ra','dec'] if not c in columns]
         W,H = wcs.get_width(), wcs.get_height()
+        spacing = self.healpix_side() / 8. / wcs.pixel_scale() * 3600.
+        if step is not None:
+            spacing = min(spacing, step)
         xx,yy = np.meshgrid(
-            np.linspace(1-margin, W+margin, 2+int((W+2*margin)/step)),
-            np.linspace(1-margin, H+margin, 2+int((H+2*margin)/step)))
-        # Convert to RA,Dec and then to unique healpixes
+            np.linspace(1-margin, W+margin, 2+int((W+2*margin)/spacing)),
+            np.linspace(1-margin, H+margin, 2+int((H+2*margin)/spacing)))
         ra,dec = wcs.pixelxy2radec(xx.ravel(), yy.ravel())
-        healpixes = set()
-        for r,d in zip(ra,dec):
-            healpixes.add(self.healpix_for_radec(r, d))
-        # Read catalog in those healpixes
-        cat = self.get_healpix_catalogs(healpixes)
-        # Cut to sources actually within the CCD.
+        def near(r, d):
+            ok,x,y = wcs.radec2pixelxy(r, d)
+            m = margin + 2.*spacing
+            return bool(ok) and (x >= 1-m) and (x <= W+m) and (y >= 1-m) and (y <= H+m)
+        healpixes = self.healpixes_touching(ra, dec, near)
+
+        def onccd(T):
+            _,x,y = wcs.radec2pixelxy(T.ra, T.dec)
+            return np.flatnonzero((x >= 1.-margin) * (x <= W+margin) *
+                                  (y >= 1.-margin) * (y <= H+margin))
+        cat = self.get_healpix_catalogs(healpixes, columns=columns, cut=onccd)
         _,xx,yy = wcs.radec2pixelxy(cat.ra, cat.dec)
         cat.x = xx
         cat.y = yy
-        onccd = np.flatnonzero((xx >= 1.-margin) * (xx <= W+margin) *
-                               (yy >= 1.-margin) * (yy <= H+margin))
-        cat.cut(onccd)
         return cat
 
 class ps1cat(HealpixedCatalog):
@@ -87,12 +269,14 @@ class ps1cat(HealpixedCatalog):
         else:
             self.ccdwcs = ccdwcs
 
-    def get_stars(self,magrange=None,band='r'):
+    def get_stars(self,magrange=None,band='r',columns=None):
         """Return the set of PS1 or gaia-PS1 matched stars on a given CCD with well-measured grz
         magnitudes. Optionally trim the stars to a desired r-band magnitude
-        range.
+        range, and read only the given catalog columns.
         """
-        cat = self.get_catalog_in_wcs(self.ccdwcs)
+        if columns is not None and magrange is not None and not 'median' in columns:
+            columns = list(columns) + ['median']
+        cat = self.get_catalog_in_wcs(self.ccdwcs, columns=columns)
         print('Found {} good PS1 stars'.format(len(cat)))
         if magrange is not None:
             keep = np.where((cat.median[:,ps1cat.ps1band[band]]>magrange[0])*
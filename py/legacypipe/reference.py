@@ -150,6 +150,35 @@ def get_reference_sources(survey, targetwcs, pixscale, bands,
         if c in refs.get_columns():
             refs.delete_column(c)
 
+    cut_reference_sources(refs, targetwcs, pixscale)
+
+    # ensure bool columns
+    for col in ['isbright', 'ismedium', 'islargegalaxy', 'iscluster', 'isgaia',
+                'istycho', 'donotfit', 'freezeparams']:
+        if not col in refs.get_columns():
+            refs.set(col, np.zeros(len(refs), bool))
+    # Copy flags from the 'refs' table to the source objects themselves.
+    sources = refs.sources
+    refs.delete_column('sources')
+    for i,(donotfit,freeze) in enumerate(zip(refs.donotfit, refs.freezeparams)):
+        if donotfit:
+            sources[i] = None
+        if sources[i] is None:
+            continue
+        sources[i].is_reference_source = True
+        if freeze:
+            sources[i].freezeparams = True
+
+    return refs,sources
+
+def cut_reference_sources(refs, targetwcs, pixscale):
+    '''
+    Cuts reference sources *refs* (in place) to the ones that affect
+    image *targetwcs*, and sets their integer pixel positions ibx,iby
+    and in_bounds flags in that image.
+    '''
+    H,W = targetwcs.shape
+    H,W = int(H),int(W)
     # radius / radius_pix are used to set the MASKBITS shapes;
     # keep_radius determines which sources are kept (because we subtract
     # stellar halos out to N x their radii)
@@ -173,25 +202,6 @@ def get_reference_sources(survey, targetwcs, pixscale, bands,
     refs.in_bounds = ((refs.ibx >= 0) * (refs.ibx < W) *
                       (refs.iby >= 0) * (refs.iby < H))
 
-    # ensure bool columns
-    for col in ['isbright', 'ismedium', 'islargegalaxy', 'iscluster', 'isgaia',
-                'istycho', 'donotfit', 'freezeparams']:
-        if not col in refs.get_columns():
-            refs.set(col, np.zeros(len(refs), bool))
-    # Copy flags from the 'refs' table to the source objects themselves.
-    sources = refs.sources
-    refs.delete_column('sources')
-    for i,(donotfit,freeze) in enumerate(zip(refs.donotfit, refs.freezeparams)):
-        if donotfit:
-            sources[i] = None
-        if sources[i] is None:
-            continue
-        sources[i].is_reference_source = True
-        if freeze:
-            sources[i].freezeparams = True
-
-    return refs,sources
-
 def read_gaia(wcs, bands):
     '''
     *wcs* here should include margin
@@ -199,7 +209,19 @@ def read_gaia(wcs, bands):
     from legacypipe.gaiacat import GaiaCatalog
     from legacypipe.survey import GaiaSource
 
-    gaia = GaiaCatalog().get_catalog_in_wcs(wcs)
+    # the columns used below, plus those written to the ref-sources
+    # file and tagged along into the tractor catalog
+    cols = ['source_id', 'ra', 'dec', 'ref_epoch', 'pmra', 'pmdec', 'parallax',
+            'ra_error', 'dec_error', 'pmra_error', 'pmdec_error', 'parallax_error',
+            'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag',
+            'phot_g_mean_flux_over_error', 'phot_bp_mean_flux_over_error',
+            'phot_rp_mean_flux_over_error', 'phot_g_n_obs', 'phot_bp_n_obs',
+            'phot_rp_n_obs', 'phot_variable_flag', 'astrometric_excess_noise',
+            'astrometric_excess_noise_sig', 'astrometric_n_obs_al',
+            'astrometric_n_good_obs_al', 'astrometric_weight_al', 'duplicated_source',
+            'a_g_val', 'e_bp_min_rp_val', 'phot_bp_rp_excess_factor',
+            'astrometric_sigma5d_max', 'astrometric_params_solved']
+    gaia = GaiaCatalog().get_catalog_in_wcs(wcs, columns=cols)
     debug('Got', len(gaia), 'Gaia stars nearby')
 
     gaia.G = gaia.phot_g_mean_mag
@@ -630,6 +652,7 @@ def read_star_clusters(targetwcs):
 
 def get_reference_map(wcs, refs):
     from legacypipe.bits import IN_BLOB
+    from legacypipe.utils import region_batches, paint_batch
 
     H,W = wcs.shape
     H = int(H)
@@ -664,36 +687,40 @@ def get_reference_map(wcs, refs):
         _,xx,yy = wcs.radec2pixelxy(thisrefs.ra, thisrefs.dec)
         xx -= 1.
         yy -= 1.
-        for x,y,rpix,ref in zip(xx,yy,radius_pix,thisrefs):
+        bitval = np.uint8(IN_BLOB[bit])
+        if ellipse:
+            # *should* have ba and pa if we got here...
+            # (computed per object, as scalars, to keep the exact
+            # floating-point results of painting one at a time)
+            pa = [p if np.isfinite(p) else 0. for p in thisrefs.pa]
+            ct = np.array([np.cos(np.deg2rad(90.+p)) for p in pa])
+            st = np.array([np.sin(np.deg2rad(90.+p)) for p in pa])
+            r2 = radius_pix * thisrefs.ba
+            debug('Painting', len(I), col, 'ellipses: PA', thisrefs.pa, 'BA', thisrefs.ba,
+                  'radius (pix)', radius_pix)
+        # Paint regions of the same size in batches
+        for J,gx,gy in region_batches(xx, yy, radius_pix, shape=(H,W)):
+            x = xx[J][:,np.newaxis,np.newaxis]
+            y = yy[J][:,np.newaxis,np.newaxis]
+            rpix = radius_pix[J][:,np.newaxis,np.newaxis]
+            dx = gx[:,np.newaxis,:] - x
+            dy = gy[:,:,np.newaxis] - y
             # Cut to bounding square
-            xlo = int(np.clip(np.floor(x   - rpix), 0, W))
-            xhi = int(np.clip(np.ceil (x+1 + rpix), 0, W))
-            ylo = int(np.clip(np.floor(y   - rpix), 0, H))
-            yhi = int(np.clip(np.ceil (y+1 + rpix), 0, H))
-            if xlo == xhi or ylo == yhi:
-                continue
-            bitval = np.uint8(IN_BLOB[bit])
+            inbox = ((gx < np.ceil(xx[J] + 1 + radius_pix[J])[:,np.newaxis])[:,np.newaxis,:] *
+                     (gy < np.ceil(yy[J] + 1 + radius_pix[J])[:,np.newaxis])[:,:,np.newaxis])
             if not ellipse:
-                rr = ((np.arange(ylo,yhi)[:,np.newaxis] - y)**2 +
-                      (np.arange(xlo,xhi)[np.newaxis,:] - x)**2)
+                rr = dy**2 + dx**2
                 masked = (rr <= rpix**2)
             else:
-                # *should* have ba and pa if we got here...
-                xgrid,ygrid = np.meshgrid(np.arange(xlo,xhi), np.arange(ylo,yhi))
-                dx = xgrid - x
-                dy = ygrid - y
                 # Rotate to "intermediate world coords" via the unit-scaled CD matrix
                 du = cd[0][0] * dx + cd[0][1] * dy
                 dv = cd[1][0] * dx + cd[1][1] * dy
-                debug('Object: PA', ref.pa, 'BA', ref.ba, 'Radius', ref.radius, 'pix', rpix)
-                if not np.isfinite(ref.pa):
-                    ref.pa = 0.
-                ct = np.cos(np.deg2rad(90.+ref.pa))
-                st = np.sin(np.deg2rad(90.+ref.pa))
-                v1 = ct * du + -st * dv
-                v2 = st * du +  ct * dv
+                c = ct[J][:,np.newaxis,np.newaxis]
+                s = st[J][:,np.newaxis,np.newaxis]
+                v1 = c * du + -s * dv
+                v2 = s * du +  c * dv
                 r1 = rpix
-                r2 = rpix * ref.ba
-                masked = (v1**2 / r1**2 + v2**2 / r2**2 < 1.)
-            refmap[ylo:yhi, xlo:xhi] |= (bitval * masked)
+                rb = r2[J][:,np.newaxis,np.newaxis]
+                masked = (v1**2 / r1**2 + v2**2 / rb**2 < 1.)
+            paint_batch(refmap, bitval, gx, gy, masked * inbox)
     return refmap
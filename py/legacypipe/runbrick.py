@@ -91,6 +91,8 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
                galex_dir=None,
                command_line=None,
                read_parallel=True,
+               merge_calibs=False,
+               tim_spill_dir=None,
                **kwargs):
     '''
     This is the first stage in the pipeline.  It
@@ -254,28 +256,45 @@ def stage_tims(W=3600, H=3600, pixscale=0.262, brickname=None,
             kwa.update(splinesky=True)
         if not gaia_stars:
             kwa.update(gaia=False)
+        if merge_calibs:
+            kwa.update(merge_calibs=True)
 
-        # Run calibrations
-        args = [(im, kwa) for im in ims]
+        # Run calibrations (once per CCD; see legacypipe.calibservice)
+        from legacypipe.calibservice import dedup_calib_args
+        args = dedup_calib_args([(im, kwa) for im in ims])
         mp.map(run_calibs, args)
         tnow = Time()
         debug('Calibrations:', tnow-tlast)
         tlast = tnow
 
     # Read Tractor images
+    spill_dir = None
+    if tim_spill_dir is not None:
+        import tempfile
+        os.makedirs(tim_spill_dir, exist_ok=True)
+        spill_dir = tempfile.mkdtemp(prefix='tims-%s-' % brickname, dir=tim_spill_dir)
+        info('Spilling tim pixels to', spill_dir)
     args = [(im, targetrd, dict(gaussPsf=gaussPsf, pixPsf=pixPsf,
                                 hybridPsf=hybridPsf, normalizePsf=normalizePsf,
                                 subsky=subsky,
                                 apodize=apodize,
                                 constant_invvar=constant_invvar,
                                 pixels=read_image_pixels,
-                                old_calibs_ok=old_calibs_ok))
+                                old_calibs_ok=old_calibs_ok,
+                                spill_dir=spill_dir))
                                 for im in ims]
     record_event and record_event('stage_tims: starting read_tims')
     if read_parallel:
         tims = list(mp.map(read_one_tim, args))
     else:
         tims = list(map(read_one_tim, args))
+    if spill_dir is not None:
+        # Memory-map the spilled pixels (unlinking the files).
+        import shutil
+        from legacypipe.timspill import map_spilled_tim
+        tims = [map_spilled_tim(tim) if tim is not None else None
+                for tim in tims]
+        shutil.rmtree(spill_dir, ignore_errors=True)
     record_event and record_event('stage_tims: done read_tims')
 
     tnow = Time()
@@ -916,6 +935,7 @@ def stage_srcs(pixscale=None, targetwcs=None,
     else:
         co_sky = None
 
+
     keys = ['T', 'tims', 'blobsrcs', 'blobslices', 'blobmap', 'cat',
             'ps', 'saturated_pix', 'version_header', 'co_sky', 'ccds']
     L = locals()
@@ -939,6 +959,12 @@ def stage_fitblobs(T=None,
                    nblobs=None, blob0=None, blobxy=None,
                    blobradec=None, blobid=None,
                    max_blobsize=None,
+                   blob_cost_model=None,
+                   shared_tims=False,
+                   intra_blob_threads=1,
+                   fit_max_steps=None,
+                   fit_dchisq_snr=None,
+                   blob_cpu_budget=None,
                    reoptimize=False,
                    iterative=False,
                    large_galaxies_force_pointsource=True,
@@ -1051,18 +1077,32 @@ def stage_fitblobs(T=None,
     R = []
     # Check for existing checkpoint file.
     if checkpoint_filename and os.path.exists(checkpoint_filename):
-        from astrometry.util.file import unpickle_from_file
+        from legacypipe.checkpoint import read_checkpoint, write_checkpoint
         info('Reading', checkpoint_filename)
+        nread = [0]
+        def counting(rr):
+            for r in rr:
+                nread[0] += 1
+                yield r
         try:
-            R = unpickle_from_file(checkpoint_filename)
-            debug('Read', len(R), 'results from checkpoint file', checkpoint_filename)
+            for r in _check_checkpoints(counting(read_checkpoint(checkpoint_filename)),
+                                        blobslices, brickname):
+                R.append(r)
         except:
             import traceback
             print('Failed to read checkpoint file ' + checkpoint_filename)
             traceback.print_exc()
-        keepR = _check_checkpoints(R, blobslices, brickname)
-        info('Keeping', len(keepR), 'of', len(R), 'checkpointed results')
-        R = keepR
+        nread = nread[0]
+        info('Keeping', len(R), 'of', nread, 'checkpointed results')
+        if len(R) < nread:
+            # Rewrite the checkpoint without the dropped results, so
+            # that new results can be appended to it.
+            try:
+                write_checkpoint(R, checkpoint_filename)
+            except:
+                print('Failed to rewrite checkpoint file', checkpoint_filename)
+                import traceback
+                traceback.print_exc()
         skipblobs = [r['iblob'] for r in R]
 
     bailout_mask = None
@@ -1101,6 +1141,19 @@ def stage_fitblobs(T=None,
 
     frozen_galaxies = get_frozen_galaxies(T, blobsrcs, blobmap, targetwcs, cat)
     refmap = get_blobiter_ref_map(refstars, T_clusters, less_masking, targetwcs)
+    shared_pixels = None
+    if shared_tims and mp is not None and mp.pool is not None:
+        from legacypipe.sharedtims import SharedTimPixels, shared_memory_available
+        if shared_memory_available():
+            shared_pixels = SharedTimPixels(tims)
+        else:
+            info('--shared-tims needs Python >= 3.8 (multiprocessing.shared_memory);'
+                 ' sending tim pixels to the workers with their tasks instead')
+
+    blob_order = None
+    if blob_cost_model is not None:
+        blob_order,_ = _blob_cost_order(blob_cost_model, blobslices, blobsrcs, blobmap,
+                                        targetwcs, tims, cat, frozen_galaxies)
     # Create the iterator over blobs to process
     blobiter = _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims,
                           cat, bands, plots, ps, reoptimize, iterative, use_ceres,
@@ -1108,54 +1161,66 @@ def stage_fitblobs(T=None,
                           frozen_galaxies,
                           skipblobs=skipblobs,
                           single_thread=(mp is None or mp.pool is None),
-                          max_blobsize=max_blobsize, custom_brick=custom_brick)
+                          max_blobsize=max_blobsize, custom_brick=custom_brick,
+                          blob_order=blob_order, shared_pixels=shared_pixels,
+                          intra_blob_threads=intra_blob_threads,
+                          fit_limits=dict(max_steps=fit_max_steps,
+                                          dchisq_snr=fit_dchisq_snr,
+                                          cpu_budget=blob_cpu_budget))
     # to allow timingpool to queue tasks one at a time
     blobiter = iterwrapper(blobiter, len(blobsrcs))
 
-    if checkpoint_filename is None:
-        R.extend(mp.map(_bounce_one_blob, blobiter))
-    else:
-        from astrometry.util.ttime import CpuMeas
-        # Begin running one_blob on each blob...
-        Riter = mp.imap_unordered(_bounce_one_blob, blobiter)
-        # measure wall time and write out checkpoint file periodically.
-        last_checkpoint = CpuMeas()
-        n_finished = 0
-        n_finished_total = 0
-        while True:
-            import multiprocessing
-            # Time to write a checkpoint file? (And have something to write?)
-            tnow = CpuMeas()
-            dt = tnow.wall_seconds_since(last_checkpoint)
-            if dt >= checkpoint_period and n_finished > 0:
-                # Write checkpoint!
-                debug('Writing', n_finished, 'new results; total for this run', n_finished_total)
+    try:
+        if checkpoint_filename is None:
+            R.extend(mp.map(_bounce_one_blob, blobiter))
+        else:
+            from astrometry.util.ttime import CpuMeas
+            from legacypipe.checkpoint import CheckpointWriter
+            # Results are appended to the checkpoint file as they arrive,
+            # and synced to disk every checkpoint_period.
+            ckpt = CheckpointWriter(checkpoint_filename, sync_period=None)
+            # Begin running one_blob on each blob...
+            Riter = mp.imap_unordered(_bounce_one_blob, blobiter)
+            last_checkpoint = CpuMeas()
+            n_finished = 0
+            n_finished_total = 0
+            while True:
+                import multiprocessing
+                # Time to sync the checkpoint file? (And have something to write?)
+                tnow = CpuMeas()
+                dt = tnow.wall_seconds_since(last_checkpoint)
+                if dt >= checkpoint_period and n_finished > 0:
+                    debug('Syncing', n_finished, 'new results; total for this run', n_finished_total)
+                    try:
+                        ckpt.sync()
+                        last_checkpoint = tnow
+                        dt = 0.
+                        n_finished = 0
+                    except:
+                        print('Failed to write checkpoint file', checkpoint_filename)
+                        import traceback
+                        traceback.print_exc()
+                # Wait for results (with timeout)
                 try:
-                    _write_checkpoint(R, checkpoint_filename)
-                    last_checkpoint = tnow
-                    dt = 0.
-                    n_finished = 0
-                except:
-                    print('Failed to write checkpoint file', checkpoint_filename)
-                    import traceback
-                    traceback.print_exc()
-            # Wait for results (with timeout)
-            try:
-                if mp.pool is not None:
-                    timeout = max(1, checkpoint_period - dt)
-                    r = Riter.next(timeout)
-                else:
-                    r = next(Riter)
-                R.append(r)
-                n_finished += 1
-                n_finished_total += 1
-            except StopIteration:
-                break
-            except multiprocessing.TimeoutError:
-                continue
-        # Write checkpoint when done!
-        _write_checkpoint(R, checkpoint_filename)
-        debug('Got', n_finished_total, 'results; wrote', len(R), 'to checkpoint')
+                    if mp.pool is not None:
+                        timeout = max(1, checkpoint_period - dt)
+                        r = Riter.next(timeout)
+                    else:
+                        r = next(Riter)
+                    R.append(r)
+                    ckpt.append(r)
+                    n_finished += 1
+                    n_finished_total += 1
+                except StopIteration:
+                    break
+                except multiprocessing.TimeoutError:
+                    continue
+            # Sync checkpoint when done!
+            ckpt.close()
+            debug('Got', n_finished_total, 'results; wrote them to checkpoint', checkpoint_filename)
+    finally:
+        if shared_pixels is not None:
+            shared_pixels.close()
     debug('Fitting sources:', Time()-tlast)
 
     # Repackage the results from one_blob...
@@ -1238,10 +1303,10 @@ def stage_fitblobs(T=None,
     for k in ['fracflux', 'fracin', 'fracmasked', 'rchisq',
               'cpu_arch', 'cpu_source', 'cpu_blob',
               'blob_width', 'blob_height', 'blob_npix',
-              'blob_nimages', 'blob_totalpix',
+              'blob_nimages', 'blob_totalpix', 'blob_nlarge', 'blob_nfrozen',
               'blob_symm_width', 'blob_symm_height', 'blob_symm_npix',
               'blob_symm_nimages', 'bx0', 'by0',
-              'hit_limit', 'hit_ser_limit', 'hit_r_limit',
+              'hit_limit', 'hit_ser_limit', 'hit_r_limit', 'hit_budget',
               'dchisq',
               'force_keep_source', 'fit_background', 'forced_pointsource']:
         T.set(k, BB.get(k))
@@ -1467,22 +1532,15 @@ def _get_bailout_mask(blobmap, skipblobs, targetwcs, W, H, brick, blobslices):
     bailout_mask = bmap[blobmap+1]
     return bailout_mask
 
-def _write_checkpoint(R, checkpoint_filename):
-    from astrometry.util.file import pickle_to_file, trymakedirs
-    d = os.path.dirname(checkpoint_filename)
-    if len(d) and not os.path.exists(d):
-        trymakedirs(d)
-    fn = checkpoint_filename + '.tmp'
-    pickle_to_file(R, fn)
-    os.rename(fn, checkpoint_filename)
-    debug('Wrote checkpoint to', checkpoint_filename)
-
 def _check_checkpoints(R, blobslices, brickname):
     # Check that checkpointed blobids match our current set of blobs,
     # based on blob bounding-box.  This can fail if the code changes
     # between writing & reading the checkpoint, resulting in a
     # different set of detected sources.
-    keepR = []
+    #
+    # *R* can be any iterable (eg, the generator from
+    # checkpoint.read_checkpoint); results are yielded as they pass.
+    seen = set()
     for ri in R:
         brick = ri['brickname']
         iblob = ri['iblob']
@@ -1514,26 +1572,51 @@ def _check_checkpoints(R, blobslices, brickname):
                     print('Checkpointed blob bbox', [rx0,rx1,ry0,ry1],
                           'does not match expected', [bx0,bx1,by0,by1], 'for iblob', iblob)
                     continue
-        keepR.append(ri)
-    return keepR
+        if iblob >= 0:
+            if iblob in seen:
+                print('Duplicate checkpointed result for iblob', iblob)
+                continue
+            seen.add(iblob)
+        yield ri
 
 def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, bands,
                plots, ps, reoptimize, iterative, use_ceres, refmap,
                large_galaxies_force_pointsource, less_masking,
                brick, frozen_galaxies, single_thread=False,
-               skipblobs=None, max_blobsize=None, custom_brick=False):
+               skipblobs=None, max_blobsize=None, custom_brick=False,
+               blob_order=None, shared_pixels=None, intra_blob_threads=1,
+               fit_limits=None):
     '''
     *blobmap*: map, with -1 indicating no-blob, other values indexing *blobslices*,*blobsrcs*.
+
+    *blob_order*: order in which to yield blobs (eg, from
+     _blob_cost_order); default is largest first.
+
+    *shared_pixels*: a sharedtims.SharedTimPixels holding the pixels of
+     *tims*; if given, blob tasks refer to those rather than carrying
+     copies of the tim sub-images.
+
+    *intra_blob_threads*: number of threads each blob task may use to
+     fit non-overlapping sources concurrently (see OneBlob).
+
+    *fit_limits*: dict of convergence limits (max_steps, dchisq_snr,
+     cpu_budget) passed to OneBlob.
     '''
     from collections import Counter
 
+    # Optional settings for one_blob
+    blob_opts = dict(threads=intra_blob_threads)
+    if fit_limits is not None:
+        blob_opts.update(fit_limits)
+
     if skipblobs is None:
         skipblobs = []
 
-    # sort blobs by size so that larger ones start running first
-    blobvals = Counter(blobmap[blobmap>=0])
-    blob_order = np.array([b for b,npix in blobvals.most_common()])
-    del blobvals
+    if blob_order is None:
+        # sort blobs by size so that larger ones start running first
+        blobvals = Counter(blobmap[blobmap>=0])
+        blob_order = np.array([b for b,npix in blobvals.most_common()])
+        del blobvals
 
     if custom_brick:
         U = None
@@ -1596,7 +1679,7 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, b
         # Here we cut out subimages for the blob...
         rr,dd = targetwcs.pixelxy2radec([bx0,bx0,bx1,bx1],[by0,by1,by1,by0])
         subtimargs = []
-        for tim in tims:
+        for itim,tim in enumerate(tims):
             h,w = tim.shape
             _,x,y = tim.subwcs.radec2pixelxy(rr,dd)
             sx0,sx1 = x.min(), x.max()
@@ -1610,12 +1693,17 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, b
             sy0 = int(np.clip(int(np.floor(sy0)), 0, h-1))
             sy1 = int(np.clip(int(np.ceil (sy1)), 0, h-1)) + 1
             subslc = slice(sy0,sy1),slice(sx0,sx1)
-            subimg = tim.getImage   ()[subslc]
-            subie  = tim.getInvError()[subslc]
-            if tim.dq is None:
-                subdq = None
+            if shared_pixels is not None:
+                subimg = shared_pixels.get(itim, 'img',    subslc)
+                subie  = shared_pixels.get(itim, 'inverr', subslc)
+                subdq  = shared_pixels.get(itim, 'dq',     subslc)
             else:
-                subdq  = tim.dq[subslc]
+                subimg = tim.getImage   ()[subslc]
+                subie  = tim.getInvError()[subslc]
+                if tim.dq is None:
+                    subdq = None
+                else:
+                    subdq  = tim.dq[subslc]
             subwcs = tim.getWcs().shifted(sx0, sy0)
             subsky = tim.getSky().shifted(sx0, sy0)
             subpsf = tim.getPsf().getShifted(sx0, sy0)
@@ -1640,7 +1728,32 @@ def _blob_iter(brickname, blobslices, blobsrcs, blobmap, targetwcs, tims, cat, b
                 blobmask, subtimargs, [cat[i] for i in Isrcs], bands, plots, ps,
                 reoptimize, iterative, use_ceres, refmap[bslc],
                 large_galaxies_force_pointsource, less_masking,
-                frozen_galaxies.get(iblob, [])))
+                frozen_galaxies.get(iblob, []),
+                blob_opts))
+
+def _blob_cost_order(blob_cost_model, blobslices, blobsrcs, blobmap, targetwcs,
+                     tims, cat, frozen_galaxies, nworkers=None, tail_aware=False):
+    '''
+    Orders blobs by CPU time predicted by *blob_cost_model* (see
+    legacypipe.blobcost), longest first.
+
+    Returns (blob_order, cost), where *cost* is indexed by blob
+    number; if *tail_aware*, returns (blob_order, cost, stragglers),
+    where *stragglers* is the set of blob numbers predicted to run
+    longer than the ideal per-worker share of the total.
+    '''
+    from legacypipe.blobcost import blob_cost_features, schedule_blobs
+    F = blob_cost_features(blobslices, blobsrcs, blobmap, targetwcs, tims, cat,
+                           frozen_galaxies)
+    cost = blob_cost_model.predict(F)
+    F.cost = cost
+    F.cut(F.npix > 0)
+    debug('Predicted CPU time for', len(F), 'blobs:', np.sum(F.cost), 'sec')
+    if not tail_aware:
+        I = schedule_blobs(F.cost)
+        return F.iblob[I], cost
+    I,strag = schedule_blobs(F.cost, nworkers=nworkers, tail_aware=True)
+    return F.iblob[I], cost, set(F.iblob[strag])
 
 def _bounce_one_blob(X):
     ''' This just wraps the one_blob function, for debugging &
@@ -1670,17 +1783,18 @@ def _get_mod(X):
     return mod
 
 def _get_both_mods(X):
-    from astrometry.util.resample import resample_with_wcs, OverlapError
     from astrometry.util.miscutils import get_overlapping_region
+    from legacypipe.survey import tim_get_resamp_map
     (tim, srcs, srcblobs, blobmap, targetwcs, frozen_galaxies, ps, plots) = X
     mod = np.zeros(tim.getModelShape(), np.float32)
     blobmod = np.zeros(tim.getModelShape(), np.float32)
     assert(len(srcs) == len(srcblobs))
     ### modelMasks during fitblobs()....?
-    try:
-        Yo,Xo,Yi,Xi,_ = resample_with_wcs(tim.subwcs, targetwcs)
-    except OverlapError:
+    R = tim_get_resamp_map(tim, targetwcs, reverse=True)
+    if R is None:
         return None,None
+    Yo,Xo,Yi,Xi = R.indices()
+    del R
     timblobmap = np.empty(mod.shape, blobmap.dtype)
     timblobmap[:,:] = -1
     timblobmap[Yo,Xo] = blobmap[Yi,Xi]
@@ -2066,6 +2180,7 @@ def stage_coadds(survey=None, bands=None, version_header=None, targetwcs=None,
         ('RUNNER',              'RUN',   'fitting moved pos > 2.5 arcsec'),
         ('GAIA_POINTSOURCE',    'GPSF',  'Gaia source treated as point source'),
         ('ITERATIVE',           'ITER',  'source detected during iterative detection'),
+        ('HIT_BUDGET',          'BUDGT', 'hit step or CPU budget during fit'),
         ]
     version_header.add_record(dict(name='COMMENT', value='fitbits bits:'))
     _add_bit_description(version_header, FITBITS, fbits,
@@ -2322,6 +2437,7 @@ def stage_wise_forced(
     brick=None,
     wise_ceres=True,
     unwise_coadds=True,
+    wise_cells=None,
     version_header=None,
     maskbits=None,
     mp=None,
@@ -2397,7 +2513,8 @@ def stage_wise_forced(
     eargs = []
     if unwise_tr_dir is not None:
         tdir = unwise_tr_dir
-        TR = fits_table(os.path.join(tdir, 'time_resolved_atlas.fits'))
+        from legacypipe.tilecache import read_table
+        TR = read_table(os.path.join(tdir, 'time_resolved_atlas.fits'))
         debug('Read', len(TR), 'time-resolved WISE coadd tiles')
         TR.cut(np.array([t in tiles.coadd_id for t in TR.coadd_id]))
         debug('Cut to', len(TR), 'time-resolved vs', len(tiles), 'full-depth')
@@ -2448,7 +2565,24 @@ def stage_wise_forced(
 
     # Run the forced photometry!
     record_event and record_event('stage_wise_forced: photometry')
-    phots = mp.map(unwise_phot, args + [a for ie,a in eargs])
+    tasks = args + [a for ie,a in eargs]
+    if wise_cells is not None and wise_cells > 1 and len(tasks):
+        # Split each task into spatial cells, to use more cores.
+        from legacypipe.unwise import UnwiseCells
+        # halo: 30 unWISE pixels
+        cells = UnwiseCells(targetwcs, wise_cells, 30. * 2.75 / pixscale)
+        ra  = np.array([src.getPosition().ra  for src in wcat])
+        dec = np.array([src.getPosition().dec for src in wcat])
+        split = cells.split(ra, dec)
+        info('Running unWISE forced photometry in', len(split), 'cells; sources per cell:',
+             [len(I) for I,_,_ in split])
+        cphots = mp.map(unwise_phot, [cells.task_args(X, c) for X in tasks for c in split])
+        n = len(split)
+        phots = [cells.merge(split, cphots[i*n:(i+1)*n], len(wcat))
+                 for i in range(len(tasks))]
+        del cphots
+    else:
+        phots = mp.map(unwise_phot, tasks)
     record_event and record_event('stage_wise_forced: results')
 
     # Unpack results...
@@ -2573,6 +2707,40 @@ def _fill_skipped_values(WISE, Nskipped, do_phot):
     WISE.cut(I)
     return WISE
 
+def _set_fitbits(T, pixscale):
+    '''
+    Sets the FITBITS column *T.fitbits* from the fitting results in *T*
+    (*pixscale* in arcsec/pixel).
+    '''
+    T.fitbits = np.zeros(len(T), np.int16)
+    T.fitbits[T.forced_pointsource] |= FITBITS['FORCED_POINTSOURCE']
+    T.fitbits[T.fit_background]     |= FITBITS['FIT_BACKGROUND']
+    T.fitbits[T.hit_r_limit]        |= FITBITS['HIT_RADIUS_LIMIT']
+    T.fitbits[T.hit_ser_limit]      |= FITBITS['HIT_SERSIC_LIMIT']
+    # WALKER/RUNNER
+    moved = np.hypot(T.bx - T.bx0, T.by - T.by0)
+    # radii in pixels:
+    walk_radius = 1.  / pixscale
+    run_radius  = 2.5 / pixscale
+    T.fitbits[moved > walk_radius] |= FITBITS['WALKER']
+    T.fitbits[moved > run_radius ] |= FITBITS['RUNNER']
+    # do we have Gaia?
+    if 'pointsource' in T.get_columns():
+        T.fitbits[T.pointsource]       |= FITBITS['GAIA_POINTSOURCE']
+    T.fitbits[T.iterative]         |= FITBITS['ITERATIVE']
+    if 'hit_budget' in T.get_columns():
+        T.fitbits[T.hit_budget]    |= FITBITS['HIT_BUDGET']
+
+    for col,bit in [('freezeparams',  'FROZEN'),
+                    ('isbright',      'BRIGHT'),
+                    ('ismedium',      'MEDIUM'),
+                    ('isgaia',        'GAIA'),
+                    ('istycho',       'TYCHO2'),
+                    ('islargegalaxy', 'LARGEGALAXY')]:
+        if not col in T.get_columns():
+            continue
+        T.fitbits[T.get(col)] |= FITBITS[bit]
+
 def stage_writecat(
     survey=None,
     version_header=None,
@@ -2809,32 +2977,7 @@ def stage_writecat(
     T.sersic[np.array([t in ['EXP',b'EXP'] for t in T.type])] = 1.0
     T.sersic[np.array([t in ['REX',b'REX'] for t in T.type])] = 1.0
 
-    T.fitbits = np.zeros(len(T), np.int16)
-    T.fitbits[T.forced_pointsource] |= FITBITS['FORCED_POINTSOURCE']
-    T.fitbits[T.fit_background]     |= FITBITS['FIT_BACKGROUND']
-    T.fitbits[T.hit_r_limit]        |= FITBITS['HIT_RADIUS_LIMIT']
-    T.fitbits[T.hit_ser_limit]      |= FITBITS['HIT_SERSIC_LIMIT']
-    # WALKER/RUNNER
-    moved = np.hypot(T.bx - T.bx0, T.by - T.by0)
-    # radii in pixels:
-    walk_radius = 1.  / pixscale
-    run_radius  = 2.5 / pixscale
-    T.fitbits[moved > walk_radius] |= FITBITS['WALKER']
-    T.fitbits[moved > run_radius ] |= FITBITS['RUNNER']
-    # do we have Gaia?
-    if 'pointsource' in T.get_columns():
-        T.fitbits[T.pointsource]       |= FITBITS['GAIA_POINTSOURCE']
-    T.fitbits[T.iterative]         |= FITBITS['ITERATIVE']
-
-    for col,bit in [('freezeparams',  'FROZEN'),
-                    ('isbright',      'BRIGHT'),
-                    ('ismedium',      'MEDIUM'),
-                    ('isgaia',        'GAIA'),
-                    ('istycho',       'TYCHO2'),
-                    ('islargegalaxy', 'LARGEGALAXY')]:
-        if not col in T.get_columns():
-            continue
-        T.fitbits[T.get(col)] |= FITBITS[bit]
+    _set_fitbits(T, pixscale)
 
     with survey.write_output('tractor-intermediate', brick=brickname) as out:
         T[np.argsort(T.objid)].writeto(None, fits_object=out.fits, primheader=primhdr)
@@ -2895,6 +3038,15 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               allbands='grz',
               nblobs=None, blob=None, blobxy=None, blobradec=None, blobid=None,
               max_blobsize=None,
+              blob_cost_model=None,
+              shared_tims=False,
+              intra_blob_threads=None,
+              fit_max_steps=None,
+              fit_dchisq_snr=None,
+              blob_cpu_budget=None,
+              wise_cells=None,
+              merge_calibs=False,
+              tim_spill_dir=None,
               nsigma=6,
               saddle_fraction=0.1,
               saddle_min=2.,
@@ -2944,6 +3096,7 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
               record_event=None,
     # These are for the 'stages' infrastructure
               pickle_pat='pickles/runbrick-%(brick)s-%%(stage)s.pickle',
+              stage_store=None,
               stages=None,
               force=None, forceall=False, write_pickles=True,
               checkpoint_filename=None,
@@ -3015,16 +3168,56 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     - *max_blobsize*: int; ignore blobs with more than this many pixels
 
+    - *blob_cost_model*: string; if set, a blob CPU-time model file
+      (from legacypipe.blobcost), or "default" for the built-in
+      coefficients; blobs are fit in order of predicted time rather
+      than size.
+
+    - *shared_tims*: boolean; with *threads*, pass tim pixels to the
+      blob-fitting workers through shared memory rather than pickling
+      them into each task.  Needs Python >= 3.8; ignored otherwise.
+
+    - *intra_blob_threads*: integer; threads that each big blob may use
+      to fit its non-overlapping sources concurrently during model
+      selection.  With more than one thread, the result is
+      deterministic but can differ slightly from the serial fit, since
+      sources fit together do not see each other's final models.
+
+    - *fit_max_steps*: integer; maximum optimizer steps when fitting
+      each source.
+
+    - *fit_dchisq_snr*: float; stop optimizing a source when the
+      chi-squared improvement per step falls below this fraction of
+      its (S/N)^2.
+
+    - *blob_cpu_budget*: float; CPU seconds per blob, after which the
+      remaining sources keep their model types and only their fluxes
+      are fit.  Sources hitting either budget get the HIT_BUDGET fitbit.
+
     - *nsigma*: float; detection threshold in sigmas.
 
     - *wise*: boolean; run WISE forced photometry?
 
+    - *wise_cells*: integer; split the brick into this many cells on a
+      side for unWISE forced photometry, and fit the cells in
+      parallel.  Each cell also fits the sources within a halo around
+      it, but fluxes near cell edges can differ slightly from fitting
+      the whole brick at once.
+
     - *early_coadds*: boolean; generate the early coadds?
 
     - *do_calibs*: boolean; run the calibration preprocessing steps?
 
     - *old_calibs_ok*: boolean; allow/use old calibration frames?
 
+    - *merge_calibs*: boolean; when the calibration steps complete the
+      last CCD of an exposure, merge its per-CCD PsfEx and sky files
+      into the per-exposure files.
+
+    - *tim_spill_dir*: string; directory (eg, on node-local disk) to
+      write the tims' pixels to, keeping them memory-mapped rather
+      than in memory (see legacypipe.timspill).
+
     - *write_metrics*: boolean; write out a variety of useful metrics
 
     - *gaussPsf*: boolean; use a simpler single-component Gaussian PSF model?
@@ -3068,6 +3261,8 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
     Options regarding the "stages":
 
     - *pickle_pat*: string; filename for 'pickle' files
+    - *stage_store*: string; if set, directory for a per-key stage
+      store (see legacypipe.stagestore), used instead of pickle files.
     - *stages*: list of strings; stages (functions stage_*) to run.
 
     - *force*: list of strings; prerequisite stages that will be run
@@ -3127,8 +3322,12 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
                           int(1000*np.abs(dec))))
     initargs.update(brickname=brick, survey=survey)
 
+    stage_args = None
     if stagefunc is None:
         stagefunc = CallGlobalTime('stage_%s', globals())
+        if stage_store is not None:
+            from legacypipe.stagestore import stage_arg_names
+            stage_args = lambda stage: stage_arg_names(globals()['stage_%s' % stage])
 
     plot_base_default = 'brick-%(brick)s'
     if plot_base is None:
@@ -3223,6 +3422,28 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
         kwargs.update(blobid=blobid)
     if max_blobsize is not None:
         kwargs.update(max_blobsize=max_blobsize)
+    if shared_tims:
+        kwargs.update(shared_tims=True)
+    if intra_blob_threads is not None:
+        kwargs.update(intra_blob_threads=intra_blob_threads)
+    if fit_max_steps is not None:
+        kwargs.update(fit_max_steps=fit_max_steps)
+    if fit_dchisq_snr is not None:
+        kwargs.update(fit_dchisq_snr=fit_dchisq_snr)
+    if blob_cpu_budget is not None:
+        kwargs.update(blob_cpu_budget=blob_cpu_budget)
+    if wise_cells is not None:
+        kwargs.update(wise_cells=wise_cells)
+    if merge_calibs:
+        kwargs.update(merge_calibs=merge_calibs)
+    if tim_spill_dir is not None:
+        kwargs.update(tim_spill_dir=tim_spill_dir)
+    if blob_cost_model is not None:
+        from legacypipe.blobcost import BlobCostModel
+        if blob_cost_model == 'default':
+            kwargs.update(blob_cost_model=BlobCostModel())
+        else:
+            kwargs.update(blob_cost_model=BlobCostModel.read(blob_cost_model))
 
     pickle_pat = pickle_pat % dict(brick=brick)
 
@@ -3327,9 +3548,17 @@ def run_brick(brick, survey, radec=None, pixscale=0.262,
 
     t0 = StageTime()
     R = None
-    for stage in stages:
-        R = runstage(stage, pickle_pat, mystagefunc, prereqs=prereqs,
-                     initial_args=initargs, **kwargs)
+    if stage_store is not None:
+        from legacypipe.stagestore import StageStore, runstage as store_runstage
+        store = StageStore(stage_store % dict(brick=brick))
+        for stage in stages:
+            R = store_runstage(stage, store, mystagefunc, prereqs=prereqs,
+                               initial_args=initargs, stage_args=stage_args,
+                               **kwargs)
+    else:
+        for stage in stages:
+            R = runstage(stage, pickle_pat, mystagefunc, prereqs=prereqs,
+                         initial_args=initargs, **kwargs)
 
     info('All done:', StageTime()-t0)
 
@@ -3429,6 +3658,10 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
         '-P', '--pickle', dest='pickle_pat',
         help='Pickle filename pattern, default %(default)s',
         default='pickles/runbrick-%(brick)s-%%(stage)s.pickle')
+    parser.add_argument(
+        '--stage-store', default=None,
+        help='Directory for a per-key stage store, used instead of pickle files; '
+        'eg "pickles/runbrick-%%(brick)s-store"')
 
     parser.add_argument('--plot-base',
                         help='Base filename for plots, default brick-BRICK')
@@ -3456,6 +3689,20 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
 
     parser.add_argument('--max-blobsize', type=int,
                         help='Skip blobs containing more than the given number of pixels.')
+    parser.add_argument('--blob-cost-model', default=None,
+                        help='Fit blobs in order of CPU time predicted by this model file (from legacypipe.blobcost), or "default"')
+    parser.add_argument('--shared-tims', default=False, action='store_true',
+                        help='With --threads, send tim pixels to blob-fitting workers via shared memory (Python >= 3.8)')
+    parser.add_argument('--intra-blob-threads', type=int, default=None,
+                        help='Threads per big blob for fitting non-overlapping sources concurrently')
+    parser.add_argument('--fit-max-steps', type=int, default=None,
+                        help='Maximum optimizer steps when fitting each source')
+    parser.add_argument('--fit-dchisq-snr', type=float, default=None,
+                        help='Stop fitting a source when its chi-squared improvement falls below this fraction of its S/N^2')
+    parser.add_argument('--blob-cpu-budget', type=float, default=None,
+                        help='CPU seconds per blob; after that, only fit the fluxes of the remaining sources')
+    parser.add_argument('--wise-cells', type=int, default=None,
+                        help='Run unWISE forced photometry in parallel on N x N cells of the brick')
 
     parser.add_argument(
         '--check-done', default=False, action='store_true',
@@ -3473,6 +3720,12 @@ python -u legacypipe/runbrick.py --plots --brick 2440p070 --zoom 1900 2400 450 9
         '--old-calibs-ok', dest='old_calibs_ok', default=False, action='store_true',
         help='Allow old calibration files (where the data validation does not necessarily pass).')
 
+    parser.add_argument('--merge-calibs', default=False, action='store_true',
+                        help='Merge per-CCD calibration files into per-exposure files once all CCDs of an exposure are done')
+
+    parser.add_argument('--tim-spill-dir', default=None,
+                        help='Directory (eg, on local disk) to spill image pixels to, keeping them memory-mapped rather than in memory')
+
     parser.add_argument('--skip-metrics', dest='write_metrics', default=True,
                         action='store_false',
                         help='Do not generate the metrics directory and files')
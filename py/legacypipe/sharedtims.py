@@ -0,0 +1,177 @@
+'''
+Shares tim pixels (image, inverse-error and data-quality planes) with
+multiprocessing workers through one POSIX shared-memory segment per
+brick, so that blob-fitting tasks carry only small (segment, offset,
+slice) descriptors instead of pickled sub-images.
+
+(The anonymous mmap in legacypipe.internal.sharedmem is only
+inherited by processes forked after it is created; runbrick's worker
+pool is started before the tims are read, so a named segment is used
+here.)
+
+Workers see read-only views of the shared pixels (or take private
+copies, which is still much cheaper than unpickling them).  While the
+segment exists, the parent's tims also use (writable) views of it
+rather than their own copies of the pixels.
+
+This needs multiprocessing.shared_memory, new in Python 3.8; see
+*shared_memory_available*.
+'''
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.sharedtims')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# Per-process attached segment: (name, SharedMemory)
+_attached = [None, None]
+
+def shared_memory_available():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return False
+    return True
+
+def _attach(name):
+    from multiprocessing.shared_memory import SharedMemory
+    oldname,oldshm = _attached
+    if oldname == name:
+        return oldshm
+    if oldshm is not None:
+        # Only keep the most recent segment (ie, brick) mapped.
+        try:
+            oldshm.close()
+        except BufferError:
+            # views still exist; the mapping goes away with them.
+            pass
+    try:
+        shm = SharedMemory(name=name, track=False)
+    except TypeError:
+        # (python < 3.13) Attaching registers the segment with this
+        # process's resource tracker, which would unlink it when this
+        # worker exits -- or, if the tracker is the parent's, drop the
+        # parent's registration.  Only the creator registers it.
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            shm = SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+    _attached[0] = name
+    _attached[1] = shm
+    return shm
+
+class SharedPixels(object):
+    '''
+    A picklable reference to a slice of one plane in a
+    SharedTimPixels segment.
+    '''
+    def __init__(self, name, offset, shape, dtype, slc):
+        self.name = name
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.slc = slc
+
+    def get(self):
+        shm = _attach(self.name)
+        a = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf,
+                       offset=self.offset)
+        a.flags.writeable = False
+        return a[self.slc]
+
+def get_pixels(x, copy=False):
+    '''
+    Returns the pixels for *x*, which may be a SharedPixels reference
+    or a plain array (or None).  If *copy*, shared pixels are copied
+    into a private, writable array.
+    '''
+    if isinstance(x, SharedPixels):
+        x = x.get()
+        if copy:
+            x = x.copy()
+    return x
+
+class SharedTimPixels(object):
+    '''
+    Moves the pixel planes of *tims* into a new shared-memory segment:
+    the tims' planes are replaced by views of the segment, so that the
+    pixels are not held twice.  *close()* gives the tims back private
+    copies and removes the segment.
+    '''
+    planes = ['img', 'inverr', 'dq']
+    # tim attribute holding each plane
+    attrs = dict(img='data', inverr='inverr', dq='dq')
+
+    def __init__(self, tims):
+        from multiprocessing.shared_memory import SharedMemory
+        layout = []
+        offset = 0
+        for tim in tims:
+            tlayout = {}
+            for plane,a in zip(self.planes, [tim.getImage(), tim.getInvError(), tim.dq]):
+                if a is None:
+                    continue
+                tlayout[plane] = (offset, a.shape, a.dtype.str)
+                # keep planes 64-byte aligned
+                offset += (a.nbytes + 63) // 64 * 64
+            layout.append(tlayout)
+        self.shm = SharedMemory(create=True, size=max(offset, 1))
+        self.name = self.shm.name
+        self.layout = layout
+        # Copy the pixels one tim at a time, pointing each tim at the
+        # shared pixels (dropping its own copies) before moving on, so
+        # that at most one tim's pixels are held twice.
+        self.tims = tims
+        for itim,tim in enumerate(tims):
+            for plane,(off,shape,dtype) in layout[itim].items():
+                attr = self.attrs[plane]
+                dest = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=off)
+                dest[:] = getattr(tim, attr)
+                setattr(tim, attr, dest)
+        info('Placed pixels for', len(tims), 'tims in shared memory', self.name,
+             ': %.1f MB' % (offset / 1e6))
+
+    def get(self, itim, plane, slc):
+        '''
+        Returns a SharedPixels reference to the given *plane* ("img",
+        "inverr" or "dq") of tim number *itim*, sliced by *slc*; or
+        None if that tim has no such plane.
+        '''
+        p = self.layout[itim].get(plane, None)
+        if p is None:
+            return None
+        offset,shape,dtype = p
+        return SharedPixels(self.name, offset, shape, dtype, slc)
+
+    def close(self):
+        if self.shm is None:
+            return
+        # Give the tims back private copies of their pixels, one at a
+        # time, releasing the views of the segment.
+        for itim,tim in enumerate(self.tims):
+            for plane in self.layout[itim].keys():
+                attr = self.attrs[plane]
+                setattr(tim, attr, np.array(getattr(tim, attr)))
+        self.tims = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # views still exist; the mapping goes away with them.
+            pass
+        self.shm.unlink()
+        self.shm = None
+        debug('Removed shared memory', self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,146 @@
+'''
+Masks shared by the sky fits of the CCDs of one exposure.
+
+LegacySurveyImage.run_sky masks reference sources (Tycho-2, Gaia, star
+clusters, SGA galaxies) and, optionally, the blobs found in an earlier
+data release before fitting the spline sky.  Done CCD by CCD, the same
+Gaia healpixes are read once per CCD, and each brick's blob map is read
+by every CCD it touches -- for DECam, several times per exposure.
+
+ExposureSkyMasks queries the reference sources once for a footprint
+covering all of an exposure's CCDs; the parent cuts them to each CCD's
+footprint (*for_ccd*), so that each CCD's task carries only its own
+sources -- the same ones its own query would have found.  Blob maps
+are read once per process and kept (bit-packed) by *read_blob_map*.
+'''
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.skymasks')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+def exposure_wcs(wcslist, pixscale, margin=60.):
+    '''
+    Returns a Tan WCS, with pixel scale *pixscale* (arcsec), covering
+    the images *wcslist* plus *margin* arcsec.
+    '''
+    from astrometry.util.util import Tan
+    from astrometry.util.starutil_numpy import radectoxyz, xyztoradec
+    rr = []
+    dd = []
+    for wcs in wcslist:
+        H,W = wcs.shape
+        xx,yy = np.meshgrid([1., (W+1)/2., W], [1., (H+1)/2., H])
+        r,d = wcs.pixelxy2radec(xx.ravel(), yy.ravel())
+        rr.append(r)
+        dd.append(d)
+    rr = np.hstack(rr)
+    dd = np.hstack(dd)
+    xyz = np.mean(radectoxyz(rr, dd), axis=0)
+    rc,dc = xyztoradec(xyz / np.sqrt(np.sum(xyz**2)))
+    ps = pixscale / 3600.
+    wcs = Tan(rc, dc, 0., 0., -ps, 0., 0., ps, 1., 1.)
+    _,xx,yy = wcs.radec2pixelxy(rr, dd)
+    m = margin / pixscale
+    x0 = np.min(xx) - m
+    y0 = np.min(yy) - m
+    W = int(np.ceil(np.max(xx) + m - x0)) + 1
+    H = int(np.ceil(np.max(yy) + m - y0)) + 1
+    return Tan(rc, dc, 1. - x0, 1. - y0, -ps, 0., 0., ps, float(W), float(H))
+
+class ExposureSkyMasks(object):
+    '''
+    The reference sources for the sky fits of the CCDs *wcslist* of
+    one exposure.
+    '''
+    def __init__(self, survey, wcslist, pixscale, gaia=True):
+        from legacypipe.reference import get_reference_sources
+        self.pixscale = pixscale
+        self.wcs = exposure_wcs(wcslist, pixscale)
+        self.refs,_ = get_reference_sources(survey, self.wcs, pixscale, None,
+                                            tycho_stars=True, gaia_stars=gaia,
+                                            large_galaxies=True,
+                                            star_clusters=True,
+                                            clean_columns=False)
+        info('Found', (0 if self.refs is None else len(self.refs)),
+             'reference sources for', len(wcslist), 'CCDs')
+
+    def get_refs(self, wcs):
+        '''
+        Returns the reference sources affecting image *wcs*.
+        '''
+        from legacypipe.reference import cut_reference_sources
+        if self.refs is None:
+            return None
+        refs = self.refs.copy()
+        cut_reference_sources(refs, wcs, self.pixscale)
+        return refs
+
+    def for_ccd(self, wcs):
+        '''
+        Returns a copy of these masks holding only the reference sources
+        affecting CCD *wcs*, to send to that CCD's sky fit.  (*get_refs*
+        on the copy, for *wcs* or a sub-image of it, gives the same
+        sources as on the original.)
+        '''
+        import copy
+        ccd = copy.copy(self)
+        ccd.refs = self.get_refs(wcs)
+        return ccd
+
+def get_blob_mask(wcs, survey_blob_mask):
+    '''
+    Returns the boolean map of the pixels of image *wcs* that are in
+    blobs of the bricks of *survey_blob_mask*.
+    '''
+    from legacypipe.survey import bricks_touching_wcs, wcs_for_brick
+    from astrometry.util.resample import resample_with_wcs, OverlapError
+
+    bricks = bricks_touching_wcs(wcs, survey=survey_blob_mask)
+    H,W = wcs.shape
+    allblobs = np.zeros((int(H),int(W)), bool)
+    for brick in bricks:
+        fn = survey_blob_mask.find_file('blobmap',brick=brick.brickname)
+        if not os.path.exists(fn):
+            print('Warning: blob map for brick', brick.brickname,
+                  'does not exist:', fn)
+            continue
+        brickwcs = wcs_for_brick(brick)
+        try:
+            Yo,Xo,Yi,Xi,_ = resample_with_wcs(wcs, brickwcs)
+        except OverlapError:
+            continue
+        blobs = read_blob_map(fn)
+        allblobs[Yo,Xo] |= blobs[Yi,Xi]
+    return allblobs
+
+# filename -> (mtime, shape, bit-packed blob map); least-recently-used first
+_blob_maps = OrderedDict()
+# ~1.6 MB each, for 3600x3600 bricks
+MAX_BLOB_MAPS = 128
+
+def read_blob_map(fn):
+    '''
+    Returns the boolean (blob >= 0) map of blob-map file *fn*, reading
+    it once per process.
+    '''
+    import fitsio
+    mtime = os.stat(fn).st_mtime_ns
+    e = _blob_maps.pop(fn, None)
+    if e is None or e[0] != mtime:
+        blobs = (fitsio.read(fn) >= 0)
+        e = (mtime, blobs.shape, np.packbits(blobs))
+        debug('Read blob map', fn)
+    _blob_maps[fn] = e
+    while len(_blob_maps) > MAX_BLOB_MAPS:
+        _blob_maps.popitem(last=False)
+    _,shape,packed = e
+    return np.unpackbits(packed, count=shape[0]*shape[1]).reshape(shape).astype(bool)
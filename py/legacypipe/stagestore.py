@@ -0,0 +1,278 @@
+'''
+A stage-output store for runbrick, used in place of pickling the whole
+stage dictionary after each stage (see *astrometry.util.stages*).
+
+Each key of a stage's output dict is stored separately, in a
+content-addressed object directory:
+
+- the (non-array) part of each value is pickled to
+  objects/XX/SHA.pickle,
+- numpy arrays larger than *min_array_bytes* found inside the value
+  (eg, tim pixels, the blob map) are written to objects/XX/SHA.npy
+  and are memory-mapped (copy-on-write) when read back.
+
+A stage is recorded as a small index file, STAGE.index, mapping keys
+to object hashes.  Keys that a stage did not touch keep the hash from
+the prerequisite stage, and objects that already exist are not
+written again, so each stage only writes what it changed.  When
+reading, values are only unpickled when a stage asks for them.
+'''
+import os
+import pickle
+import hashlib
+from io import BytesIO
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.stagestore')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+def _array_hash(a):
+    sha = hashlib.sha1()
+    sha.update(('%s %s' % (a.dtype.str, a.shape)).encode())
+    sha.update(np.ascontiguousarray(a).reshape(-1).view(np.uint8))
+    return sha.hexdigest()
+
+class _StorePickler(pickle.Pickler):
+    def __init__(self, f, min_array_bytes):
+        super(_StorePickler, self).__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.min_array_bytes = min_array_bytes
+        # hash -> array, for arrays to be written as .npy files
+        self.arrays = {}
+        self.ids = {}
+
+    def persistent_id(self, obj):
+        if not type(obj) in (np.ndarray, np.memmap):
+            return None
+        if obj.dtype.hasobject or obj.nbytes < self.min_array_bytes:
+            return None
+        sha = self.ids.get(id(obj))
+        if sha is None:
+            sha = _array_hash(obj)
+            self.ids[id(obj)] = sha
+            self.arrays[sha] = obj
+        return ('ndarray', sha)
+
+class _StoreUnpickler(pickle.Unpickler):
+    def __init__(self, f, store):
+        super(_StoreUnpickler, self).__init__(f)
+        self.store = store
+
+    def persistent_load(self, pid):
+        kind,sha = pid
+        assert(kind == 'ndarray')
+        return self.store.load_array(sha)
+
+class StageStore(object):
+    def __init__(self, basedir, min_array_bytes=65536):
+        self.basedir = basedir
+        self.min_array_bytes = min_array_bytes
+
+    def __str__(self):
+        return 'StageStore(%s)' % self.basedir
+
+    def _object_path(self, sha, suffix):
+        return os.path.join(self.basedir, 'objects', sha[:2], sha + suffix)
+
+    def _index_path(self, stage):
+        return os.path.join(self.basedir, '%s.index' % stage)
+
+    def _write_atomic(self, fn, writefunc):
+        from astrometry.util.file import trymakedirs
+        trymakedirs(fn, dir=True)
+        tmpfn = fn + '.tmp-%i' % os.getpid()
+        with open(tmpfn, 'wb') as f:
+            writefunc(f)
+        os.rename(tmpfn, fn)
+
+    def stage_exists(self, stage):
+        return os.path.exists(self._index_path(stage))
+
+    def read_index(self, stage):
+        with open(self._index_path(stage), 'rb') as f:
+            return pickle.load(f)
+
+    def read_stage(self, stage):
+        '''
+        Returns a LazyStageDict for the given stage.
+        '''
+        return LazyStageDict(self, self.read_index(stage))
+
+    def load_array(self, sha):
+        return np.load(self._object_path(sha, '.npy'), mmap_mode='c')
+
+    def load_object(self, sha):
+        with open(self._object_path(sha, '.pickle'), 'rb') as f:
+            return _StoreUnpickler(f, self).load()
+
+    def put_object(self, obj):
+        '''
+        Stores *obj*, writing only the pieces that do not already
+        exist; returns its hash and the number of bytes written.
+        '''
+        f = BytesIO()
+        p = _StorePickler(f, self.min_array_bytes)
+        p.dump(obj)
+        data = f.getvalue()
+        del f
+        nwritten = 0
+        for sha,arr in p.arrays.items():
+            fn = self._object_path(sha, '.npy')
+            if os.path.exists(fn):
+                continue
+            self._write_atomic(fn, lambda f: np.save(f, np.asarray(arr)))
+            nwritten += arr.nbytes
+        del p
+        sha = hashlib.sha1(data).hexdigest()
+        fn = self._object_path(sha, '.pickle')
+        if not os.path.exists(fn):
+            self._write_atomic(fn, lambda f: f.write(data))
+            nwritten += len(data)
+        return sha, nwritten
+
+    def write_stage(self, stage, P, skip=None):
+        '''
+        Records the stage dict *P* (a dict or LazyStageDict) as the
+        output of *stage*.  Keys in *skip* are not stored.
+        '''
+        if skip is None:
+            skip = []
+        index = {}
+        nwritten = 0
+        for key in P.keys():
+            if key in skip:
+                continue
+            sha = None
+            if isinstance(P, LazyStageDict):
+                sha = P.stored_hash(key)
+            if sha is None:
+                sha,nw = self.put_object(P[key])
+                nwritten += nw
+                debug('Stage', stage, 'key', key, ': wrote', nw, 'bytes')
+            index[key] = sha
+        self._write_atomic(self._index_path(stage),
+                           lambda f: pickle.dump(index, f))
+        info('Wrote stage', stage, 'to', self.basedir, ':', len(index), 'keys,',
+             nwritten, 'new bytes')
+
+class LazyStageDict(object):
+    '''
+    A dict-like view of a stored stage, that unpickles values on
+    first access.
+    '''
+    def __init__(self, store, index=None):
+        self.store = store
+        # key -> hash, for values that are still as stored
+        self.index = dict(index or {})
+        self.values = {}
+
+    def keys(self):
+        return list(set(self.index.keys()).union(self.values.keys()))
+
+    def __contains__(self, key):
+        return key in self.values or key in self.index
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            sha = self.index[key]
+            debug('Loading', key, 'from', self.store)
+            self.values[key] = self.store.load_object(sha)
+        return self.values[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        self.index.pop(key, None)
+
+    def update(self, d):
+        for k,v in d.items():
+            self[k] = v
+
+    def stored_hash(self, key):
+        '''
+        Returns the stored hash of *key* if it has not been loaded or
+        replaced since it was read; None otherwise.  (Loaded values may
+        have been modified in place, so they must be re-stored.)
+        '''
+        if key in self.values:
+            return None
+        return self.index.get(key)
+
+    def subset(self, keys=None):
+        '''
+        Returns a plain dict of the given keys (all keys if None),
+        loading them as required.
+        '''
+        if keys is None:
+            keys = self.keys()
+        return dict([(k, self[k]) for k in keys if k in self])
+
+def stage_arg_names(func):
+    '''
+    Returns the list of named arguments of a stage function.
+    '''
+    import inspect
+    return [name for name,p in inspect.signature(func).parameters.items()
+            if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)]
+
+def runstage(stage, store, stagefunc, force=None, forceall=False, prereqs=None,
+             write=True, initial_args=None, stage_args=None, **kwargs):
+    '''
+    Like *astrometry.util.stages.runstage*, but reading and writing a
+    StageStore rather than a pickle file per stage.
+
+    *stage_args*: if not None, a function returning the list of
+    argument names for a given stage; only those values are loaded and
+    passed to *stagefunc*.
+    '''
+    if force is None:
+        force = []
+    if prereqs is None:
+        prereqs = {}
+    if initial_args is None:
+        initial_args = {}
+
+    if store.stage_exists(stage):
+        if forceall or stage in force:
+            info('Ignoring stored stage', stage, 'and forcing it to run')
+        else:
+            info('Reading stage', stage, 'from', store)
+            P = store.read_stage(stage)
+            P.update(kwargs)
+            return P
+
+    prereq = prereqs.get(stage, None)
+    if prereq is None:
+        P = LazyStageDict(store)
+        P.update(initial_args)
+    else:
+        P = runstage(prereq, store, stagefunc, force=force, forceall=forceall,
+                     prereqs=prereqs, write=write, initial_args=initial_args,
+                     stage_args=stage_args, **kwargs)
+    P.update(kwargs)
+
+    names = None
+    if stage_args is not None:
+        names = stage_args(stage)
+    info('Running stage', stage)
+    R = stagefunc(stage, **P.subset(names))
+    info('Stage', stage, 'finished')
+    if R is not None:
+        P.update(R)
+
+    if write is True or (type(write) in [list, tuple] and stage in write):
+        store.write_stage(stage, P, skip=kwargs.keys())
+    return P
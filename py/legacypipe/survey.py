@@ -490,19 +490,79 @@ def get_dependency_versions(unwise_dir, unwise_tr_dir, unwise_modelsky_dir, gale
         headers.append(('DEPVER%02i' % i, value, ''))
     return headers
 
-def tim_get_resamp(tim, targetwcs):
+class ResampleMap(object):
+    '''
+    A pixel mapping between two WCSes, as computed by
+    *resample_with_wcs(outwcs, inwcs)*: output pixels (Yo,Xo) take
+    their values from input pixels (Yi,Xi).  The index arrays are
+    stored as int16.
+    '''
+    def __init__(self, Yo, Xo, Yi, Xi):
+        self.Yo = Yo.astype(np.int16)
+        self.Xo = Xo.astype(np.int16)
+        self.Yi = Yi.astype(np.int16)
+        self.Xi = Xi.astype(np.int16)
+
+    def __len__(self):
+        return len(self.Yo)
+
+    def indices(self):
+        return self.Yo, self.Xo, self.Yi, self.Xi
+
+def tim_resample_lanczos(tim, targetwcs, imgs):
+    '''
+    Lanczos3-resamples the *tim*-shaped images *imgs* into *targetwcs*;
+    returns (Yo,Xo,Yi,Xi,rimgs) as resample_with_wcs does, or None if
+    they do not overlap.
+
+    This is not cached: resample_with_wcs takes the sub-pixel offsets
+    from its spline-interpolated coordinates, and recomputing them
+    from the exact WCS would change the resampled pixels.
+    '''
     from astrometry.util.resample import resample_with_wcs,OverlapError
+    try:
+        Yo,Xo,Yi,Xi,rimgs = resample_with_wcs(
+            targetwcs, tim.subwcs, imgs, 3, intType=np.int16)
+    except OverlapError:
+        return None
+    if len(Yo) == 0:
+        return None
+    return Yo,Xo,Yi,Xi,rimgs
 
-    if hasattr(tim, 'resamp'):
-        return tim.resamp
+def compute_resamp_map(outwcs, inwcs):
+    '''
+    Computes a ResampleMap from *inwcs* into *outwcs*, or returns None
+    if they do not overlap.
+    '''
+    from astrometry.util.resample import resample_with_wcs,OverlapError
     try:
-        Yo,Xo,Yi,Xi,_ = resample_with_wcs(targetwcs, tim.subwcs, intType=np.int16)
+        Yo,Xo,Yi,Xi,_ = resample_with_wcs(outwcs, inwcs, intType=np.int16)
     except OverlapError:
-        debug('No overlap between tim', tim.name, 'and target WCS')
         return None
     if len(Yo) == 0:
         return None
-    return Yo,Xo,Yi,Xi
+    return ResampleMap(Yo, Xo, Yi, Xi)
+
+def tim_get_resamp_map(tim, targetwcs, reverse=False):
+    '''
+    Returns the ResampleMap from *tim* into *targetwcs*, or from
+    *targetwcs* into *tim* if *reverse*; None if they do not overlap.
+    '''
+    if reverse:
+        R = compute_resamp_map(tim.subwcs, targetwcs)
+    else:
+        R = compute_resamp_map(targetwcs, tim.subwcs)
+    if R is None:
+        debug('No overlap between tim', tim.name, 'and target WCS')
+    return R
+
+def tim_get_resamp(tim, targetwcs):
+    if hasattr(tim, 'resamp'):
+        return tim.resamp
+    R = tim_get_resamp_map(tim, targetwcs)
+    if R is None:
+        return None
+    return R.indices()
 
 
 def sdss_rgb(imgs, bands, scales=None, m=0.03, Q=20, mnmx=None):
@@ -624,6 +684,53 @@ def bricks_touching_wcs(targetwcs, survey=None, B=None, margin=20):
         keep.append(i)
     return B[np.array(keep)]
 
+# Columns of CCD corner RA,Dec (len(ccds) x 4), precomputed by
+# add_ccd_corners (and stored in the survey-ccds kd-tree files).
+CCD_CORNER_COLUMNS = ['corner_ra', 'corner_dec']
+
+def ccd_corners(ccds):
+    '''
+    Computes the RA,Dec of the corners of the CCDs in table *ccds*, from
+    their TAN WCS header columns.  Returns (ra, dec), each
+    len(ccds) x 4, for the pixel corners (0.5,0.5), (W+0.5,0.5),
+    (W+0.5,H+0.5), (0.5,H+0.5).
+    '''
+    W = ccds.width.astype(np.float64)[:,np.newaxis]
+    H = ccds.height.astype(np.float64)[:,np.newaxis]
+    zero = np.zeros_like(W)
+    x = 0.5 + np.hstack((zero, W, W, zero))
+    y = 0.5 + np.hstack((zero, zero, H, H))
+    dx = x - ccds.crpix1[:,np.newaxis]
+    dy = y - ccds.crpix2[:,np.newaxis]
+    # intermediate world coordinates (radians)
+    xi  = np.deg2rad(ccds.cd1_1[:,np.newaxis] * dx + ccds.cd1_2[:,np.newaxis] * dy)
+    eta = np.deg2rad(ccds.cd2_1[:,np.newaxis] * dx + ccds.cd2_2[:,np.newaxis] * dy)
+    # gnomonic projection about (crval1, crval2)
+    ra0  = np.deg2rad(ccds.crval1.astype(np.float64))[:,np.newaxis]
+    dec0 = np.deg2rad(ccds.crval2.astype(np.float64))[:,np.newaxis]
+    den = np.cos(dec0) - eta * np.sin(dec0)
+    ra = np.rad2deg(ra0 + np.arctan2(xi, den)) % 360.
+    dec = np.rad2deg(np.arctan2(np.sin(dec0) + eta * np.cos(dec0),
+                                np.hypot(xi, den)))
+    return ra, dec
+
+def add_ccd_corners(ccds):
+    '''
+    Adds the CCD_CORNER_COLUMNS to table *ccds* (if not already there).
+    '''
+    if not 'corner_ra' in ccds.get_columns():
+        ccds.corner_ra, ccds.corner_dec = ccd_corners(ccds)
+    return ccds
+
+def drop_ccd_corners(ccds):
+    '''
+    Removes the CCD_CORNER_COLUMNS from table *ccds* (if there).
+    '''
+    for c in CCD_CORNER_COLUMNS:
+        if c in ccds.get_columns():
+            ccds.delete_column(c)
+    return ccds
+
 def ccds_touching_wcs(targetwcs, ccds, ccdrad=None, polygons=True):
     '''
     targetwcs: wcs object describing region of interest
@@ -633,10 +740,10 @@ def ccds_touching_wcs(targetwcs, ccds, ccdrad=None, polygons=True):
     If None (the default), compute from the CCDs table.
     (0.17 for DECam)
 
+    Uses the CCD corner columns (see add_ccd_corners) if present.
+
     Returns: index array I of CCDs within range.
     '''
-    from astrometry.util.util import Tan
-    from astrometry.util.miscutils import polygons_intersect
     from astrometry.util.starutil_numpy import degrees_between
 
     trad = targetwcs.radius()
@@ -649,37 +756,44 @@ def ccds_touching_wcs(targetwcs, ccds, ccdrad=None, polygons=True):
     r,d = targetwcs.radec_center()
     I, = np.where(np.abs(ccds.dec - d) < rad)
     I = I[np.where(degrees_between(r, d, ccds.ra[I], ccds.dec[I]) < rad)[0]]
-    if not polygons:
+    if not polygons or len(I) == 0:
         return I
-    # now check actual polygon intersection
+    # now check actual polygon intersection, in the target's pixel space
+    if 'corner_ra' in ccds.get_columns():
+        cra,cdec = ccds.corner_ra[I], ccds.corner_dec[I]
+    else:
+        cra,cdec = ccd_corners(ccds[I])
+    _,xx,yy = targetwcs.radec2pixelxy(cra.ravel(), cdec.ravel())
+    poly = np.dstack((np.reshape(xx, cra.shape), np.reshape(yy, cra.shape)))
     tw,th = targetwcs.imagew, targetwcs.imageh
-    targetpoly = [(0.5,0.5),(tw+0.5,0.5),(tw+0.5,th+0.5),(0.5,th+0.5)]
-    cd = targetwcs.get_cd()
-    tdet = cd[0]*cd[3] - cd[1]*cd[2]
-    if tdet > 0:
-        targetpoly = list(reversed(targetpoly))
-    targetpoly = np.array(targetpoly)
+    keep = polygons_intersect_box(poly, 0.5, tw+0.5, 0.5, th+0.5)
+    return I[keep]
 
-    keep = []
-    for i in I:
-        W,H = ccds.width[i],ccds.height[i]
-        wcs = Tan(*[float(x) for x in
-                    [ccds.crval1[i], ccds.crval2[i], ccds.crpix1[i], ccds.crpix2[i],
-                     ccds.cd1_1[i], ccds.cd1_2[i], ccds.cd2_1[i], ccds.cd2_2[i], W, H]])
-        cd = wcs.get_cd()
-        wdet = cd[0]*cd[3] - cd[1]*cd[2]
-        poly = []
-        for x,y in [(0.5,0.5),(W+0.5,0.5),(W+0.5,H+0.5),(0.5,H+0.5)]:
-            rr,dd = wcs.pixelxy2radec(x,y)
-            _,xx,yy = targetwcs.radec2pixelxy(rr,dd)
-            poly.append((xx,yy))
-        if wdet > 0:
-            poly = list(reversed(poly))
-        poly = np.array(poly)
-        if polygons_intersect(targetpoly, poly):
-            keep.append(i)
-    I = np.array(keep)
-    return I
+def polygons_intersect_box(polys, x0, x1, y0, y1):
+    '''
+    Separating-axis test for a batch of convex quadrilaterals *polys*
+    (N x 4 x 2, vertices in order, either winding) against the box
+    [x0,x1] x [y0,y1].  Returns a boolean array, True where they
+    intersect (or touch).
+    '''
+    px = polys[:,:,0]
+    py = polys[:,:,1]
+    # The box's axes
+    sep = ((px.min(axis=1) > x1) | (px.max(axis=1) < x0) |
+           (py.min(axis=1) > y1) | (py.max(axis=1) < y0))
+    # The polygons' edge normals
+    ex = np.roll(px, -1, axis=1) - px
+    ey = np.roll(py, -1, axis=1) - py
+    # projections of the polygons' vertices: N x edges x vertices
+    pp = (-ey[:,:,np.newaxis] * px[:,np.newaxis,:] +
+           ex[:,:,np.newaxis] * py[:,np.newaxis,:])
+    bx = np.array([x0, x1, x1, x0])
+    by = np.array([y0, y0, y1, y1])
+    bp = (-ey[:,:,np.newaxis] * bx[np.newaxis,np.newaxis,:] +
+           ex[:,:,np.newaxis] * by[np.newaxis,np.newaxis,:])
+    sep |= np.any((pp.min(axis=2) > bp.max(axis=2)) |
+                  (pp.max(axis=2) < bp.min(axis=2)), axis=1)
+    return np.logical_not(sep) * np.all(np.isfinite(polys), axis=(1,2))
 
 def create_temp(**kwargs):
     f,fn = tempfile.mkstemp(dir=tempdir, **kwargs)
@@ -775,6 +889,10 @@ class LegacySurveyData(object):
         # - initially None, then a list of (fn, kd)
         self.ccd_kdtrees = None
 
+        # Columnar CCDs index (legacypipe.ccdindex) --
+        # - initially None, then a CCDIndex, or False if there is none
+        self.ccd_index = None
+
         self.image_typemap = {
             'decam'  : DecamImage,
             'decam+noise'  : DecamImage,
@@ -868,6 +986,9 @@ class LegacySurveyData(object):
             return swaplist(
                 glob(os.path.join(basedir, 'survey-ccds*.kd.fits')))
 
+        elif filetype == 'ccd-index':
+            return swap(os.path.join(basedir, 'survey-ccds-index'))
+
         elif filetype == 'tycho2':
             dirnm = os.environ.get('TYCHO2_KD_DIR')
             if dirnm is not None:
@@ -1321,6 +1442,18 @@ class LegacySurveyData(object):
         '''
         Returns the table of CCDs.
         '''
+        index = self.get_ccd_index()
+        if index:
+            columns = kwargs.get('columns')
+            if columns is None:
+                columns = [c for c in index.columns if not c in CCD_CORNER_COLUMNS]
+            rows = kwargs.get('rows')
+            if rows is not None:
+                rows = index.rows()[rows]
+            T = index.table(rows=rows, columns=columns)
+            debug('Read', len(T), 'CCDs from index', index.dirname)
+            return T
+
         fns = self.find_file('ccd-kds')
         fns = self.filter_ccd_kd_files(fns)
         # If 'ccd-kds' files exist, read the CCDs tables from them!
@@ -1336,7 +1469,18 @@ class LegacySurveyData(object):
         TT = []
         for fn in fns:
             debug('Reading CCDs from', fn)
-            T = fits_table(fn, **kwargs)
+            kw = kwargs
+            if kwargs.get('columns') is None:
+                # Skip the CCD corners stored in the kd-tree files
+                # (ccds_touching_wcs computes them only for the CCDs
+                # it needs them for).
+                import fitsio
+                cols = fitsio.FITS(fn)[1].get_colnames()
+                if any([c.lower() in CCD_CORNER_COLUMNS for c in cols]):
+                    kw = kwargs.copy()
+                    kw.update(columns=[c for c in cols
+                                       if not c.lower() in CCD_CORNER_COLUMNS])
+            T = fits_table(fn, **kw)
             debug('Got', len(T), 'CCDs')
             TT.append(T)
         if len(TT) > 1:
@@ -1382,9 +1526,18 @@ class LegacySurveyData(object):
         '''
         Returns a table of the CCDs touching the given *wcs* region.
         '''
-        kdfns = self.get_ccd_kdtrees()
+        index = self.get_ccd_index()
+        kdfns = [] if index else self.get_ccd_kdtrees()
 
-        if len(kdfns):
+        if index:
+            # Same MAGIC 1-degree search radius as below.
+            ra,dec = wcs.radec_center()
+            I = index.search_radec(ra, dec, 1.)
+            debug(len(I), 'CCDs within 1 deg of RA,Dec', '(%.3f, %.3f)' % (ra,dec))
+            if len(I) == 0:
+                return None
+            ccds = index.table(rows=I)
+        elif len(kdfns):
             from astrometry.libkd.spherematch import tree_search_radec
             # MAGIC number: we'll search a 1-degree radius for CCDs
             # roughly in range, then refine using the
@@ -1409,7 +1562,44 @@ class LegacySurveyData(object):
         I = ccds_touching_wcs(wcs, ccds, **kwargs)
         if len(I) == 0:
             return None
-        return ccds[I]
+        return drop_ccd_corners(ccds[I])
+
+    def get_ccd_index(self):
+        '''
+        Returns the CCDIndex for this survey (from
+        legacypipe/create_ccd_index.py), or False if there is none.
+
+        The index stands in for both the survey-ccds files and their
+        kd-trees, so the names of the files it was made from go through
+        both filter_ccds_files and filter_ccd_kd_files, and the index
+        is restricted to the rows from the files that pass; if none
+        pass (eg, runccd's no_kd), the index is not used.
+        '''
+        if self.ccd_index is None:
+            fn = self.find_file('ccd-index')
+            if os.path.isdir(fn):
+                from legacypipe.ccdindex import CCDIndex
+                debug('Using CCDs index', fn)
+                self.ccd_index = CCDIndex(fn)
+            else:
+                self.ccd_index = False
+        index = self.ccd_index
+        if not index:
+            return index
+        if index.files is None:
+            # An index that does not record its files: use it only if
+            # this survey does not select among the files.
+            cls = type(self)
+            if (cls.filter_ccds_files is not LegacySurveyData.filter_ccds_files or
+                cls.filter_ccd_kd_files is not LegacySurveyData.filter_ccd_kd_files):
+                debug('Not using CCDs index', index.dirname, 'without its file names')
+                return False
+            return index
+        files = self.filter_ccd_kd_files(self.filter_ccds_files(list(index.files)))
+        if len(files) == 0:
+            return False
+        index.select_files(files)
+        return index
 
     def get_ccd_kdtrees(self):
         # check cache...
@@ -1481,6 +1671,21 @@ class LegacySurveyData(object):
         number, integer), *ccdname* (string), and *camera* (string),
         if given.
         '''
+        index = self.get_ccd_index()
+        if index and (expnum is not None or ccdname is not None or camera is not None):
+            # Read the expnum rows, or only the columns we select on.
+            if expnum is not None:
+                I = index.expnum_rows(expnum)
+                if len(I) == 0:
+                    return None
+            else:
+                I = index.rows()
+            for val,col in [(ccdname,'ccdname'), (camera,'camera')]:
+                if val is not None:
+                    I = I[index.column(col)[I] == val]
+            return index.table(rows=I, columns=[c for c in index.columns
+                                                if not c in CCD_CORNER_COLUMNS])
+
         if expnum is not None:
             C = self.try_expnum_kdtree(expnum)
             if C is not None:
@@ -1533,6 +1738,11 @@ class LegacySurveyData(object):
         > fitsgetext -i ekd.fits -o ekd-%02i -a -M
         > cat dr7-0* ekd-0[123456] > $CSCRATCH/dr7-depthcut+/survey-ccds-dr7.kd.fits
         '''
+        index = self.get_ccd_index()
+        if index:
+            I = index.expnum_rows(expnum)
+            return index.table(rows=I, columns=[c for c in index.columns
+                                                if not c in CCD_CORNER_COLUMNS])
         fns = self.find_file('ccd-kds')
         fns = self.filter_ccd_kd_files(fns)
         if len(fns) == 0:
@@ -1561,16 +1771,19 @@ class LegacySurveyData(object):
             return fits_table()
         ccds = merge_tables(TT, columns='fillzero')
         ccds = self.cleanup_ccds_table(ccds)
-        return ccds
+        return drop_ccd_corners(ccds)
 
 
 def run_calibs(X):
+    from legacypipe.calibservice import calib_service
     im = X[0]
-    kwargs = X[1]
+    kwargs = X[1].copy()
     noraise = kwargs.pop('noraise', False)
+    merge = kwargs.pop('merge_calibs', False)
     debug('run_calibs for image', im, ':', kwargs)
     try:
-        return im.run_calibs(**kwargs)
+        # (locked per CCD against other processes building the same calibs)
+        return calib_service.run(im, kwargs, merge=merge)
     except:
         print('Exception in run_calibs:', im, kwargs)
         import traceback
@@ -1581,10 +1794,16 @@ def run_calibs(X):
 def read_one_tim(X):
     from astrometry.util.ttime import Time
     (im, targetrd, kwargs) = X
+    kwargs = kwargs.copy()
+    # Spill the pixels to this directory? (see legacypipe.timspill)
+    spill_dir = kwargs.pop('spill_dir', None)
     t0 = Time()
     tim = im.get_tractor_image(radecpoly=targetrd, **kwargs)
     if tim is not None:
         th,tw = tim.shape
         print('Time to read %i x %i image, hdu %i:' % (tw,th, im.hdu), Time()-t0)
+        if spill_dir is not None:
+            from legacypipe.timspill import spill_tim
+            spill_tim(tim, spill_dir, '%s-%s-%s' % (im.camera, im.expnum, im.ccdname))
     return tim
 
@@ -0,0 +1,301 @@
+'''
+A per-node cache of the unWISE and GALEX tiles that cutouts are read from.
+
+Neighbouring bricks (and the several processes of one node working on
+bricks together) read overlapping cutouts of the same 2048^2 or 3840^2
+tiles, often gzipped, from a network filesystem.  TileCutoutCache keeps
+each tile HDU it reads as a .npy file in a local directory, named by
+the hash of (tile file, HDU, file size and mtime) -- so the tile, band
+and epoch are part of the key through the file name -- and cuts every
+later cutout of that tile out of the (memory-mapped) cached copy.
+
+Readers that want whole files rather than cutouts (eg, the unWISE
+tile reader, get_unwise_tractor_image) are instead pointed at local
+copies of the files, made by *fetch_files*.
+
+Processes sharing the directory coordinate with file locks: the first
+to miss a tile reads it while the others wait for it, files appear
+atomically, and the least-recently-used tiles are removed when the
+directory grows beyond its byte budget.  Temporary files left behind by
+writers that died are removed too.
+
+The cache is enabled by setting $TILE_CACHE_DIR (eg, to a node-local
+/tmp directory); $TILE_CACHE_MB sets its budget (default 4000).
+
+Small tables that would otherwise be parsed once per brick (eg, the
+unWISE time-resolved atlas) are kept per process by *read_table*.
+'''
+import os
+import re
+import shutil
+import hashlib
+
+import numpy as np
+
+from legacypipe.utils import FileLock
+
+import logging
+logger = logging.getLogger('legacypipe.tilecache')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+class TileCutoutCache(object):
+    '''
+    A cache of tiles, for reading cutouts, in directory *cachedir*,
+    bounded by *maxbytes*, and safe to share between processes.
+    '''
+    def __init__(self, cachedir, maxbytes):
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, fn, ext):
+        st = os.stat(fn)
+        s = '%s %s %i %i' % (os.path.abspath(fn), ext, st.st_size, st.st_mtime_ns)
+        return hashlib.sha1(s.encode()).hexdigest()
+
+    def read(self, fn, ext, y0, y1, x0, x1):
+        '''
+        Returns the cutout [y0:y1, x0:x1] of HDU *ext* of FITS file *fn*.
+        '''
+        path = os.path.join(self.cachedir, self.key(fn, ext) + '.npy')
+        img = self._load(path, y0, y1, x0, x1)
+        if img is not None:
+            self.hits += 1
+            return img
+        with FileLock(path + '.lock'):
+            # Another process may have read it while we waited.
+            img = self._load(path, y0, y1, x0, x1)
+            if img is not None:
+                self.hits += 1
+                return img
+            self.misses += 1
+            tile = _read_tile(fn, ext)
+            tmpfn = '%s.tmp-%i' % (path, os.getpid())
+            with open(tmpfn, 'wb') as f:
+                np.save(f, tile)
+            os.rename(tmpfn, path)
+            debug('Cached tile', fn, 'ext', ext, 'in', path)
+        img = tile[y0:y1, x0:x1].copy()
+        del tile
+        self.evict()
+        return img
+
+    def fetch_files(self, fns, subdir):
+        '''
+        Copies the files *fns* into directory *subdir* of a cache
+        entry (keyed by their names, sizes and mtimes), if not there
+        already; returns the entry's directory.
+        '''
+        keys = []
+        for fn in sorted(fns):
+            st = os.stat(fn)
+            keys.append('%s %i %i' % (os.path.abspath(fn), st.st_size, st.st_mtime_ns))
+        key = hashlib.sha1((subdir + ' ' + ' '.join(keys)).encode()).hexdigest()
+        path = os.path.join(self.cachedir, key + '.d')
+        if self._touch(path):
+            self.hits += 1
+            return path
+        with FileLock(path + '.lock'):
+            if self._touch(path):
+                self.hits += 1
+                return path
+            self.misses += 1
+            tmpdir = '%s.tmp-%i' % (path, os.getpid())
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            os.makedirs(os.path.join(tmpdir, subdir))
+            for fn in fns:
+                shutil.copyfile(fn, os.path.join(tmpdir, subdir, os.path.basename(fn)))
+            os.rename(tmpdir, path)
+            debug('Cached', len(fns), 'files in', path)
+        self.evict()
+        return path
+
+    def _touch(self, path):
+        # Marks cache entry *path* as recently used; returns False if it
+        # does not exist.
+        try:
+            os.utime(path)
+        except OSError:
+            return False
+        return True
+
+    def _load(self, path, y0, y1, x0, x1):
+        try:
+            tile = np.load(path, mmap_mode='r')
+            img = np.array(tile[y0:y1, x0:x1])
+        except (IOError, OSError, ValueError):
+            return None
+        del tile
+        self._touch(path)
+        return img
+
+    def evict(self):
+        '''
+        Removes temporary files of writers that are no longer running,
+        then least-recently-used entries until the cache is within its
+        byte budget.
+
+        Lock files are left alone: another process may hold (or be
+        waiting for) the lock, and removing the file would let a third
+        process lock a new file of the same name.
+        '''
+        with FileLock(os.path.join(self.cachedir, 'evict.lock')):
+            files = []
+            total = 0
+            nstale = 0
+            for fn in os.listdir(self.cachedir):
+                path = os.path.join(self.cachedir, fn)
+                m = re.match(r'.*\.tmp-(\d+)$', fn)
+                if m is not None:
+                    if _pid_running(int(m.group(1))):
+                        total += _disk_usage(path)
+                    else:
+                        _remove(path)
+                        nstale += 1
+                    continue
+                if not (fn.endswith('.npy') or fn.endswith('.d')):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                size = _disk_usage(path)
+                files.append((st.st_mtime, size, path))
+                total += size
+            if nstale:
+                info('Removed', nstale, 'stale temporary files from tile cache', self.cachedir)
+            files.sort()
+            for _,size,path in files:
+                if total <= self.maxbytes:
+                    break
+                _remove(path)
+                total -= size
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, cachedir=self.cachedir,
+                    maxbytes=self.maxbytes)
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # eg, PermissionError: it exists but is not ours
+        pass
+    return True
+
+def _disk_usage(path):
+    # Bytes in file or directory *path*.
+    if not os.path.isdir(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+    total = 0
+    for dirpath,_,fns in os.walk(path):
+        for fn in fns:
+            try:
+                total += os.stat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return total
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _read_cutout(fn, ext, y0, y1, x0, x1):
+    import fitsio
+    return fitsio.FITS(fn)[ext][y0:y1, x0:x1]
+
+def _read_tile(fn, ext):
+    import fitsio
+    return fitsio.read(fn, ext=ext)
+
+_tile_cache = None
+
+def get_tile_cache():
+    '''
+    Returns this process's TileCutoutCache, or None if $TILE_CACHE_DIR
+    is not set.
+    '''
+    global _tile_cache
+    cachedir = os.environ.get('TILE_CACHE_DIR')
+    if not cachedir:
+        return None
+    if _tile_cache is None or _tile_cache.cachedir != cachedir:
+        maxbytes = int(float(os.environ.get('TILE_CACHE_MB', 4000)) * 1e6)
+        try:
+            _tile_cache = TileCutoutCache(cachedir, maxbytes)
+        except OSError as e:
+            info('Failed to create tile cache directory', cachedir, ':', e)
+            return None
+    return _tile_cache
+
+def read_cutout(fn, ext, y0, y1, x0, x1):
+    '''
+    Returns the cutout [y0:y1, x0:x1] of HDU *ext* of FITS file *fn*,
+    through the node's tile cache if there is one.
+    '''
+    cache = get_tile_cache()
+    if cache is not None:
+        try:
+            return cache.read(fn, ext, y0, y1, x0, x1)
+        except OSError as e:
+            info('Tile cache failed for', fn, ':', e)
+    return _read_cutout(fn, ext, y0, y1, x0, x1)
+
+def fetch_files(fns, subdir):
+    '''
+    Returns a directory containing the files *fns* under *subdir*:
+    a local copy in the node's tile cache if there is one (and the copy
+    succeeds), or None.
+    '''
+    cache = get_tile_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.fetch_files(fns, subdir)
+    except OSError as e:
+        info('Tile cache failed for', subdir, ':', e)
+    return None
+
+# (filename, ext) -> (mtime, value)
+_table_memo = {}
+_header_memo = {}
+
+def _memoized(memo, fn, ext, reader):
+    mtime = os.stat(fn).st_mtime_ns
+    e = memo.get((fn, ext))
+    if e is None or e[0] != mtime:
+        e = (mtime, reader())
+        memo[(fn, ext)] = e
+    return e[1]
+
+def read_table(fn, ext=1):
+    '''
+    Reads the FITS table *fn* once per process; returns a copy that the
+    caller may modify.
+    '''
+    from astrometry.util.fits import fits_table
+    return _memoized(_table_memo, fn, ext, lambda: fits_table(fn, ext=ext)).copy()
+
+def read_header(fn, ext=0):
+    '''
+    Reads the FITS header of HDU *ext* of *fn* once per process.
+    '''
+    import fitsio
+    return _memoized(_header_memo, fn, ext, lambda: fitsio.read_header(fn, ext=ext))
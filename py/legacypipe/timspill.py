@@ -0,0 +1,80 @@
+'''
+Spills the pixels of tims (tractor Images) to local disk.
+
+From stage_tims onward, runbrick keeps every tim's image, inverse-error
+and DQ arrays in memory; for deep bricks with hundreds of CCDs these
+dominate the peak memory.  With a spill directory (runbrick
+--tim-spill-dir, eg on node-local disk), read_one_tim writes each tim's
+pixels there once they are read and calibrated, and sends back to
+stage_tims small SpilledPixels placeholders in their place; stage_tims
+replaces these by copy-on-write memory maps of the files.
+
+Pixels are then read from disk when first used, and stages that use
+only parts of the images (eg, the blob cutouts for fitting) touch only
+those pages; untouched and unmodified pages can be dropped by the OS
+under memory pressure.  In-place changes (eg, outlier masking) stay in
+memory and do not change the files.  The files are unlinked once
+mapped, so the disk space is freed with the tims.
+'''
+import os
+
+import numpy as np
+
+import logging
+logger = logging.getLogger('legacypipe.timspill')
+def info(*args):
+    from legacypipe.utils import log_info
+    log_info(logger, args)
+def debug(*args):
+    from legacypipe.utils import log_debug
+    log_debug(logger, args)
+
+# tim attributes holding pixel arrays
+SPILL_ATTRS = ['data', 'inverr', 'dq']
+
+class SpilledPixels(object):
+    '''
+    Placeholder for a pixel array written to .npy file *fn*.
+    '''
+    def __init__(self, fn, shape, dtype):
+        self.fn = fn
+        self.shape = shape
+        self.dtype = dtype
+
+    def __str__(self):
+        return 'SpilledPixels(%s, %s, %s)' % (self.fn, self.shape, self.dtype)
+
+    def load(self):
+        a = np.load(self.fn, mmap_mode='c')
+        assert(a.shape == self.shape)
+        # The mapping stays valid after the file is unlinked.
+        os.remove(self.fn)
+        return a.view(np.ndarray)
+
+def spill_tim(tim, spilldir, name):
+    '''
+    Writes the pixel arrays of *tim* to files in *spilldir* (prefixed
+    *name*), replacing them by SpilledPixels; returns *tim*.
+    '''
+    for attr in SPILL_ATTRS:
+        a = getattr(tim, attr, None)
+        if not isinstance(a, np.ndarray):
+            continue
+        fn = os.path.join(spilldir, '%s-%s.npy' % (name, attr))
+        tmpfn = fn + '.tmp'
+        with open(tmpfn, 'wb') as f:
+            np.save(f, a)
+        os.rename(tmpfn, fn)
+        setattr(tim, attr, SpilledPixels(fn, a.shape, a.dtype))
+    return tim
+
+def map_spilled_tim(tim):
+    '''
+    Replaces the SpilledPixels of *tim* by memory maps of their files;
+    returns *tim*.
+    '''
+    for attr in SPILL_ATTRS:
+        a = getattr(tim, attr, None)
+        if isinstance(a, SpilledPixels):
+            setattr(tim, attr, a.load())
+    return tim
@@ -6,6 +6,8 @@ from astrometry.util.ttime import Time
 
 from wise.unwise import get_unwise_tractor_image
 
+from legacypipe.tilecache import read_cutout, fetch_files, get_tile_cache
+
 import logging
 logger = logging.getLogger('legacypipe.unwise')
 def info(*args):
@@ -15,6 +17,30 @@ def debug(*args):
     from legacypipe.utils import log_debug
     log_debug(logger, args)
 
+def cached_unwise_dir(unwise_dir, coadd_id, band):
+    '''
+    Returns an unWISE coadd directory to pass to
+    get_unwise_tractor_image for tile *coadd_id*, band *band*: a copy
+    of the tile's (masked) files in the node's tile cache, if there is
+    one; else *unwise_dir* (which may be a colon-separated list).
+    '''
+    if get_tile_cache() is None:
+        return unwise_dir
+    tiledir = os.path.join(coadd_id[:3], coadd_id)
+    for basedir in unwise_dir.split(':'):
+        fns = [os.path.join(basedir, tiledir, 'unwise-%s-w%i-%s' % (coadd_id, band, f))
+               for f in ['img-m.fits', 'invvar-m.fits.gz', 'std-m.fits.gz',
+                         'n-m.fits.gz', 'n-u.fits.gz']]
+        fns = [fn for fn in fns if os.path.exists(fn)]
+        if len(fns) == 0 or not fns[0].endswith('img-m.fits'):
+            # get_unwise_tractor_image would try the next directory
+            continue
+        cached = fetch_files(fns, tiledir)
+        if cached is None:
+            break
+        return cached
+    return unwise_dir
+
 '''
 This function was imported whole from the tractor repo:
 wise/forcedphot.py because I figured we were doing enough
@@ -28,13 +54,17 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                       pixelized_psf=False,
                       get_masks=None,
                       move_crpix=False,
-                      modelsky_dir=None):
+                      modelsky_dir=None,
+                      fit_region=None):
     '''
     Given a list of tractor sources *cat*
     and a list of unWISE tiles *tiles* (a fits_table with RA,Dec,coadd_id)
     runs forced photometry, returning a FITS table the same length as *cat*.
 
     *get_masks*: the WCS to resample mask bits into.
+
+    *fit_region*: (wcs, x0, x1, y0, y1): fit only the image pixels
+    within this rectangle of (0-based) pixels of *wcs* (see UnwiseCells).
     '''
     from tractor import PointSource, Tractor, ExpGalaxy, DevGalaxy
     from tractor.sersic import SersicGalaxy
@@ -83,7 +113,8 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
     tims = []
     for tile in tiles:
         info('Reading WISE tile', tile.coadd_id, 'band', band)
-        tim = get_unwise_tractor_image(tile.unwise_dir, tile.coadd_id, band,
+        tim = get_unwise_tractor_image(cached_unwise_dir(tile.unwise_dir, tile.coadd_id, band),
+                                       tile.coadd_id, band,
                                        bandname=wanyband, roiradecbox=roiradecbox)
         if tim is None:
             debug('Actually, no overlap with WISE coadd tile', tile.coadd_id)
@@ -120,7 +151,7 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             if not os.path.exists(fn):
                 raise RuntimeError('WARNING: does not exist:', fn)
             x0,x1,y0,y1 = tim.roi
-            bg = fitsio.FITS(fn)[2][y0:y1, x0:x1]
+            bg = read_cutout(fn, 2, y0, y1, x0, x1)
             assert(bg.shape == tim.shape)
 
             if plots:
@@ -203,7 +234,7 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
                 if os.path.exists(fn):
                     debug('Reading unWISE mask file', fn)
                     x0,x1,y0,y1 = tim.roi
-                    tilemask = fitsio.FITS(fn)[0][y0:y1,x0:x1]
+                    tilemask = read_cutout(fn, 0, y0, y1, x0, x1)
                     break
             if tilemask is None:
                 info('unWISE mask file for tile', tile.coadd_id, 'does not exist')
@@ -251,6 +282,14 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             du = binary_dilation(unique)
             tim.coadd_inverr = tim.inverr * du
         tim.inverr[unique == False] = 0.
+        if fit_region is not None:
+            rwcs,rx0,rx1,ry0,ry1 = fit_region
+            _,rx,ry = rwcs.radec2pixelxy(rr, dd)
+            rx -= 1.
+            ry -= 1.
+            tim.inverr[np.logical_not((rx >= rx0) * (rx < rx1) *
+                                      (ry >= ry0) * (ry < ry1))] = 0.
+            del rx,ry
         del xx,yy,rr,dd,unique
 
         if plots:
@@ -396,25 +435,8 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
             src.halfsize = int(np.hypot(R, galrad * 5 / pixscale))
     debug('Set WISE source sizes:', nbig, 'big', nmedium, 'medium', nsmall, 'small')
 
-    tractor = Tractor(tims, cat)
-    if use_ceres:
-        from tractor.ceres_optimizer import CeresOptimizer
-        tractor.optimizer = CeresOptimizer(BW=ceres_block, BH=ceres_block)
-    tractor.freezeParamsRecursive('*')
-    tractor.thawPathsTo(wanyband)
-
-    t0 = Time()
-    R = tractor.optimize_forced_photometry(
-        fitstats=True, variance=True, shared_params=False, wantims=wantims)
-    info('unWISE forced photometry took', Time() - t0)
-
-    if use_ceres:
-        term = R.ceres_status['termination']
-        # Running out of memory can cause failure to converge and term
-        # status = 2.  Fail completely in this case.
-        if term != 0:
-            info('Ceres termination status:', term)
-            raise RuntimeError('Ceres terminated with status %i' % term)
+    R = unwise_fit(tims, cat, wanyband, use_ceres=use_ceres, ceres_block=ceres_block,
+                   wantims=wantims)
 
     if wantims:
         ims1 = R.ims1
@@ -516,9 +538,157 @@ def unwise_forcedphot(cat, tiles, band=1, roiradecbox=None,
         rtn.maskmap = maskmap
     return rtn
 
+def unwise_fit(tims, cat, wanyband, use_ceres=True, ceres_block=8, wantims=False):
+    '''
+    Fits the *wanyband* fluxes of the sources *cat* (all else fixed)
+    to the images *tims*, returning the optimize_forced_photometry
+    result.
+    '''
+    from tractor import Tractor
+    tractor = Tractor(tims, cat)
+    if use_ceres:
+        from tractor.ceres_optimizer import CeresOptimizer
+        tractor.optimizer = CeresOptimizer(BW=ceres_block, BH=ceres_block)
+    tractor.freezeParamsRecursive('*')
+    tractor.thawPathsTo(wanyband)
+
+    t0 = Time()
+    R = tractor.optimize_forced_photometry(
+        fitstats=True, variance=True, shared_params=False, wantims=wantims)
+    info('unWISE forced photometry took', Time() - t0)
+
+    if use_ceres:
+        term = R.ceres_status['termination']
+        # Running out of memory can cause failure to converge and term
+        # status = 2.  Fail completely in this case.
+        if term != 0:
+            info('Ceres termination status:', term)
+            raise RuntimeError('Ceres terminated with status %i' % term)
+    return R
+
 class wphotduck(object):
     pass
 
+class UnwiseCells(object):
+    '''
+    Splits the area of *wcs* (eg, the brick) into *ncells* x *ncells*
+    cells, so that unWISE forced photometry can be run on the cells in
+    parallel.
+
+    Each source belongs to the cell containing it (the cells along the
+    edges extend outwards, to take any sources beyond *wcs*).  The fit
+    for a cell also includes the sources and pixels within *halo*
+    pixels (of *wcs*) of it, so that the sources it owns are deblended
+    against their neighbours; only the results for the sources (and
+    model pixels) it owns are kept.  Each cell reads the same unWISE
+    cutouts as the fit for the whole area, and fits only its own pixels
+    of them, so the pixel positions (wise_x, wise_y) and model images
+    are in the same frame as for the whole area.
+    '''
+    def __init__(self, wcs, ncells, halo):
+        self.wcs = wcs
+        self.ncells = ncells
+        self.halo = halo
+        H,W = wcs.shape
+        self.xedges = np.linspace(0, W, ncells+1)
+        self.yedges = np.linspace(0, H, ncells+1)
+
+    def cell_index(self, x, y):
+        '''
+        Returns the cell owning each of the (0-based) pixel positions *x*, *y*.
+        '''
+        n = self.ncells
+        cx = np.clip(np.searchsorted(self.xedges, x, side='right') - 1, 0, n-1)
+        cy = np.clip(np.searchsorted(self.yedges, y, side='right') - 1, 0, n-1)
+        return cy * n + cx
+
+    def split(self, ra, dec):
+        '''
+        Returns, for each cell, (I, owned, (x0, x1, y0, y1)): the indices of
+        the sources to fit, a boolean array marking which of those
+        the cell owns, and the region to fit (0-based pixels of *wcs*,
+        including the halo).
+        '''
+        _,x,y = self.wcs.radec2pixelxy(ra, dec)
+        x = x - 1.
+        y = y - 1.
+        icell = self.cell_index(x, y)
+        n = self.ncells
+        cells = []
+        for iy in range(n):
+            for ix in range(n):
+                x0 = self.xedges[ix] - self.halo
+                x1 = self.xedges[ix+1] + self.halo
+                y0 = self.yedges[iy] - self.halo
+                y1 = self.yedges[iy+1] + self.halo
+                owned = (icell == iy*n + ix)
+                near = owned | ((x >= x0) * (x < x1) * (y >= y0) * (y < y1))
+                I = np.flatnonzero(near)
+                cells.append((I, owned[I], (x0, x1, y0, y1)))
+        return cells
+
+    def task_args(self, X, cell):
+        '''
+        Converts the unwise_phot arguments *X* for the whole area into
+        those for one *cell*.
+        '''
+        I,_,rect = cell
+        wcat = X[0]
+        return ([wcat[i] for i in I],) + tuple(X[1:11]) + ((self.wcs,) + tuple(rect),)
+
+    def merge(self, cells, results, nsrcs):
+        '''
+        Merges the unwise_phot *results* for the *cells* (from
+        *split*) into one result for all *nsrcs* sources, taking each
+        source's (and model pixel's) values from the cell that owns
+        it.  Returns None if any cell failed.
+        '''
+        from collections import OrderedDict
+        if any([r is None for r in results]):
+            return None
+        phot = fits_table()
+        P = results[0].phot
+        for c in P.get_columns():
+            x = P.get(c)
+            phot.set(c, np.zeros((nsrcs,) + x.shape[1:], x.dtype))
+        for (I,owned,_),r in zip(cells, results):
+            for c in P.get_columns():
+                phot.get(c)[I[owned]] = r.phot.get(c)[owned]
+        rtn = wphotduck()
+        rtn.phot = phot
+        rtn.models = None
+        rtn.maskmap = None
+        # (coadd_id, band) -> [coadd_id, band, wcs, data, model, inverr]
+        models = OrderedDict()
+        # (coadd_id, band) -> cell owning each model pixel
+        owner = {}
+        for icell,r in enumerate(results):
+            if r.maskmap is not None:
+                if rtn.maskmap is None:
+                    rtn.maskmap = r.maskmap.copy()
+                else:
+                    rtn.maskmap |= r.maskmap
+            if r.models is None:
+                continue
+            for (coadd_id, band, mwcs, dat, mod, ie) in r.models:
+                # The cells' cutouts are the same; keep only the model
+                # pixels this cell owns.
+                key = (coadd_id, band)
+                if not key in owner:
+                    mh,mw = dat.shape
+                    xx,yy = np.meshgrid(np.arange(mw), np.arange(mh))
+                    rr,dd = mwcs.pixelxy2radec(xx+1, yy+1)
+                    _,bx,by = self.wcs.radec2pixelxy(rr, dd)
+                    owner[key] = self.cell_index(bx-1, by-1)
+                mod = mod * (owner[key] == icell)
+                if key in models:
+                    models[key][4] += mod
+                else:
+                    models[key] = [coadd_id, band, mwcs, dat, mod, ie]
+        if len(models):
+            rtn.models = [tuple(m) for m in models.values()]
+        return rtn
+
 def radec_in_unique_area(rr, dd, ra1, ra2, dec1, dec2):
     ''' Returns a boolean array. '''
     unique = (dd >= dec1) * (dd < dec2)
@@ -536,10 +706,14 @@ def unwise_phot(X):
     This is the entry-point from runbrick.py, called via mp.map()
     '''
     (wcat, tiles, band, roiradec, wise_ceres, pixelized_psf, get_mods, get_masks, ps,
-     move_crpix, modelsky_dir) = X
+     move_crpix, modelsky_dir) = X[:11]
+    # Optional: the region to fit (see UnwiseCells)
+    fit_region = None
+    if len(X) > 11:
+        fit_region = X[11]
     kwargs = dict(roiradecbox=roiradec, band=band, pixelized_psf=pixelized_psf,
                   get_masks=get_masks, ps=ps, move_crpix=move_crpix,
-                  modelsky_dir=modelsky_dir)
+                  modelsky_dir=modelsky_dir, fit_region=fit_region)
     if get_mods:
         kwargs.update(get_models=get_mods)
 
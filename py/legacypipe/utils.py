@@ -157,6 +157,75 @@ def find_unique_pixels(wcs, W, H, unique, ra1,ra2,dec1,dec2):
             break
     return unique
 
+def region_batches(xx, yy, rad, maxpix=4000000, shape=None):
+    '''
+    For painting many circular (or smaller) regions of radius *rad*
+    pixels centered at (*xx*,*yy*) into an image: groups the regions
+    by integer radius R = ceil(rad), and yields (I, gx, gy) for
+    batches of regions I, where gx and gy (len(I) x (2R+2)) are the
+    integer pixel coordinates spanned by each region's bounding box.
+    Each batch covers at most about *maxpix* pixels.  The coordinates
+    may fall outside the image.
+
+    If the image *shape* (H,W) is given, regions entirely outside the
+    image are skipped, and the boxes are clipped to (at most) the
+    image size and moved inside it, so that huge regions cost no more
+    than the image; the boxes still include all of each region's
+    pixels within the image.
+    '''
+    R = np.ceil(rad).astype(int)
+    order = np.argsort(R, kind='stable')
+    rvals,starts = np.unique(R[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for r,i0,i1 in zip(rvals, starts, ends):
+        S = 2*r + 2
+        I = order[i0:i1]
+        x0 = np.floor(xx[I] - r).astype(int)
+        y0 = np.floor(yy[I] - r).astype(int)
+        Sx = Sy = S
+        if shape is not None:
+            H,W = shape
+            keep = (x0 + S > 0) * (x0 < W) * (y0 + S > 0) * (y0 < H)
+            I,x0,y0 = I[keep], x0[keep], y0[keep]
+            Sx = min(S, W)
+            Sy = min(S, H)
+            x0 = np.clip(x0, 0, W - Sx)
+            y0 = np.clip(y0, 0, H - Sy)
+        nper = max(1, maxpix // (Sx*Sy))
+        for j in range(0, len(I), nper):
+            gx = x0[j:j+nper][:,np.newaxis] + np.arange(Sx)[np.newaxis,:]
+            gy = y0[j:j+nper][:,np.newaxis] + np.arange(Sy)[np.newaxis,:]
+            yield I[j:j+nper], gx, gy
+
+def paint_batch(img, val, gx, gy, masked):
+    '''
+    ORs *val* into the pixels of *img* selected by *masked* (N x Sy x Sx,
+    from a batch of region_batches), ignoring pixels outside the image.
+    '''
+    H,W = img.shape
+    masked = (masked *
+              ((gy >= 0) * (gy < H))[:,:,np.newaxis] *
+              ((gx >= 0) * (gx < W))[:,np.newaxis,:])
+    n,j,i = np.nonzero(masked)
+    img[gy[n,j], gx[n,i]] |= val
+
+class FileLock(object):
+    '''
+    An exclusive lock (flock) on file *fn*, created if necessary; use
+    as a context manager.  Locks are between processes, not threads.
+    '''
+    def __init__(self, fn):
+        self.fn = fn
+    def __enter__(self):
+        import fcntl
+        self.f = open(self.fn, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+    def __exit__(self, *args):
+        import fcntl
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
 def read_primary_header(fn):
     # fitsio 1.0.1 sped up header-reading, so we don't need to do it ourselves any more.
     import fitsio
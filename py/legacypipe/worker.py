@@ -1,15 +1,43 @@
+'''
+Worker for farm.py: fetches blob work packets from the farm, runs
+one_blob on them, and sends back the results.
+
+The worker talks to the farm over a ZeroMQ DEALER socket (the farm
+has a ROUTER).  A background thread owns the socket: it asks the farm
+for up to *prefetch* work packets ahead of time ("credits"), so that
+the next blob is already waiting when one_blob finishes; it sends
+results as they are produced (each result earns one more credit);
+it resends results that the farm has not acknowledged; and it sends
+heartbeats, so that the farm can tell a busy worker from a dead one
+and redeliver the packets held by dead ones.
+
+Work packets are encoded by legacypipe.workpacket; the objects they
+share are kept in an ObjectCache, and the farm sends only the objects
+the worker does not have (it tracks this with its own copy of the
+worker's cache, whose byte budget is sent with b'ready').
+
+Messages, worker to farm:
+  [b'ready', jobid, pickle((ncredits, cache bytes))]
+  [b'result', jobid, pickle(meta), pickle(result)]
+  [b'heartbeat', jobid]
+and farm to worker:
+  [b'work', pickle(object hashes), packet, hash, object, hash, object, ...]
+  [b'ack', pickle((brickname, iblob))]
+  [b'reset']  -- the farm had given up on this worker (or does not
+                know it); empty the object cache and ask again.
+'''
 import os
 import argparse
 import pickle
+import queue
+import threading
 import time
 
 import zmq
 
 from legacypipe.oneblob import *
 
-
-def run(server):
-
+def get_jobid():
     cluster = os.environ.get('SLURM_CLUSTER_NAME', '')
     jid = os.environ.get('SLURM_JOB_ID', '')
     aid = os.environ.get('SLURM_ARRAY_TASK_ID', '')
@@ -31,64 +59,158 @@ def run(server):
             jobid = '%s_%s_%s_%s_%s' % (cluster, ajid, aid, nid, me)
         else:
             jobid = '%s_%s_%s_%s' % (cluster, jid, nid, me)
-    jobid = jobid.encode()
+    return jobid.encode()
+
+def network_loop(ctx, server, jobid, prefetch, heartbeat, cachebytes,
+                 work, results, stop):
+    '''
+    The worker's socket-handling thread: puts (packet, objects) work
+    items (still encoded) on the *work* queue, and sends the
+    ((brickname, iblob), meta, result) tuples that appear on the
+    *results* queue.  Returns once *stop* is set and all results have
+    been sent.
+    '''
+    from legacypipe.workpacket import ObjectCache
+    cache = ObjectCache(cachebytes)
+    hello = [b'ready', jobid, pickle.dumps((prefetch, cachebytes), -1)]
+    sock = ctx.socket(zmq.DEALER)
+    sock.connect(server)
+    sock.send_multipart(hello)
+    last_sent = time.time()
+    # Results not yet acknowledged by the farm: key -> (meta, result, time sent)
+    unacked = {}
+    resend = 4. * heartbeat
+    while True:
+        while True:
+            try:
+                key,meta,result = results.get(block=False)
+            except queue.Empty:
+                break
+            sock.send_multipart([b'result', jobid, meta, result])
+            last_sent = time.time()
+            unacked[key] = (meta, result, last_sent)
+        if stop.is_set() and results.empty():
+            break
+
+        tnow = time.time()
+        for key,(meta,result,tsent) in list(unacked.items()):
+            if tnow - tsent > resend:
+                print('Resending unacknowledged result for', key)
+                sock.send_multipart([b'result', jobid, meta, result])
+                unacked[key] = (meta, result, tnow)
+                last_sent = tnow
+        if tnow - last_sent > heartbeat:
+            sock.send_multipart([b'heartbeat', jobid])
+            last_sent = tnow
+
+        if sock.poll(timeout=100) == 0:
+            continue
+        parts = sock.recv_multipart()
+        kind = parts[0]
+        if kind == b'work':
+            deps = pickle.loads(parts[1])
+            new = dict([(h.decode(), b) for h,b in zip(parts[3::2], parts[4::2])])
+            cache.update(deps, new)
+            work.put((parts[2], dict([(h, cache.get(h)) for h in deps])))
+        elif kind == b'ack':
+            unacked.pop(pickle.loads(parts[1]), None)
+        elif kind == b'reset':
+            # The farm has forgotten us (it gave up on us, or restarted):
+            # it no longer knows which objects we hold, either.
+            print('Farm reset our work requests; asking again')
+            cache = ObjectCache(cachebytes)
+            sock.send_multipart(hello)
+            last_sent = time.time()
+        else:
+            print('Unrecognized message from farm:', kind)
+    sock.close(linger=1000)
+
+def run(server, prefetch=2, heartbeat=5., cachebytes=256*1000000, func=None,
+        max_blobs=None, done=None):
+    '''
+    Runs *func* (default one_blob) on work packets from the farm at
+    *server*, keeping up to *prefetch* packets queued, and up to
+    *cachebytes* of the objects they share (both as received, and
+    decoded).
+
+    *max_blobs*: exit after this many blobs, abandoning any prefetched
+    packets (for testing the farm's redelivery).
+
+    *done*: an Event; if given, exit once it is set (for testing).
+    '''
+    from legacypipe.workpacket import decode_packet, ObjectMemo
+    if func is None:
+        func = one_blob
+    jobid = get_jobid()
     print('Setting jobid', jobid)
 
     print('Connecting to', server)
     ctx = zmq.Context()
-    sock = ctx.socket(zmq.REQ)
-    sock.connect(server)
-
-    req = None
-    meta = None
+    work = queue.Queue()
+    results = queue.Queue()
+    stop = threading.Event()
+    net = threading.Thread(target=network_loop,
+                           args=(ctx, server, jobid, prefetch, heartbeat, cachebytes,
+                                 work, results, stop),
+                           daemon=True)
+    net.start()
+
+    # Decoded shared objects
+    memo = ObjectMemo(cachebytes)
+    nblobs = 0
     tprev_wall = time.time()
-    while True:
-        msg = pickle.dumps(req, -1)
-        meta_msg = pickle.dumps(meta, -1)
-        print('Sending', len(msg))
-        sock.send_multipart([jobid, meta_msg, msg])
-        rep = sock.recv()
-        print('Received reply:', len(rep), 'bytes')
-        rep = pickle.loads(rep)
-        #print('Reply:', rep)
-        if rep is None:
-            print('No work assigned!')
-            req = None
-            time.sleep(5)
+    while max_blobs is None or nblobs < max_blobs:
+        if done is not None and done.is_set():
+            break
+        try:
+            packet,objs = work.get(timeout=1.)
+        except queue.Empty:
             continue
-            #break
-
-        (brickname, iblob, args) = rep
+        print('Received work packet:', len(packet), 'bytes;', work.qsize(), 'more queued')
+        (brickname, iblob, args) = decode_packet(packet, objs, memo)
+        del packet, objs
 
         print('Calling one_blob...')
         t0_wall = time.time()
         t0_cpu  = time.process_time()
 
-        result = one_blob(args)
+        result = func(args)
 
         t1_cpu  = time.process_time()
         t1_wall = time.time()
         overhead = t0_wall - tprev_wall
         tprev_wall = t1_wall
-        # send our answer along with our next request for work!
-        req = result
         meta = (brickname, iblob, t1_cpu-t0_cpu, t1_wall-t0_wall, overhead)
+        results.put(((brickname, iblob), pickle.dumps(meta, -1),
+                     pickle.dumps(result, -1)))
+        nblobs += 1
+    stop.set()
+    net.join()
+    ctx.term()
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('server', nargs=1, help='Server URL, eg tcp://edison08:5555')
     parser.add_argument('--threads', type=int, help='Number of processes to run')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of work packets to keep queued per process')
+    parser.add_argument('--heartbeat', type=float, default=5.,
+                        help='Seconds between heartbeats to the farm')
+    parser.add_argument('--object-cache-mb', type=float, default=256.,
+                        help='Memory (per process) for objects shared between work packets')
 
     opt = parser.parse_args()
 
     server = opt.server[0]
+    kwargs = dict(prefetch=opt.prefetch, heartbeat=opt.heartbeat,
+                  cachebytes=int(opt.object_cache_mb * 1e6))
 
     if opt.threads:
         from multiprocessing import Process
 
         procs = []
         for i in range(opt.threads):
-            p = Process(target=run, args=(server,))
+            p = Process(target=run, args=(server,), kwargs=kwargs)
             p.start()
             procs.append(p)
         for i,p in enumerate(procs):
@@ -96,7 +218,7 @@ def main():
             print('Joined process', (i+1), 'of', len(procs))
 
     else:
-        run(server)
+        run(server, **kwargs)
     print('All done!')
 
 if __name__ == '__main__':
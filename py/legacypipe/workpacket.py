@@ -0,0 +1,194 @@
+'''
+Compact encoding of blob work packets sent from farm.py to worker.py.
+
+Many blobs of a brick carry the same per-tim objects (the
+LegacySurveyImage, photocal, PSF model arrays, ...), and many of them
+are fit by the same worker.  PacketEncoder pickles such objects once
+per brick, names them by the hash of their (compressed) pickle, and
+leaves only the name in each packet; the rest of the packet (mostly
+pixels) is zlib-compressed.
+
+The farm keeps an ObjectCache per worker that mirrors the worker's own
+cache, so it can send each object to each worker only when the worker
+does not already have it.  The two stay in sync because both apply
+the same updates, in the same order, with the same byte budget (and
+both start over empty when the farm resets the worker).  The worker
+also keeps the decoded objects, in an ObjectMemo.
+'''
+import hashlib
+import pickle
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Arrays smaller than this are always sent inline.
+MIN_SHARED_ARRAY_BYTES = 16384
+
+class _SharingPickler(pickle.Pickler):
+    def __init__(self, f, encoder):
+        super(_SharingPickler, self).__init__(f, -1)
+        self.encoder = encoder
+        self.deps = []
+
+    def persistent_id(self, obj):
+        h = self.encoder.shared_id(obj)
+        if h is not None and not h in self.deps:
+            self.deps.append(h)
+        return h
+
+class PacketEncoder(object):
+    '''
+    Encodes work packets for one brick.
+
+    Objects passed to *share()* are sent by reference from their first
+    use; large numpy arrays are sent by reference once they have been
+    seen in two packets (eg, PSF model arrays shared by the sub-PSFs
+    of a tim).
+    '''
+    def __init__(self, level=1):
+        self.level = level
+        # id(obj) -> (obj, hash or None)
+        self.ids = {}
+        # hash -> compressed pickle
+        self.objects = {}
+        # arrays seen in one packet so far: id -> (array, packet number)
+        # (keeping them alive so that ids are not reused)
+        self.seen_arrays = {}
+        self.npackets = 0
+
+    def share(self, obj):
+        if obj is None or id(obj) in self.ids:
+            return
+        self.ids[id(obj)] = (obj, None)
+
+    def shared_id(self, obj):
+        e = self.ids.get(id(obj))
+        if e is None:
+            if (not isinstance(obj, np.ndarray) or
+                obj.nbytes < MIN_SHARED_ARRAY_BYTES):
+                return None
+            _,n = self.seen_arrays.setdefault(id(obj), (obj, self.npackets))
+            if n == self.npackets:
+                return None
+            del self.seen_arrays[id(obj)]
+            e = (obj, None)
+        obj,h = e
+        if h is None:
+            b = zlib.compress(pickle.dumps(obj, -1), self.level)
+            h = hashlib.sha1(b).hexdigest()
+            self.objects[h] = b
+            self.ids[id(obj)] = (obj, h)
+        return h
+
+    def encode(self, x):
+        '''
+        Returns (packet, deps, objects): the compressed packet bytes,
+        the list of object hashes it refers to, and a dict from those
+        hashes to their compressed pickles.
+        '''
+        import io
+        f = io.BytesIO()
+        p = _SharingPickler(f, self)
+        p.dump(x)
+        self.npackets += 1
+        packet = zlib.compress(f.getvalue(), self.level)
+        return packet, p.deps, dict([(h, self.objects[h]) for h in p.deps])
+
+class _SharingUnpickler(pickle.Unpickler):
+    def __init__(self, f, objects, memo):
+        super(_SharingUnpickler, self).__init__(f)
+        self.objects = objects
+        self.shared_memo = memo
+
+    def persistent_load(self, h):
+        obj = self.shared_memo.get(h)
+        if obj is None:
+            b = zlib.decompress(self.objects[h])
+            obj = pickle.loads(b)
+            self.shared_memo.add(h, obj, len(b))
+        return obj
+
+def decode_packet(packet, objects, memo=None):
+    '''
+    Decodes a packet from PacketEncoder.encode, given a dict of (at
+    least) the objects it refers to.  Decoded objects are kept in the
+    ObjectMemo *memo*, if given, and re-used by later packets.
+    '''
+    import io
+    if memo is None:
+        memo = ObjectMemo()
+    return _SharingUnpickler(io.BytesIO(zlib.decompress(packet)), objects, memo).load()
+
+class ObjectMemo(object):
+    '''
+    Decoded shared objects (hash -> object), kept by the worker for
+    later packets: an LRU cache with a budget of *maxbytes* of their
+    (uncompressed) pickles, or unlimited if None.
+    '''
+    def __init__(self, maxbytes=None):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, h):
+        e = self.entries.get(h)
+        if e is None:
+            return None
+        self.entries.move_to_end(h)
+        return e[0]
+
+    def add(self, h, obj, nbytes):
+        self.entries[h] = (obj, nbytes)
+        self.nbytes += nbytes
+        if self.maxbytes is None:
+            return
+        # (the newest object is kept even if it alone is over budget)
+        while self.nbytes > self.maxbytes and len(self.entries) > 1:
+            _,(_,n) = self.entries.popitem(last=False)
+            self.nbytes -= n
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+class ObjectCache(object):
+    '''
+    An LRU cache of shared objects (hash -> compressed pickle), with a
+    budget of *maxbytes*.  The farm uses value-less copies to track
+    which objects each worker holds.
+    '''
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def missing(self, deps):
+        return [h for h in deps if not h in self.entries]
+
+    def update(self, deps, objects, keep_values=True):
+        '''
+        Marks the objects *deps* (of one packet) as used, adding those
+        not already cached from the dict *objects*, then evicts the
+        least-recently used objects not in *deps* until within budget.
+        '''
+        for h in deps:
+            if h in self.entries:
+                self.entries.move_to_end(h)
+                continue
+            b = objects[h]
+            self.entries[h] = (b if keep_values else None, len(b))
+            self.nbytes += len(b)
+        depset = set(deps)
+        while self.nbytes > self.maxbytes:
+            h = next(iter(self.entries))
+            if h in depset:
+                break
+            _,n = self.entries.pop(h)
+            self.nbytes -= n
+
+    def get(self, h):
+        return self.entries[h][0]
@@ -745,7 +745,9 @@ class Measurer(object):
 
         ps1 = None
         try:
-            ps1 = ps1cat(ccdwcs=self.wcs).get_stars(magrange=None)
+            ps1 = ps1cat(ccdwcs=self.wcs).get_stars(
+                magrange=None,
+                columns=['obj_id', 'ra_ok', 'dec_ok', 'median', 'nmag_ok'])
         except OSError as e:
             print('No PS1 stars found for this image -- outside the PS1 footprint, or in the Galactic plane?', e)
 
@@ -762,7 +764,12 @@ class Measurer(object):
                 ps1.legacy_survey_mag = self.ps1_to_observed(ps1)
                 print(len(ps1), 'PS1 stars')
 
-        gaia = GaiaCatalog().get_catalog_in_wcs(self.wcs)
+        gaia = GaiaCatalog().get_catalog_in_wcs(
+            self.wcs,
+            columns=['source_id', 'ra', 'dec', 'ref_epoch', 'pmra', 'pmdec', 'parallax',
+                     'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag',
+                     'phot_g_mean_flux_over_error', 'phot_bp_mean_flux_over_error',
+                     'phot_rp_mean_flux_over_error'])
         assert(gaia is not None)
         assert(len(gaia) > 0)
         gaia = GaiaCatalog.catalog_nantozero(gaia)
@@ -1447,11 +1454,13 @@ class Measurer(object):
         print('Wrote %s' % fn)
 
     def run_calibs(self, survey, ext, psfex=True, splinesky=True, read_hdu=True,
-                   plots=False, survey_blob_mask=None, survey_zeropoints=None):
+                   plots=False, survey_blob_mask=None, survey_zeropoints=None,
+                   sky_masks=None, fine_sky=True):
         '''
         survey_zeropoints: LegacySurveyData object to use for fetching the
         zeropoint for this CCD, which is used for subtracting stellar halos
         and SGA galaxies.
+        sky_masks: legacypipe.skymasks.ExposureSkyMasks for this exposure.
         '''
         # Initialize with some basic data
         self.set_hdu(ext)
@@ -1549,7 +1558,8 @@ class Measurer(object):
                       git_version=git_version, survey=survey, ps=ps,
                       survey_blob_mask=survey_blob_mask,
                       halos=have_zpt,
-                      subtract_largegalaxies=have_zpt)
+                      subtract_largegalaxies=have_zpt,
+                      sky_masks=sky_masks, fine_sky=fine_sky)
         return ccd
 
 class FakeCCD(object):
@@ -1981,6 +1991,8 @@ def measure_image(img_fn, mp, image_dir='images', run_calibs_only=False,
     if zptdir is not None:
         survey_zeropoints = LegacySurveyData(survey_dir=zptdir)
 
+    fine_sky = measureargs.pop('fine_sky', True)
+
     do_splinesky = splinesky
     do_psfex = psfex
 
@@ -1998,9 +2010,22 @@ def measure_image(img_fn, mp, image_dir='images', run_calibs_only=False,
             do_psfex = False
 
     if do_splinesky or do_psfex:
+        sky_masks = [None] * len(extlist)
+        if do_splinesky and measure.goodWcs:
+            # Query the reference sources once for the whole exposure,
+            # rather than once per CCD, and send each CCD only its own.
+            from legacypipe.skymasks import ExposureSkyMasks
+            wcslist = []
+            for ext in extlist:
+                measure.set_hdu(ext)
+                wcslist.append(measure.wcs)
+            expmasks = ExposureSkyMasks(survey, wcslist, measure.pixscale)
+            sky_masks = [expmasks.for_ccd(wcs) for wcs in wcslist]
+            del expmasks
         ccds = mp.map(run_one_calib, [(measure, survey, ext, do_psfex, do_splinesky,
-                                       plots, survey_blob_mask, survey_zeropoints)
-                                      for ext in extlist])
+                                       plots, survey_blob_mask, survey_zeropoints,
+                                       masks, fine_sky)
+                                      for ext,masks in zip(extlist, sky_masks)])
 
         from legacyzpts.merge_calibs import merge_splinesky, merge_psfex
         class FakeOpts(object):
@@ -2110,11 +2135,12 @@ def measure_image(img_fn, mp, image_dir='images', run_calibs_only=False,
 
 def run_one_calib(X):
     (measure, survey, ext, psfex, splinesky, plots, survey_blob_mask,
-     survey_zeropoints) = X
+     survey_zeropoints, sky_masks, fine_sky) = X
     return measure.run_calibs(survey, ext, psfex=psfex, splinesky=splinesky,
                               plots=plots,
                               survey_blob_mask=survey_blob_mask,
-                              survey_zeropoints=survey_zeropoints)
+                              survey_zeropoints=survey_zeropoints,
+                              sky_masks=sky_masks, fine_sky=fine_sky)
 
 def run_one_ext(X):
     measure, ext, survey, splinesky, debug = X
@@ -2285,6 +2311,8 @@ def get_parser():
                         help='Do not use spline sky model for sky subtraction?')
     parser.add_argument('--blob-mask-dir', type=str, default=None,
                         help='The base directory to search for blob masks during sky model construction')
+    parser.add_argument('--no-fine-sky', dest='fine_sky', default=True, action='store_false',
+                        help='Skip the finer-grid sky fit behind the "sky_fine" diagnostic in the sky calibs.')
     parser.add_argument('--zeropoints-dir', type=str, default=None,
                         help='The base directory to search for survey-ccds files for subtracting star halos before doing sky calibration.')
     parser.add_argument('--calibdir', default=None, action='store',
@@ -0,0 +1,105 @@
+'''
+Benchmark for the vectorized CCD overlap test
+(legacypipe.survey.ccds_touching_wcs): for brick-sized target WCSes
+scattered over the CCDs of the testcase survey-ccds files, compares
+the results and speed against the original CCD-by-CCD polygon loop.
+
+    python test/bench_ccds_touching.py --ntargets 2000
+'''
+import os
+import time
+from glob import glob
+import numpy as np
+
+def ccds_touching_wcs_loop(targetwcs, ccds, I):
+    # The original per-CCD polygon test, on candidate CCDs I.
+    from astrometry.util.util import Tan
+    from astrometry.util.miscutils import polygons_intersect
+    tw,th = targetwcs.imagew, targetwcs.imageh
+    targetpoly = [(0.5,0.5),(tw+0.5,0.5),(tw+0.5,th+0.5),(0.5,th+0.5)]
+    cd = targetwcs.get_cd()
+    tdet = cd[0]*cd[3] - cd[1]*cd[2]
+    if tdet > 0:
+        targetpoly = list(reversed(targetpoly))
+    targetpoly = np.array(targetpoly)
+    keep = []
+    for i in I:
+        W,H = ccds.width[i],ccds.height[i]
+        wcs = Tan(*[float(x) for x in
+                    [ccds.crval1[i], ccds.crval2[i], ccds.crpix1[i], ccds.crpix2[i],
+                     ccds.cd1_1[i], ccds.cd1_2[i], ccds.cd2_1[i], ccds.cd2_2[i], W, H]])
+        cd = wcs.get_cd()
+        wdet = cd[0]*cd[3] - cd[1]*cd[2]
+        poly = []
+        for x,y in [(0.5,0.5),(W+0.5,0.5),(W+0.5,H+0.5),(0.5,H+0.5)]:
+            rr,dd = wcs.pixelxy2radec(x,y)
+            _,xx,yy = targetwcs.radec2pixelxy(rr,dd)
+            poly.append((xx,yy))
+        if wdet > 0:
+            poly = list(reversed(poly))
+        poly = np.array(poly)
+        if polygons_intersect(targetpoly, poly):
+            keep.append(i)
+    return np.array(keep, int)
+
+def main():
+    import argparse
+    from astrometry.util.fits import fits_table, merge_tables
+    from astrometry.util.util import Tan
+    from legacypipe.survey import ccds_touching_wcs, add_ccd_corners, ccd_corners
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ntargets', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=3600, help='Target size (pixels)')
+    opt = parser.parse_args()
+
+    fns = sorted(glob(os.path.join(os.path.dirname(__file__), 'testcase*',
+                                   'survey-ccds-*.fits.gz')))
+    ccds = merge_tables([fits_table(fn) for fn in fns], columns='fillzero')
+    print('Read', len(ccds), 'CCDs from', len(fns), 'files')
+
+    # Check the corners against the Tan WCS
+    cra,cdec = ccd_corners(ccds)
+    maxerr = 0.
+    for i in range(len(ccds)):
+        W,H = ccds.width[i],ccds.height[i]
+        wcs = Tan(*[float(x) for x in
+                    [ccds.crval1[i], ccds.crval2[i], ccds.crpix1[i], ccds.crpix2[i],
+                     ccds.cd1_1[i], ccds.cd1_2[i], ccds.cd2_1[i], ccds.cd2_2[i], W, H]])
+        for j,(x,y) in enumerate([(0.5,0.5),(W+0.5,0.5),(W+0.5,H+0.5),(0.5,H+0.5)]):
+            r,d = wcs.pixelxy2radec(x, y)
+            maxerr = max(maxerr, abs(d - cdec[i,j]),
+                         abs((r - cra[i,j] + 180.) % 360. - 180.) * np.cos(np.deg2rad(d)))
+    print('Max corner difference vs Tan: %.3g arcsec' % (maxerr * 3600.))
+
+    rng = np.random.RandomState(42)
+    pixscale = 0.262 / 3600.
+    targets = []
+    for k in range(opt.ntargets):
+        i = rng.randint(len(ccds))
+        # within a CCD-size of a CCD center
+        r = ccds.ra[i]  + rng.uniform(-0.3, 0.3) / np.cos(np.deg2rad(ccds.dec[i]))
+        d = ccds.dec[i] + rng.uniform(-0.3, 0.3)
+        targets.append(Tan(r, d, (opt.size+1)/2., (opt.size+1)/2.,
+                           -pixscale, 0., 0., pixscale, float(opt.size), float(opt.size)))
+
+    t0 = time.time()
+    R1 = []
+    for wcs in targets:
+        I = ccds_touching_wcs(wcs, ccds, polygons=False)
+        R1.append(ccds_touching_wcs_loop(wcs, ccds, I))
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    add_ccd_corners(ccds)
+    R2 = [ccds_touching_wcs(wcs, ccds) for wcs in targets]
+    t_vec = time.time() - t0
+    print('%i targets: loop %.2f s, vectorized %.2f s (including corners) -- speedup %.1f' %
+          (len(targets), t_loop, t_vec, t_loop / t_vec))
+
+    ndiff = sum([not np.array_equal(np.sort(a), np.sort(b)) for a,b in zip(R1, R2)])
+    print('Mean %.1f CCDs per target; %i targets with different results' %
+          (np.mean([len(a) for a in R1]), ndiff))
+    assert(ndiff == 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+'''
+Benchmark for fitting the sources of one big blob in threads
+(legacypipe.oneblob.one_blob with the "threads" option): fits a
+synthetic blob of point sources and galaxies serially and with N
+threads, checks that the fits agree, and reports the times.
+
+    python test/bench_intra_blob.py --nsrcs 40 --threads 4
+'''
+import time
+import numpy as np
+
+def synthetic_blob(nsrcs=20, size=200, nimages=4, seed=42):
+    '''
+    Returns the one_blob() arguments (without options) for a *size* x
+    *size* blob containing *nsrcs* sources (every third one a
+    galaxy), seen by *nimages* images in g,r.
+    '''
+    from astrometry.util.util import Tan
+    from tractor import (Image, Tractor, PointSource, RaDecPos, NanoMaggies,
+                         LinearPhotoCal, ConstantSky, GaussianMixturePSF)
+    from tractor.galaxy import ExpGalaxy
+    from tractor.ellipses import EllipseE
+    from tractor.tractortime import TAITime
+    from legacypipe.survey import LegacySurveyWcs
+
+    class FakeImage(object):
+        pass
+
+    rng = np.random.RandomState(seed)
+    pixscale = 0.262
+    W = H = size
+    brickwcs = Tan(100., 5., (W+1)/2., (H+1)/2., -pixscale/3600., 0., 0.,
+                   pixscale/3600., float(W), float(H))
+    bands = ['g', 'r']
+    x = rng.uniform(10, W-10, nsrcs)
+    y = rng.uniform(10, H-10, nsrcs)
+    ra,dec = brickwcs.pixelxy2radec(x+1, y+1)
+    flux = 10.**rng.uniform(0.5, 2.5, nsrcs)
+    truth = []
+    srcs = []
+    for i,(r,d,f) in enumerate(zip(ra, dec, flux)):
+        br = NanoMaggies(g=f, r=1.5*f)
+        if i % 3 == 2:
+            truth.append(ExpGalaxy(RaDecPos(r, d), br,
+                                   EllipseE(rng.uniform(0.5, 2.), 0.2, -0.1)))
+        else:
+            truth.append(PointSource(RaDecPos(r, d), br))
+        # initial (detection) models are point sources
+        srcs.append(PointSource(RaDecPos(r, d), br.copy()))
+
+    timargs = []
+    for i in range(nimages):
+        band = bands[i % len(bands)]
+        sig1 = 0.05
+        v = (1.2 + 0.1*i)**2
+        psf = GaussianMixturePSF(1., 0., 0., v, v, 0.)
+        twcs = LegacySurveyWcs(brickwcs, TAITime(None, mjd=58000. + i))
+        pcal = LinearPhotoCal(1., band=band)
+        tim = Image(data=np.zeros((H,W), np.float32),
+                    inverr=np.zeros((H,W), np.float32) + 1./sig1,
+                    wcs=twcs, psf=psf, photocal=pcal, sky=ConstantSky(0.))
+        img = Tractor([tim], truth).getModelImage(0)
+        img = (img + rng.normal(scale=sig1, size=img.shape)).astype(np.float32)
+        inverr = np.zeros((H,W), np.float32) + 1./sig1
+        dq = np.zeros((H,W), np.int16)
+        imobj = FakeImage()
+        imobj.fwhm = 2.35 * np.sqrt(v)
+        timargs.append((img, inverr, dq, twcs, brickwcs, pcal, ConstantSky(0.),
+                        psf, 'fake-%i' % i, band, sig1, imobj))
+
+    blobmask = np.ones((H,W), bool)
+    refmap = np.zeros((H,W), np.uint8)
+    return (0, 0, np.arange(nsrcs), brickwcs, 0, 0, W, H, blobmask, timargs,
+            srcs, bands, False, None, False, False, False, refmap,
+            False, False, [])
+
+def fit_blob(threads, **kwargs):
+    '''
+    Fits the synthetic_blob(**kwargs) blob with *threads* threads;
+    returns (the one_blob result, wall-clock seconds).
+    '''
+    from legacypipe.oneblob import one_blob
+    X = synthetic_blob(**kwargs) + (dict(threads=threads),)
+    t0 = time.time()
+    B = one_blob(X)
+    return B, time.time() - t0
+
+def same_fits(B1, B2, rtol=1e-4):
+    if len(B1) != len(B2):
+        return False
+    for s1,s2 in zip(B1.sources, B2.sources):
+        if (s1 is None) != (s2 is None):
+            return False
+        if s1 is None:
+            continue
+        if type(s1) != type(s2):
+            return False
+        if not np.allclose(s1.getParams(), s2.getParams(), rtol=rtol, atol=1e-6):
+            return False
+    return np.allclose(B1.dchisq, B2.dchisq, rtol=rtol, atol=1e-3)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nsrcs', type=int, default=40)
+    parser.add_argument('--size', type=int, default=300, help='Blob size (pixels)')
+    parser.add_argument('--images', type=int, default=6)
+    parser.add_argument('--threads', type=int, default=4)
+    opt = parser.parse_args()
+
+    kw = dict(nsrcs=opt.nsrcs, size=opt.size, nimages=opt.images)
+    B1,t1 = fit_blob(1, **kw)
+    BN,tN = fit_blob(opt.threads, **kw)
+    print('%i sources, %i images: serial %.2f s, %i threads %.2f s -- speedup %.2f' %
+          (opt.nsrcs, opt.images, t1, opt.threads, tN, t1 / tN))
+    assert(same_fits(B1, BN))
+    print('Fits agree')
+
+if __name__ == '__main__':
+    main()
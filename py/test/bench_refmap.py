@@ -0,0 +1,123 @@
+'''
+Benchmark for reference-source mask painting
+(legacypipe.reference.get_reference_map): paints a synthetic
+dense-star field (plus some galaxies) with the batched painter and
+with the original one-object-at-a-time loop, checks that the masks are
+identical, and reports the times.
+
+    python test/bench_refmap.py --nstars 5000
+'''
+import time
+import numpy as np
+
+def synthetic_refs(wcs, nstars, ngals, seed):
+    from astrometry.util.fits import fits_table
+    rng = np.random.RandomState(seed)
+    H,W = wcs.shape
+    n = nstars + ngals
+    # include objects off the edges of the brick
+    x = rng.uniform(-200, W+200, n)
+    y = rng.uniform(-200, H+200, n)
+    refs = fits_table()
+    refs.ra,refs.dec = wcs.pixelxy2radec(x, y)
+    # radii (deg) ~ magnitude-dependent masking radii, a few very large
+    refs.radius = 10.**rng.uniform(0.3, 2.3, n) / 3600.
+    refs.isbright = np.zeros(n, bool)
+    refs.ismedium = np.zeros(n, bool)
+    refs.isbright[:nstars] = (rng.uniform(size=nstars) < 0.2)
+    refs.ismedium[:nstars] = True
+    refs.islargegalaxy = np.zeros(n, bool)
+    refs.islargegalaxy[nstars:] = True
+    refs.iscluster = np.zeros(n, bool)
+    refs.pa = rng.uniform(0, 180, n).astype(np.float32)
+    refs.pa[nstars::7] = np.nan
+    refs.ba = rng.uniform(0.2, 1., n).astype(np.float32)
+    return refs
+
+def reference_map_loop(wcs, refs):
+    # The original painter, one object at a time.
+    from legacypipe.bits import IN_BLOB
+    H,W = wcs.shape
+    H = int(H)
+    W = int(W)
+    refmap = np.zeros((H,W), np.uint8)
+    pixscale = wcs.pixel_scale()
+    cd = wcs.cd
+    cd = np.reshape(cd, (2,2)) / (pixscale / 3600.)
+    for col,bit,ellipse in [('isbright', 'BRIGHT', False),
+                            ('ismedium', 'MEDIUM', False),
+                            ('iscluster', 'CLUSTER', True),
+                            ('islargegalaxy', 'GALAXY', True),]:
+        I, = np.nonzero(refs.get(col))
+        if len(I) == 0:
+            continue
+        thisrefs = refs[I]
+        radius_pix = np.ceil(thisrefs.radius * 3600. / pixscale).astype(np.int32)
+        if bit == 'BRIGHT':
+            radius_pix = (radius_pix + 1) // 2
+        _,xx,yy = wcs.radec2pixelxy(thisrefs.ra, thisrefs.dec)
+        xx -= 1.
+        yy -= 1.
+        for x,y,rpix,ref in zip(xx,yy,radius_pix,thisrefs):
+            xlo = int(np.clip(np.floor(x   - rpix), 0, W))
+            xhi = int(np.clip(np.ceil (x+1 + rpix), 0, W))
+            ylo = int(np.clip(np.floor(y   - rpix), 0, H))
+            yhi = int(np.clip(np.ceil (y+1 + rpix), 0, H))
+            if xlo == xhi or ylo == yhi:
+                continue
+            bitval = np.uint8(IN_BLOB[bit])
+            if not ellipse:
+                rr = ((np.arange(ylo,yhi)[:,np.newaxis] - y)**2 +
+                      (np.arange(xlo,xhi)[np.newaxis,:] - x)**2)
+                masked = (rr <= rpix**2)
+            else:
+                xgrid,ygrid = np.meshgrid(np.arange(xlo,xhi), np.arange(ylo,yhi))
+                dx = xgrid - x
+                dy = ygrid - y
+                du = cd[0][0] * dx + cd[0][1] * dy
+                dv = cd[1][0] * dx + cd[1][1] * dy
+                if not np.isfinite(ref.pa):
+                    ref.pa = 0.
+                ct = np.cos(np.deg2rad(90.+ref.pa))
+                st = np.sin(np.deg2rad(90.+ref.pa))
+                v1 = ct * du + -st * dv
+                v2 = st * du +  ct * dv
+                r1 = rpix
+                r2 = rpix * ref.ba
+                masked = (v1**2 / r1**2 + v2**2 / r2**2 < 1.)
+            refmap[ylo:yhi, xlo:xhi] |= (bitval * masked)
+    return refmap
+
+def main():
+    import argparse
+    from astrometry.util.util import Tan
+    from legacypipe.reference import get_reference_map
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nstars', type=int, default=5000)
+    parser.add_argument('--ngals', type=int, default=20)
+    parser.add_argument('--size', type=int, default=3600, help='Brick size (pixels)')
+    opt = parser.parse_args()
+
+    pixscale = 0.262 / 3600.
+    W = H = opt.size
+    # a slightly rotated WCS, to exercise the ellipse orientation
+    th = np.deg2rad(10.)
+    wcs = Tan(100., 5., (W+1)/2., (H+1)/2.,
+              -pixscale * np.cos(th), pixscale * np.sin(th),
+              pixscale * np.sin(th), pixscale * np.cos(th), float(W), float(H))
+    refs = synthetic_refs(wcs, opt.nstars, opt.ngals, 42)
+
+    t0 = time.time()
+    m1 = reference_map_loop(wcs, refs)
+    t_loop = time.time() - t0
+    t0 = time.time()
+    m2 = get_reference_map(wcs, refs)
+    t_batch = time.time() - t0
+    print('%i stars, %i galaxies: one at a time %.2f s, batched %.2f s -- speedup %.1f' %
+          (opt.nstars, opt.ngals, t_loop, t_batch, t_loop / t_batch))
+    print('Masked pixels:', np.count_nonzero(m2))
+    assert(np.array_equal(m1, m2))
+    print('Masks are identical')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+'''
+Benchmark for cell-parallel unWISE forced photometry (see
+legacypipe.unwise.UnwiseCells): writes a synthetic unWISE tile, runs
+legacypipe.unwise.unwise_phot on a brick once as a whole and once
+split into cells (run in parallel and merged with UnwiseCells.merge),
+and reports the speedup and the differences.
+
+    python test/bench_unwise_cells.py --cells 4 --threads 16
+'''
+import os
+import time
+import numpy as np
+
+def write_unwise_tile(basedir, coadd_id, ra, dec, size, cat, seed=42, band=1):
+    '''
+    Writes a synthetic *size* x *size* unWISE tile *coadd_id* centred on
+    *ra*, *dec*, containing the sources *cat*, in the layout read by
+    wise.unwise.get_unwise_tractor_image; returns its WCS.
+    '''
+    import fitsio
+    from tractor import (Image, Tractor, LinearPhotoCal, ConstantSky,
+                         NCircularGaussianPSF, ConstantFitsWcs)
+    from legacypipe.unwise import unwise_tile_wcs
+    rng = np.random.RandomState(seed)
+    wcs = unwise_tile_wcs(ra, dec, W=size, H=size)
+    sig1 = 1.
+    tim = Image(data=np.zeros((size,size), np.float32),
+                inverr=np.ones((size,size), np.float32) / sig1,
+                wcs=ConstantFitsWcs(wcs), psf=NCircularGaussianPSF([1.], [1.]),
+                sky=ConstantSky(0.), photocal=LinearPhotoCal(1., band='w'))
+    img = Tractor([tim], cat).getModelImage(0)
+    img = (img + rng.normal(scale=sig1, size=img.shape)).astype(np.float32)
+
+    hdr = fitsio.FITSHDR()
+    for k,v in [('CTYPE1', 'RA---TAN'), ('CTYPE2', 'DEC--TAN'),
+                ('CRVAL1', ra), ('CRVAL2', dec),
+                ('CRPIX1', (size + 1) / 2.), ('CRPIX2', (size + 1) / 2.),
+                ('CD1_1', -2.75 / 3600.), ('CD1_2', 0.), ('CD2_1', 0.),
+                ('CD2_2', 2.75 / 3600.), ('IMAGEW', size), ('IMAGEH', size),
+                ('MAGZP', 22.5)]:
+        hdr.add_record(dict(name=k, value=v))
+    tdir = os.path.join(basedir, coadd_id[:3], coadd_id)
+    os.makedirs(tdir)
+    pat = os.path.join(tdir, 'unwise-%s-w%i-%%s.fits' % (coadd_id, band))
+    nims = np.zeros((size,size), np.int16) + 20
+    for kind,data in [('img-m', img),
+                      ('invvar-m', np.zeros((size,size), np.float32) + 1./sig1**2),
+                      ('n-m', nims), ('n-u', nims)]:
+        fn = pat % kind
+        if kind != 'img-m':
+            fn += '.gz'
+        fitsio.write(fn, data, header=hdr, clobber=True)
+    return wcs
+
+def synthetic_brick(basedir, nsrcs=1000, size=3600, seed=42):
+    '''
+    Writes a synthetic unWISE tile covering a *size* x *size* brick with
+    *nsrcs* sources; returns the brick WCS and the unwise_phot arguments
+    (W1, with models) for it.
+    '''
+    from astrometry.util.util import Tan
+    from astrometry.util.fits import fits_table
+    from tractor import PointSource, RaDecPos, NanoMaggies
+
+    rng = np.random.RandomState(seed)
+    ra,dec = 180., 0.
+    pixscale = 0.262
+    brickwcs = Tan(ra, dec, (size+1)/2., (size+1)/2., -pixscale/3600., 0., 0.,
+                   pixscale/3600., float(size), float(size))
+    x = rng.uniform(1, size, nsrcs)
+    y = rng.uniform(1, size, nsrcs)
+    rr,dd = brickwcs.pixelxy2radec(x, y)
+    flux = 10.**rng.uniform(1, 3.5, nsrcs)
+    truth = [PointSource(RaDecPos(r, d), NanoMaggies(w=f))
+             for r,d,f in zip(rr, dd, flux)]
+    # the tile covers the brick plus a margin
+    tilesize = int(np.ceil(size * pixscale / 2.75)) + 100
+    coadd_id = '1800p000'
+    write_unwise_tile(basedir, coadd_id, ra, dec, tilesize, truth, seed=seed)
+    tiles = fits_table()
+    tiles.coadd_id = np.array([coadd_id])
+    tiles.ra = np.array([ra])
+    tiles.dec = np.array([dec])
+    tiles.ra1 = np.array([ra - 1.])
+    tiles.ra2 = np.array([ra + 1.])
+    tiles.dec1 = np.array([dec - 1.])
+    tiles.dec2 = np.array([dec + 1.])
+    tiles.unwise_dir = np.array([basedir])
+
+    # initial fluxes for forced photometry
+    wcat = [PointSource(RaDecPos(r, d), NanoMaggies(w=1.)) for r,d in zip(rr, dd)]
+    # as in runbrick.stage_wise_forced
+    targetrd = np.array([brickwcs.pixelxy2radec(x,y) for x,y in
+                         [(1,1),(size,1),(size,size),(1,size),(1,1)]])
+    roiradec = [targetrd[0,0], targetrd[2,0], targetrd[0,1], targetrd[2,1]]
+    X = (wcat, tiles, 1, roiradec, False, False, True, None, None, False, None)
+    return brickwcs, X
+
+def run_whole_and_cells(X, brickwcs, ncells, halo=30.*2.75/0.262, mapper=map):
+    '''
+    Runs unwise_phot *X* for the whole brick, and in *ncells* x *ncells*
+    cells (with *mapper*, merged with UnwiseCells.merge); returns
+    (whole result, seconds, merged result, seconds).
+    '''
+    from legacypipe.unwise import unwise_phot, UnwiseCells
+    t0 = time.time()
+    R1 = unwise_phot(X)
+    t_whole = time.time() - t0
+
+    t0 = time.time()
+    cells = UnwiseCells(brickwcs, ncells, halo)
+    wcat = X[0]
+    ra  = np.array([src.getPosition().ra  for src in wcat])
+    dec = np.array([src.getPosition().dec for src in wcat])
+    split = cells.split(ra, dec)
+    R = list(mapper(unwise_phot, [cells.task_args(X, c) for c in split]))
+    R2 = cells.merge(split, R, len(wcat))
+    t_cells = time.time() - t0
+    return R1, t_whole, R2, t_cells
+
+def flux_differences(R1, R2, band=1):
+    '''
+    Returns the absolute flux differences of the results *R1*, *R2*,
+    in sigmas (of *R1*).
+    '''
+    f1 = R1.phot.get('flux_w%i' % band)
+    f2 = R2.phot.get('flux_w%i' % band)
+    iv = R1.phot.get('flux_ivar_w%i' % band)
+    ok = (iv > 0)
+    return np.abs(f1 - f2)[ok] * np.sqrt(iv[ok])
+
+def main():
+    import argparse
+    import tempfile
+    from multiprocessing import Pool
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cells', type=int, default=4, help='Cells per side')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--nsrcs', type=int, default=3000)
+    parser.add_argument('--size', type=int, default=3600, help='Brick size (pixels)')
+    opt = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    brickwcs,X = synthetic_brick(tempdir, nsrcs=opt.nsrcs, size=opt.size)
+    pool = Pool(opt.threads)
+    R1,t_whole,R2,t_cells = run_whole_and_cells(X, brickwcs, opt.cells, mapper=pool.map)
+    pool.close()
+    print('Whole brick: %.2f s' % t_whole)
+    print('%i x %i cells, %i processes: %.2f s -- speedup %.1f' %
+          (opt.cells, opt.cells, opt.threads, t_cells, t_whole / t_cells))
+    assert(np.all(R1.phot.wise_x == R2.phot.wise_x))
+    assert(np.all(R1.phot.wise_y == R2.phot.wise_y))
+    dflux = flux_differences(R1, R2)
+    print('Flux differences (sigmas): median %.3g, 99th pct %.3g, max %.3g' %
+          (np.median(dflux), np.percentile(dflux, 99), dflux.max()))
+    (_,_,_,_,mod1,_), = R1.models
+    (_,_,_,_,mod2,_), = R2.models
+    print('Model images: max difference %.3g' % np.abs(mod1 - mod2).max())
+
+if __name__ == '__main__':
+    main()
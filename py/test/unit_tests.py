@@ -56,6 +56,1567 @@ class TestOneblob(unittest.TestCase):
         mod = _select_model(chisqs, nparams, galaxy_margin)
         self.assertTrue(mod == 'dev')
 
+    def test_waves(self):
+        import numpy as np
+        from tractor import Patch
+        from legacypipe.oneblob import SourceModels, _non_overlapping_waves
+
+        def patch(x0, y0):
+            return Patch(x0, y0, np.ones((10,10), np.float32))
+        models = SourceModels()
+        # one tim; sources 0 and 1 overlap; 2 is separate; 3 overlaps 1.
+        models.models = [[patch(0,0), patch(5,5), patch(50,50), patch(12,12)]]
+        waves = _non_overlapping_waves(models, [0, 1, 2, 3])
+        self.assertEqual(waves, [[0, 2], [1], [3]])
+
+    def test_model_cache(self):
+        import numpy as np
+        from tractor import (Image, PointSource, PixPos, NanoMaggies,
+                             LinearPhotoCal, ConstantSky, NCircularGaussianPSF)
+        from tractor.galaxy import ExpGalaxy, DevGalaxy
+        from tractor.ellipses import EllipseE
+        from tractor.wcs import NullWCS
+        from legacypipe.oneblob import SourceModels
+
+        tim = Image(data=np.zeros((50,50), np.float32),
+                    inverr=np.ones((50,50), np.float32),
+                    psf=NCircularGaussianPSF([1.5], [1.]), wcs=NullWCS(),
+                    sky=ConstantSky(0.), photocal=LinearPhotoCal(1., band='r'))
+        gal = ExpGalaxy(PixPos(25., 25.), NanoMaggies(r=10.),
+                        EllipseE(2., 0., 0.))
+        models = SourceModels()
+        models.create([tim], [gal])
+        models.update_and_subtract(0, gal, [tim])
+        self.assertTrue(np.array_equal(models.get_patch(0, tim, gal).patch,
+                                       gal.getModelPatch(tim).patch))
+        # Changing the shape (or the model type) must not re-use the patch.
+        gal.shape.setParams([3., 0.3, 0.])
+        p = models.get_patch(0, tim, gal)
+        self.assertTrue(np.array_equal(p.patch, gal.getModelPatch(tim).patch))
+        dev = DevGalaxy(gal.pos, gal.brightness, gal.shape)
+        models.cache[dev] = models.cache.pop(gal)
+        p = models.get_patch(0, tim, dev)
+        self.assertTrue(np.array_equal(p.patch, dev.getModelPatch(tim).patch))
+        psf = PointSource(PixPos(25., 25.), NanoMaggies(r=10.))
+        models.update_and_subtract(0, psf, [tim])
+        self.assertTrue(np.array_equal(models.get_patch(0, tim, psf).patch,
+                                       psf.getModelPatch(tim).patch))
+
+    def test_model_cache_galaxies(self):
+        # The patches of fit galaxies are re-used for the metrics, after
+        # _convert_ellipses has changed their shape parameterization.
+        import numpy as np
+        from tractor import (Image, PixPos, NanoMaggies, LinearPhotoCal,
+                             ConstantSky, NCircularGaussianPSF)
+        from tractor.galaxy import ExpGalaxy, DevGalaxy
+        from tractor.wcs import NullWCS
+        from legacypipe.survey import LegacyEllipseWithPriors
+        from legacypipe.oneblob import SourceModels, _convert_ellipses
+
+        tim = Image(data=np.zeros((50,50), np.float32),
+                    inverr=np.ones((50,50), np.float32),
+                    psf=NCircularGaussianPSF([1.5], [1.]), wcs=NullWCS(),
+                    sky=ConstantSky(0.), photocal=LinearPhotoCal(1., band='r'))
+        for clazz in [ExpGalaxy, DevGalaxy]:
+            gal = clazz(PixPos(25., 25.), NanoMaggies(r=10.),
+                        LegacyEllipseWithPriors(np.log(2.), 0.2, -0.1))
+            models = SourceModels()
+            models.create([tim], [gal])
+            models.update_and_subtract(0, gal, [tim])
+            cached = models.cache[gal][1][0]
+            _convert_ellipses(gal)
+            p = models.get_patch(0, tim, gal)
+            # a cache hit...
+            self.assertTrue(p.patch is cached.patch)
+            # ... of the same model
+            self.assertTrue(np.allclose(p.patch, gal.getModelPatch(tim).patch,
+                                        rtol=1e-5, atol=1e-8))
+
+    def test_sersic_start(self):
+        from legacypipe.oneblob import _sersic_start
+
+        nparams = dict(psf=2, rex=3, exp=5, dev=5, ser=6)
+        galaxy_margin = 3.**2 + (nparams['exp'] - nparams['psf'])
+        # DEV/EXP improvement below the galaxy margin: no SER fit
+        chisqs = dict(psf=500, rex=505, exp=510, dev=512)
+        self.assertTrue(_sersic_start(chisqs, nparams, galaxy_margin) is None)
+        chisqs = dict(psf=0, rex=0, exp=0, dev=0)
+        self.assertTrue(_sersic_start(chisqs, nparams, galaxy_margin) is None)
+        # ... above it: start from the better one
+        chisqs = dict(psf=500, rex=505, exp=520, dev=512)
+        self.assertEqual(_sersic_start(chisqs, nparams, galaxy_margin), 'exp')
+        chisqs = dict(psf=500, rex=505, exp=520, dev=530)
+        self.assertEqual(_sersic_start(chisqs, nparams, galaxy_margin), 'dev')
+
+    def test_source_context(self):
+        import numpy as np
+        from astrometry.util.util import Tan
+        from tractor import (Image, PointSource, RaDecPos, NanoMaggies,
+                             LinearPhotoCal, ConstantSky, NCircularGaussianPSF,
+                             ConstantFitsWcs)
+        from legacypipe.oneblob import SourceContext
+
+        pixscale = 0.262 / 3600.
+        wcs = Tan(100., 5., 25.5, 25.5, -pixscale, 0., 0., pixscale, 50., 50.)
+        tims = []
+        for i in range(2):
+            tim = Image(data=np.zeros((50,50), np.float32),
+                        inverr=np.ones((50,50), np.float32),
+                        psf=NCircularGaussianPSF([1.5], [1.]),
+                        wcs=ConstantFitsWcs(wcs), sky=ConstantSky(0.),
+                        photocal=LinearPhotoCal(1., band='r'))
+            tim.subwcs = wcs
+            tims.append(tim)
+        # the second image has no pixels in the sub-blob
+        tims[1].inverr[:, :] = 0.
+        orig = [tim.inverr for tim in tims]
+        ra,dec = wcs.pixelxy2radec(21., 21.)
+        src = PointSource(RaDecPos(ra, dec), NanoMaggies(r=1.))
+        blobmask = np.zeros((50,50), bool)
+        blobmask[10:30, 10:30] = True
+        ctx = SourceContext(tims, [{}, {}], wcs, (0,0), blobmask)
+        dilated = np.zeros((50,50), bool)
+        dilated[15:25, 12:20] = True
+        npix = ctx.mask(src, dilated)
+        self.assertEqual(npix, 80)
+        self.assertEqual(ctx.srctims, [tims[0]])
+        self.assertTrue(np.array_equal(tims[0].inverr > 0, dilated))
+        mm = ctx.modelMasks[0][src]
+        self.assertEqual((mm.x0, mm.y0, mm.w, mm.h), (12, 15, 8, 10))
+        self.assertTrue(ctx.in_blob(src.getPosition()))
+        ra,dec = wcs.pixelxy2radec(41., 21.)
+        self.assertFalse(ctx.in_blob(RaDecPos(ra, dec)))
+        ra,dec = wcs.pixelxy2radec(-5., 21.)
+        self.assertFalse(ctx.in_blob(RaDecPos(ra, dec)))
+        # reverting swaps back the original arrays, once
+        ctx.unmask()
+        self.assertTrue(tims[0].inverr is orig[0])
+        self.assertTrue(tims[1].inverr is orig[1])
+        tims[0].inverr = np.zeros((50,50), np.float32)
+        ctx.unmask()
+        self.assertFalse(tims[0].inverr is orig[0])
+
+    def test_shared_context(self):
+        # The source context is built once per source, not per model,
+        # and the images are unmasked after model selection.
+        from unittest import mock
+        import numpy as np
+        from legacypipe.oneblob import SourceContext
+        from bench_intra_blob import fit_blob
+
+        contexts = []
+        orig_init = SourceContext.__init__
+        def init(self, *args, **kwargs):
+            orig_init(self, *args, **kwargs)
+            contexts.append(self)
+        with mock.patch.object(SourceContext, '__init__', init):
+            B,_ = fit_blob(1, nsrcs=6, size=100, nimages=2)
+        self.assertTrue(len(contexts) > 0)
+        self.assertTrue(len(contexts) <= 2 * len(B))
+        ntried = sum(len(m) for m in B.all_models)
+        self.assertTrue(ntried > len(contexts))
+        for ctx in contexts:
+            self.assertEqual(ctx.saved_ies, [])
+            for tim in ctx.srctims:
+                self.assertTrue(np.all(tim.inverr > 0))
+
+    def test_threads(self):
+        # Fitting a big blob's sources in threads gives the serial fits.
+        from bench_intra_blob import fit_blob, same_fits
+        B1,_ = fit_blob(1, nsrcs=12, size=160, nimages=2)
+        B2,_ = fit_blob(2, nsrcs=12, size=160, nimages=2)
+        self.assertTrue(same_fits(B1, B2))
+
+    def test_hit_max_steps(self):
+        from legacypipe.oneblob import OneBlob
+        class Limits(object):
+            pass
+        ob = Limits()
+        ob.max_steps = None
+        self.assertFalse(OneBlob.hit_max_steps(ob, 50))
+        ob.max_steps = 5
+        # optimize_loop is given 6 steps: converging on step 5 (index 4)
+        # is within the limit; reaching index 5 is not.
+        self.assertFalse(OneBlob.hit_max_steps(ob, 4))
+        self.assertTrue(OneBlob.hit_max_steps(ob, 5))
+
+    def test_fit_limits(self):
+        # --fit-max-steps, --fit-dchisq-snr, --blob-cpu-budget on a small blob
+        import numpy as np
+        from legacypipe.oneblob import one_blob
+        from bench_intra_blob import synthetic_blob
+
+        def fit(**opts):
+            X = synthetic_blob(nsrcs=4, size=60, nimages=2)
+            return one_blob(X + (opts,))
+
+        B = fit()
+        self.assertFalse(np.any(B.hit_budget))
+
+        # Step limit: fits that converge within it are not marked
+        B = fit(max_steps=1000)
+        self.assertFalse(np.any(B.hit_budget))
+        B = fit(max_steps=1)
+        self.assertTrue(np.any(B.hit_budget))
+        for s in B.all_model_opt_steps:
+            self.assertTrue(all(v <= 1 for v in s.values()))
+
+        # A large dchisq_snr stops each fit after its first step
+        B = fit(dchisq_snr=1e6)
+        for s in B.all_model_opt_steps:
+            self.assertTrue(all(v == 0 for v in s.values()))
+
+        # Out of CPU budget: each source keeps its model type and only
+        # its fluxes are fit.
+        B = fit(cpu_budget=0.)
+        for s,src,hit in zip(B.all_models, B.sources, B.hit_budget):
+            if src is None:
+                continue
+            self.assertTrue(hit)
+            self.assertTrue(set(s.keys()) <= set(['psf']))
+            self.assertEqual(type(src).__name__, 'PointSource')
+
+    def test_hit_budget_bit(self):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.bits import FITBITS
+        from legacypipe.runbrick import _set_fitbits
+        T = fits_table()
+        N = 3
+        for c in ['forced_pointsource', 'fit_background', 'hit_r_limit',
+                  'hit_ser_limit', 'iterative']:
+            T.set(c, np.zeros(N, bool))
+        T.bx = T.bx0 = T.by = T.by0 = np.zeros(N, np.float32)
+        T.hit_budget = np.array([False, True, False])
+        _set_fitbits(T, 0.262)
+        self.assertEqual(list(T.fitbits), [0, FITBITS['HIT_BUDGET'], 0])
+
+    def test_thread_cpu_time(self):
+        # (falls back to the process CPU time before Python 3.7)
+        from unittest import mock
+        from legacypipe import oneblob
+        for avail in [oneblob.thread_time_available(), False]:
+            with mock.patch.object(oneblob, 'thread_time_available',
+                                   return_value=avail):
+                t0 = oneblob.thread_cpu_time()
+                sum(range(100000))
+                self.assertTrue(oneblob.thread_cpu_time() >= t0)
+        # fit_blob, with threads, on this python
+        from bench_intra_blob import fit_blob
+        with mock.patch.object(oneblob, 'thread_time_available',
+                               return_value=False):
+            B,_ = fit_blob(2, nsrcs=6, size=100, nimages=2)
+        self.assertTrue(all(B.cpu_source >= 0))
+
+    def test_source_metrics(self):
+        import numpy as np
+        from tractor import Image, Tractor, PointSource, PixPos, NanoMaggies
+        from tractor import LinearPhotoCal, ConstantSky, NCircularGaussianPSF
+        from tractor.wcs import NullWCS
+        from legacypipe.oneblob import (_compute_source_metrics,
+                                        _compute_source_metrics_loop)
+        rng = np.random.RandomState(42)
+        bands = ['g', 'r', 'z']
+        tims = []
+        for i in range(5):
+            band = bands[i % 2]
+            H,W = 40, 50
+            ie = np.ones((H,W), np.float32)
+            ie[rng.uniform(size=(H,W)) < 0.05] = 0.
+            tim = Image(data=rng.normal(size=(H,W)).astype(np.float32),
+                        inverr=ie, psf=NCircularGaussianPSF([1.5 + 0.2*i], [1.]),
+                        wcs=NullWCS(), sky=ConstantSky(0.1),
+                        photocal=LinearPhotoCal(1., band=band))
+            tim.band = band
+            tims.append(tim)
+        # blended, near-edge, off-image and zero-flux sources
+        srcs = [PointSource(PixPos(x, y), NanoMaggies(g=f, r=2*f, z=f))
+                for x,y,f in [(10,10,50), (13,11,20), (48,20,30),
+                              (25,38,10), (100,100,10), (30,20,0)]]
+        tr = Tractor(tims, srcs)
+        M1 = _compute_source_metrics(srcs, tims, bands, tr)
+        M2 = _compute_source_metrics_loop(srcs, tims, bands, tr)
+        self.assertEqual(sorted(M1.keys()), sorted(M2.keys()))
+        for k in M2.keys():
+            self.assertTrue(np.allclose(M1[k], M2[k], rtol=1e-5, atol=1e-6), k)
+
+class TestStageStore(unittest.TestCase):
+
+    def test_roundtrip(self):
+        import tempfile
+        import numpy as np
+        from legacypipe.stagestore import StageStore, runstage
+
+        def stagefunc(stage, **kwargs):
+            if stage == 'a':
+                return dict(img=np.arange(100000, dtype=np.float32),
+                            name='x')
+            if stage == 'b':
+                self.assertTrue('img' not in kwargs)
+                return dict(name=kwargs['name'] + 'y')
+            if stage == 'c':
+                self.assertEqual(kwargs['name'], 'xy')
+                return dict(total=float(np.sum(kwargs['img'])))
+        names = dict(a=[], b=['name'], c=['img', 'name'])
+        prereqs = dict(a=None, b='a', c='b')
+
+        with tempfile.TemporaryDirectory() as d:
+            store = StageStore(d)
+            R = runstage('c', store, stagefunc, prereqs=prereqs,
+                         stage_args=lambda s: names[s])
+            self.assertEqual(R['total'], float(np.sum(np.arange(100000))))
+            # 'img' was not touched by stage 'b', so it is shared.
+            self.assertEqual(store.read_index('a')['img'],
+                             store.read_index('b')['img'])
+            R = store.read_stage('c')
+            self.assertEqual(R['name'], 'xy')
+            self.assertTrue(np.all(R['img'] == np.arange(100000)))
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_truncated(self):
+        import os
+        import tempfile
+        from legacypipe.checkpoint import CheckpointWriter, read_checkpoint
+
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'checkpoint.pickle')
+            with CheckpointWriter(fn) as w:
+                for i in range(3):
+                    w.append(dict(brickname='b', iblob=i, result=None))
+            # Appending reopens the existing file.
+            with CheckpointWriter(fn) as w:
+                w.append(dict(brickname='b', iblob=3, result=None))
+            R = list(read_checkpoint(fn))
+            self.assertEqual([r['iblob'] for r in R], [0, 1, 2, 3])
+            # Chop the last record in half.
+            sz = os.path.getsize(fn)
+            with open(fn, 'r+b') as f:
+                f.truncate(sz - 5)
+            R = list(read_checkpoint(fn))
+            self.assertEqual([r['iblob'] for r in R], [0, 1, 2])
+            # Resuming cuts off the bad tail, so new records read back.
+            with CheckpointWriter(fn) as w:
+                for i in [3, 4]:
+                    w.append(dict(brickname='b', iblob=i, result=None))
+            R = list(read_checkpoint(fn))
+            self.assertEqual([r['iblob'] for r in R], [0, 1, 2, 3, 4])
+            # Likewise for a corrupted (rather than truncated) tail.
+            with open(fn, 'ab') as f:
+                f.write(b'garbage')
+            with CheckpointWriter(fn) as w:
+                w.append(dict(brickname='b', iblob=5, result=None))
+            R = list(read_checkpoint(fn))
+            self.assertEqual([r['iblob'] for r in R], [0, 1, 2, 3, 4, 5])
+
+    def test_unpicklable(self):
+        import os
+        import zlib
+        import tempfile
+        from legacypipe.checkpoint import (CheckpointWriter, read_checkpoint,
+                                           RECORD_MAGIC, _frame)
+
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'checkpoint.pickle')
+            with CheckpointWriter(fn) as w:
+                for i in range(2):
+                    w.append(dict(brickname='b', iblob=i, result=None))
+                # A record with a good checksum that does not unpickle,
+                # followed by a good one.
+                data = b'not a pickle'
+                w.f.write(_frame.pack(RECORD_MAGIC, len(data),
+                                      zlib.crc32(data) & 0xffffffff))
+                w.f.write(data)
+                w.append(dict(brickname='b', iblob=2, result=None))
+            R = list(read_checkpoint(fn))
+            self.assertEqual([r['iblob'] for r in R], [0, 1])
+            # Resuming cuts the file at the bad record.
+            with CheckpointWriter(fn) as w:
+                w.append(dict(brickname='b', iblob=3, result=None))
+            R = list(read_checkpoint(fn))
+            self.assertEqual([r['iblob'] for r in R], [0, 1, 3])
+
+            # An unreadable old-format file is replaced by a new log.
+            fn = os.path.join(d, 'old.pickle')
+            with open(fn, 'wb') as f:
+                f.write(b'garbage')
+            with CheckpointWriter(fn) as w:
+                w.append(dict(brickname='b', iblob=0, result=None))
+            R = list(read_checkpoint(fn))
+            self.assertEqual([r['iblob'] for r in R], [0])
+
+class TestSharedTims(unittest.TestCase):
+
+    def test_share(self):
+        import numpy as np
+        from tractor import Image
+        from legacypipe.sharedtims import (SharedTimPixels, get_pixels,
+                                           shared_memory_available)
+        if not shared_memory_available():
+            self.skipTest('multiprocessing.shared_memory needs Python >= 3.8')
+        rng = np.random.RandomState(2)
+        tims = []
+        orig = []
+        for i in range(3):
+            img = rng.normal(size=(50+i, 40)).astype(np.float32)
+            ie = rng.uniform(size=img.shape).astype(np.float32)
+            dq = rng.randint(0, 8, size=img.shape).astype(np.int16)
+            tim = Image(data=img.copy(), inverr=ie.copy())
+            tim.dq = dq.copy()
+            tims.append(tim)
+            orig.append((img, ie, dq))
+        with SharedTimPixels(tims) as shared:
+            slc = (slice(5, 20), slice(3, 30))
+            for itim,(img,ie,dq) in enumerate(orig):
+                # the tims now use the shared pixels...
+                self.assertFalse(tims[itim].getImage().flags.owndata)
+                self.assertTrue(np.array_equal(tims[itim].getImage(), img))
+                for plane,a in [('img', img), ('inverr', ie), ('dq', dq)]:
+                    self.assertTrue(np.array_equal(
+                        get_pixels(shared.get(itim, plane, slc)), a[slc]))
+        # ... and get private copies back.
+        for tim,(img,ie,dq) in zip(tims, orig):
+            self.assertTrue(tim.getImage().flags.owndata)
+            self.assertTrue(np.array_equal(tim.getImage(), img))
+            self.assertTrue(np.array_equal(tim.getInvError(), ie))
+            self.assertTrue(np.array_equal(tim.dq, dq))
+
+    def test_attach_untracked(self):
+        # Workers attaching to the segment do not register it with a
+        # resource tracker (which could unlink it when they exit).
+        from unittest import mock
+        import numpy as np
+        from tractor import Image
+        from multiprocessing import resource_tracker
+        from legacypipe import sharedtims
+        if not sharedtims.shared_memory_available():
+            self.skipTest('multiprocessing.shared_memory needs Python >= 3.8')
+        tim = Image(data=np.ones((10,10), np.float32),
+                    inverr=np.ones((10,10), np.float32))
+        tim.dq = None
+        with sharedtims.SharedTimPixels([tim]) as shared:
+            with mock.patch.object(resource_tracker, 'register') as reg:
+                sharedtims._attached[:] = [None, None]
+                p = shared.get(0, 'img', (slice(2,4), slice(0,3)))
+                self.assertTrue(np.all(sharedtims.get_pixels(p) == 1.))
+                self.assertFalse(reg.called)
+            self.assertTrue(shared.get(0, 'dq', None) is None)
+            sharedtims._attached[:] = [None, None]
+
+class TestBlobCost(unittest.TestCase):
+
+    def test_fit_and_schedule(self):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.blobcost import (BlobCostModel, schedule_blobs,
+                                         _add_derived_features)
+        F = fits_table()
+        F.nsrcs = np.array([1, 2, 5, 1, 20])
+        F.totalpix = np.array([1e3, 5e3, 1e4, 1e5, 1e6])
+        F.nlarge = np.zeros(5, int)
+        F.nfrozen = np.zeros(5, int)
+        _add_derived_features(F)
+        truth = BlobCostModel(dict(one=1., nsrcs=2., totalpix=1e-4, srcpix=1e-6))
+        cpu = truth.predict(F)
+        model = BlobCostModel()
+        model.fit(F, cpu, features=['one', 'nsrcs', 'totalpix', 'srcpix'])
+        self.assertTrue(np.allclose(model.predict(F), cpu))
+        order = schedule_blobs(cpu)
+        self.assertEqual(list(order), [4, 3, 2, 1, 0])
+        order,strag = schedule_blobs(cpu, nworkers=4, tail_aware=True)
+        self.assertEqual(list(np.flatnonzero(strag)), [4])
+
+    def test_all_models_features(self):
+        # nlarge and nfrozen are read from the all-models blob columns
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.blobcost import all_models_features
+        T = fits_table()
+        T.blob = np.array([0, 0, 1, 2, -1])
+        T.type = np.array(['PSF', 'EXP', 'SER', 'DUP', 'PSF'])
+        T.cpu_blob = np.array([2., 2., 5., 1., 1.], np.float32)
+        T.blob_npix = np.array([100, 100, 400, 10, 10])
+        T.blob_nimages = np.array([3, 3, 4, 1, 1], np.int16)
+        T.blob_totalpix = np.array([300, 300, 1600, 10, 10], np.int32)
+        F,cpu = all_models_features(T)
+        self.assertEqual(list(F.nsrcs), [2, 1])
+        self.assertEqual(list(F.nlarge), [0, 0])
+        T.blob_nlarge = np.array([0, 0, 1, 0, 0], np.int16)
+        T.blob_nfrozen = np.array([2, 2, 0, 0, 0], np.int16)
+        F,cpu = all_models_features(T)
+        self.assertEqual(list(cpu), [2., 5.])
+        self.assertEqual(list(F.nlarge), [0, 1])
+        self.assertEqual(list(F.nfrozen), [2, 0])
+        self.assertEqual(list(F.nlargepix), [0, 1600])
+        self.assertEqual(list(F.nfrozenpix), [600, 0])
+
+    def test_blob_features_recorded(self):
+        # one_blob records the nlarge and nfrozen features
+        import numpy as np
+        from tractor import PointSource, RaDecPos, NanoMaggies
+        from tractor.galaxy import ExpGalaxy
+        from tractor.ellipses import EllipseE
+        from legacypipe.oneblob import one_blob
+        from legacypipe.blobcost import count_large_galaxies
+        from bench_intra_blob import synthetic_blob
+
+        gal = ExpGalaxy(RaDecPos(0., 0.), NanoMaggies(r=1.), EllipseE(1., 0., 0.))
+        ref = ExpGalaxy(RaDecPos(0., 0.), NanoMaggies(r=1.), EllipseE(1., 0., 0.))
+        ref.is_reference_source = True
+        star = PointSource(RaDecPos(0., 0.), NanoMaggies(r=1.))
+        star.is_reference_source = True
+        self.assertEqual(count_large_galaxies([gal, ref, star, ref]), 2)
+
+        X = list(synthetic_blob(nsrcs=3, size=60, nimages=2))
+        pos = X[10][1].getPosition()
+        X[20] = [ExpGalaxy(RaDecPos(pos.ra, pos.dec), NanoMaggies(g=1., r=1.),
+                           EllipseE(1., 0., 0.))]
+        B = one_blob(tuple(X))
+        self.assertTrue(np.all(B.blob_nlarge == 0))
+        self.assertTrue(np.all(B.blob_nfrozen == 1))
+
+class TestHealpixCache(unittest.TestCase):
+
+    def test_lru(self):
+        import os
+        import tempfile
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.ps1cat import HealpixChunkCache, _subtable
+
+        with tempfile.TemporaryDirectory() as d:
+            fns = []
+            for i in range(3):
+                T = fits_table()
+                T.ra = np.arange(1000, dtype=np.float64)
+                T.dec = np.zeros(1000)
+                T.mag = np.ones(1000, np.float32) * i
+                fn = os.path.join(d, 'chunk-%i.fits' % i)
+                T.writeto(fn)
+                fns.append(fn)
+            # room for two full chunks
+            cache = HealpixChunkCache(2 * 20000)
+            T = cache.get(fns[0])
+            self.assertEqual(sorted(T.get_columns()), ['dec', 'mag', 'ra'])
+            # a projection is served from the full-column entry
+            cache.get(fns[0], columns=['ra', 'dec'])
+            cache.get(fns[1], columns=['mag'])
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.stats()['misses'], 2)
+            # ... but not the other way round
+            T = cache.get(fns[1])
+            self.assertTrue(np.all(T.mag == 1))
+            self.assertEqual(cache.stats()['misses'], 3)
+            # evicts the least-recently used chunk (0)
+            cache.get(fns[0])
+            cache.get(fns[2])
+            self.assertEqual(list(cache.entries.keys()), [fns[0], fns[2]])
+            self.assertTrue(cache.nbytes <= cache.maxbytes)
+            # requested columns the file lacks are skipped
+            T = cache.get(fns[1], columns=['mag', 'a_g_val'])
+            self.assertEqual(T.get_columns(), ['mag'])
+            self.assertEqual(_subtable(T, columns=['mag', 'a_g_val']).get_columns(),
+                             ['mag'])
+
+class TestTileCache(unittest.TestCase):
+
+    def test_cutouts(self):
+        import os
+        import tempfile
+        import numpy as np
+        import fitsio
+        from legacypipe.tilecache import TileCutoutCache
+
+        with tempfile.TemporaryDirectory() as d:
+            img = np.arange(100*100, dtype=np.float32).reshape(100,100)
+            fns = [os.path.join(d, 'tile-%i.fits' % i) for i in range(3)]
+            for i,fn in enumerate(fns):
+                fitsio.write(fn, img + 1000 * i, clobber=True)
+            # room for two 100x100 float32 tiles
+            cache = TileCutoutCache(os.path.join(d, 'cache'), 2 * 41000)
+            c = cache.read(fns[0], 0, 10, 50, 20, 60)
+            self.assertTrue(np.all(c == img[10:50, 20:60]))
+            # a different cutout of the same tile (eg, the next brick's)
+            c = cache.read(fns[0], 0, 40, 80, 50, 90)
+            self.assertTrue(np.all(c == img[40:80, 50:90]))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            c = cache.read(fns[1], 0, 0, 40, 0, 40)
+            self.assertTrue(np.all(c == img[:40, :40] + 1000))
+            cache.read(fns[2], 0, 60, 100, 60, 100)
+            self.assertEqual(cache.misses, 3)
+            npy = [f for f in os.listdir(cache.cachedir) if f.endswith('.npy')]
+            self.assertEqual(len(npy), 2)
+            # rewriting a tile invalidates it
+            fitsio.write(fns[2], img + 1, clobber=True)
+            c = cache.read(fns[2], 0, 0, 40, 0, 40)
+            self.assertTrue(np.all(c == img[:40, :40] + 1))
+            self.assertEqual(cache.misses, 4)
+
+    def test_evict(self):
+        import os
+        import subprocess
+        import sys
+        import tempfile
+        from legacypipe.tilecache import TileCutoutCache
+
+        with tempfile.TemporaryDirectory() as d:
+            cache = TileCutoutCache(d, 1000)
+            # a finished process's pid
+            p = subprocess.Popen([sys.executable, '-c', 'pass'])
+            p.wait()
+            stale = os.path.join(d, 'a.npy.tmp-%i' % p.pid)
+            live = os.path.join(d, 'b.npy.tmp-%i' % os.getpid())
+            for fn in [stale, live, os.path.join(d, 'c.npy.lock')]:
+                with open(fn, 'wb') as f:
+                    f.write(b'x' * 100)
+            cache.evict()
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(os.path.exists(live))
+            self.assertTrue(os.path.exists(os.path.join(d, 'c.npy.lock')))
+            # live temporary files count towards the budget
+            old = os.path.join(d, 'old.npy')
+            with open(old, 'wb') as f:
+                f.write(b'x' * 950)
+            os.utime(old, (1, 1))
+            cache.evict()
+            self.assertFalse(os.path.exists(old))
+            self.assertTrue(os.path.exists(live))
+
+    def test_fetch_files(self):
+        import os
+        import tempfile
+        from legacypipe.tilecache import TileCutoutCache
+
+        with tempfile.TemporaryDirectory() as d:
+            src = os.path.join(d, 'src')
+            os.makedirs(src)
+            fns = [os.path.join(src, 'tile-%s.fits' % k) for k in ['img', 'n']]
+            for fn in fns:
+                with open(fn, 'wb') as f:
+                    f.write(fn.encode())
+            cache = TileCutoutCache(os.path.join(d, 'cache'), 10000)
+            path = cache.fetch_files(fns, os.path.join('000', '0000p000'))
+            for fn in fns:
+                with open(os.path.join(path, '000', '0000p000', os.path.basename(fn)),
+                          'rb') as f:
+                    self.assertEqual(f.read(), fn.encode())
+            self.assertEqual(cache.fetch_files(fns, os.path.join('000', '0000p000')),
+                             path)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            # a changed file makes a new entry
+            with open(fns[1], 'wb') as f:
+                f.write(b'changed')
+            self.assertNotEqual(cache.fetch_files(fns, os.path.join('000', '0000p000')),
+                                path)
+
+
+def _times_ten(x):
+    i,_ = x
+    return 10 * i
+
+class TestFarm(unittest.TestCase):
+
+    def setUp(self):
+        import threading
+        # Set to stop the farm and worker threads started by a test
+        self.done = threading.Event()
+        self.threads = []
+
+    def tearDown(self):
+        self.done.set()
+        for t in self.threads:
+            t.join(timeout=10)
+            self.assertFalse(t.is_alive())
+
+    def start_thread(self, target, args, kwargs):
+        import threading
+        t = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        t.start()
+        self.threads.append(t)
+
+    def free_port(self):
+        import socket
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def test_loopback(self):
+        # Runs the farm's network thread and several workers on this machine.
+        import pickle
+        import queue
+        import time
+        import numpy as np
+        from legacypipe.farm import network_thread, PrioritizedItem
+        from legacypipe.worker import run
+        from legacypipe.workpacket import PacketEncoder
+
+        port = self.free_port()
+        server = 'tcp://127.0.0.1:%i' % port
+
+        nblobs = 20
+        inqueue = queue.Queue()
+        outqueue = queue.Queue()
+        encoder = PacketEncoder()
+        shared = np.arange(10000)
+        encoder.share(shared)
+        for i in range(nblobs):
+            inqueue.put(PrioritizedItem(item=('b', i, encoder.encode(('b', i, (i, shared))))))
+        self.start_thread(network_thread,
+                          (None, port, None, inqueue, outqueue, None, 'test', 2.),
+                          dict(stop=self.done))
+        # This worker quits after one blob, abandoning its prefetched packets,
+        # which must be redelivered to the others.
+        self.start_thread(run, (server,),
+                          dict(prefetch=4, heartbeat=0.2, func=_times_ten,
+                               max_blobs=1, done=self.done))
+        time.sleep(0.5)
+        for i in range(3):
+            self.start_thread(run, (server,),
+                              dict(prefetch=2, heartbeat=0.2, func=_times_ten,
+                                   done=self.done))
+        results = {}
+        while len(results) < nblobs:
+            br,iblob,msg = outqueue.get(timeout=30)
+            self.assertFalse(iblob in results)
+            results[iblob] = pickle.loads(msg)
+        self.assertEqual(results, dict([(i, 10*i) for i in range(nblobs)]))
+
+    def test_reset(self):
+        # A worker the farm does not know gets one b'reset', however many
+        # messages it sends; repeated b'ready's do not add up credits.
+        import pickle
+        import queue
+        import time
+        import zmq
+        from legacypipe.farm import network_thread, PrioritizedItem
+        from legacypipe.workpacket import PacketEncoder
+
+        port = self.free_port()
+        inqueue = queue.Queue()
+        outqueue = queue.Queue()
+        encoder = PacketEncoder()
+        self.start_thread(network_thread,
+                          (None, port, None, inqueue, outqueue, None, 'test', 30.),
+                          dict(stop=self.done))
+        ctx = zmq.Context()
+        sock = ctx.socket(zmq.DEALER)
+        sock.connect('tcp://127.0.0.1:%i' % port)
+
+        def receive(wait=1000):
+            msgs = []
+            while sock.poll(timeout=wait):
+                msgs.append(sock.recv_multipart())
+                wait = 200
+            return msgs
+        try:
+            for i in range(3):
+                sock.send_multipart([b'heartbeat', b'me'])
+            self.assertEqual(receive(), [[b'reset']])
+            hello = [b'ready', b'me', pickle.dumps((1, 10**6), -1)]
+            sock.send_multipart(hello)
+            sock.send_multipart(hello)
+            time.sleep(0.5)
+            for i in range(3):
+                inqueue.put(PrioritizedItem(item=('b', i, encoder.encode(('b', i, i)))))
+            msgs = receive(2000)
+            self.assertEqual([m[0] for m in msgs], [b'work'])
+        finally:
+            sock.close(linger=0)
+            ctx.term()
+
+    def test_empty_bricks(self):
+        # Bricks without blobs must not keep their --bricks-in-flight slots.
+        import sys
+        import threading
+        from unittest import mock
+        import legacypipe.farm as farm
+
+        class Task(object):
+            SUCCEEDED = 'Succeeded'
+            FAILED = 'Failed'
+            def __init__(self, name):
+                self.task = self.id = name
+                self.state = None
+            def set_state(self, state, err=None):
+                self.state = state
+        tasks = [Task('brick%i' % i) for i in range(4)]
+        todo = list(tasks)
+        class Queue(object):
+            def get(self, timeout=None):
+                return todo.pop(0) if len(todo) else None
+        qdo = mock.Mock(Task=Task)
+        qdo.connect.return_value = Queue()
+
+        slots = threading.Semaphore(2)
+        with mock.patch.dict(sys.modules, qdo=qdo), \
+             mock.patch.object(farm, 'queue_work', return_value=0):
+            t = threading.Thread(target=farm.input_thread,
+                                 args=('q', None, None, None, None, slots, None, 0),
+                                 daemon=True)
+            t.start()
+            t.join(timeout=10)
+        self.assertFalse(t.is_alive())
+        self.assertEqual([task.state for task in tasks], ['Succeeded'] * 4)
+        self.assertTrue(slots.acquire(blocking=False))
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_brick_schedule(self):
+        from collections import Counter
+        from legacypipe.farm import BrickSchedule
+        outstanding = Counter()
+        sched = BrickSchedule('fair')
+        for br in ['a', 'b']:
+            for i in range(3):
+                sched.add(br, i, -i, None)
+        # 'a' arrived first; then take turns; largest (lowest priority) first
+        order = []
+        while len(sched):
+            br,i,_ = sched.pop(outstanding)
+            outstanding[br] += 1
+            order.append((br, i))
+        self.assertEqual(order, [('a',2), ('b',2), ('a',1), ('b',1), ('a',0), ('b',0)])
+        sched = BrickSchedule('deadline')
+        for br in ['a', 'b']:
+            sched.add(br, 0, 0, None)
+        outstanding = Counter(a=10)
+        self.assertEqual(sched.pop(outstanding)[0], 'a')
+
+    def test_workpacket(self):
+        import numpy as np
+        from legacypipe.workpacket import (PacketEncoder, ObjectCache, ObjectMemo,
+                                           decode_packet)
+
+        encoder = PacketEncoder()
+        shared = dict(name='tim', x=np.arange(100))
+        encoder.share(shared)
+        psf = np.ones(10000)
+        farm_cache = ObjectCache(10**6)
+        worker_cache = ObjectCache(10**6)
+        memo = ObjectMemo()
+        for i in range(3):
+            x = (i, shared, psf, np.zeros(10000) + i)
+            packet,deps,objs = encoder.encode(x)
+            # the psf array is shared from its second use
+            self.assertEqual(len(deps), 1 if i == 0 else 2)
+            new = farm_cache.missing(deps)
+            self.assertEqual(len(new), 0 if i == 2 else 1)
+            farm_cache.update(deps, objs, keep_values=False)
+            worker_cache.update(deps, dict([(h, objs[h]) for h in new]))
+            y = decode_packet(packet, dict([(h, worker_cache.get(h)) for h in deps]), memo)
+            self.assertEqual(y[0], i)
+            self.assertEqual(y[1]['name'], 'tim')
+            self.assertTrue(np.all(y[2] == psf))
+            self.assertTrue(np.all(y[3] == i))
+        self.assertEqual(list(farm_cache.entries.keys()), list(worker_cache.entries.keys()))
+        self.assertEqual(len(memo), 2)
+
+        # The decoded objects are kept within a byte budget (the psf
+        # array alone, pickled, takes 80 kB).
+        memo = ObjectMemo(50000)
+        for i in range(2):
+            packet,deps,objs = encoder.encode((shared, psf))
+            y = decode_packet(packet, objs, memo)
+            self.assertTrue(np.all(y[1] == psf))
+            self.assertEqual(len(memo), 1)
+            self.assertTrue(memo.nbytes > 80000)
+
+def _halo_model_loop(refs, rr, dd, wcs, pixscale, band, ccdname, inner):
+    # The original star-by-star halo model, for comparison.
+    import numpy as np
+    from legacypipe.halos import moffat
+    fluxes = 10.**((refs.get('decam_mag_%s' % band) - 22.5) / -2.5)
+    H,W = wcs.shape
+    H,W = int(H),int(W)
+    halo = np.zeros((H,W), np.float32)
+    for ref,flux,ra,dec in zip(refs, fluxes, rr, dd):
+        _,x,y = wcs.radec2pixelxy(ra, dec)
+        x -= 1.
+        y -= 1.
+        rad_arcsec = ref.radius * 3600.
+        rad_arcsec *= 4.0
+        rad_arcsec = np.minimum(rad_arcsec, 400.)
+        pixrad = int(np.ceil(rad_arcsec / pixscale))
+        xlo = int(np.clip(np.floor(x - pixrad), 0, W-1))
+        xhi = int(np.clip(np.ceil (x + pixrad), 0, W-1))
+        ylo = int(np.clip(np.floor(y - pixrad), 0, H-1))
+        yhi = int(np.clip(np.ceil (y + pixrad), 0, H-1))
+        if xlo == xhi or ylo == yhi:
+            continue
+        rads = np.hypot(np.arange(ylo, yhi+1)[:,np.newaxis] - y,
+                        np.arange(xlo, xhi+1)[np.newaxis,:] - x)
+        maxr = pixrad
+        apr = maxr*0.5
+        apodize = np.clip((rads - maxr) / (apr - maxr), 0., 1.)
+        apr_i0 = 7. / pixscale
+        apr_i1 = 8. / pixscale
+        apodize *= np.clip((rads - apr_i0) / (apr_i1 - apr_i0), 0., 1.)
+        if band == 'z':
+            if ccdname.strip() in ['N20', 'S8', 'S10', 'S18', 'S21', 'S27']:
+                alpha, beta, weight = 16, 2.3, 0.0095
+            else:
+                alpha, beta, weight = 17.650, 1.7, 0.0145
+            if x < 0 or y < 0 or x > W-1 or y > H-1:
+                weight *= 0.5
+            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * weight *
+                                           moffat(rads*pixscale, alpha, beta) * pixscale**2)
+        else:
+            f = dict(g=0.00045, r=0.00033)[band]
+            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * f * (rads*pixscale)**-2
+                                           * pixscale**2)
+        if inner is not None:
+            halo[ylo:yhi+1, xlo:xhi+1] += (flux * apodize * 1. *
+                                           moffat(rads*pixscale, *inner) * pixscale**2)
+    return halo
+
+class TestHalos(unittest.TestCase):
+
+    def test_halo_model(self):
+        import numpy as np
+        from astrometry.util.util import Tan
+        from astrometry.util.fits import fits_table
+        from legacypipe.halos import decam_halo_model
+        from legacypipe.survey import radec_at_mjd
+
+        class duck(object):
+            pass
+
+        pixscale = 0.262
+        W,H = 2046,4094
+        wcs = Tan(30., 0., (W+1)/2., (H+1)/2., -pixscale/3600., 0., 0., pixscale/3600.,
+                  float(W), float(H))
+        rng = np.random.RandomState(17)
+        n = 200
+        refs = fits_table()
+        # stars on and off the chip
+        x = rng.uniform(-500, W+500, n)
+        y = rng.uniform(-500, H+500, n)
+        refs.ra,refs.dec = wcs.pixelxy2radec(x, y)
+        refs.ref_epoch = np.zeros(n, np.float32) + 2015.5
+        refs.pmra = rng.normal(scale=10., size=n).astype(np.float32)
+        refs.pmdec = rng.normal(scale=10., size=n).astype(np.float32)
+        refs.parallax = np.zeros(n, np.float32)
+        mag = rng.uniform(8., 16., n).astype(np.float32)
+        refs.radius = (np.clip(1630. * 1.396**(-mag), 0., 300.) / 3600.).astype(np.float32)
+        mjd = 58000.
+        rr,dd = radec_at_mjd(refs.ra, refs.dec, refs.ref_epoch.astype(float),
+                             refs.pmra, refs.pmdec, refs.parallax, mjd)
+        psf = duck()
+        psf.moffat = (0.8, 2.5)
+        for band in ['g', 'r', 'z']:
+            refs.set('decam_mag_%s' % band, mag)
+            for ccdname in ['N4', 'S8']:
+                imobj = duck()
+                imobj.ccdname = ccdname
+                for inner in [None, psf]:
+                    h1 = decam_halo_model(refs, mjd, wcs, pixscale, band, imobj,
+                                          inner is not None, psf=inner)
+                    h2 = _halo_model_loop(refs, rr, dd, wcs, pixscale, band, ccdname,
+                                          inner and inner.moffat)
+                    self.assertTrue(np.array_equal(h1, h2))
+                    self.assertTrue(np.any(h1 > 0))
+
+class TestCCDIndex(unittest.TestCase):
+
+    def test_index(self):
+        import os
+        import shutil
+        import tempfile
+        import numpy as np
+        from legacypipe.survey import LegacySurveyData, wcs_for_brick
+        from legacypipe.create_ccd_index import create_ccd_index
+
+        fn = os.path.join(os.path.dirname(__file__), 'testcase3', 'survey-ccds-1.fits.gz')
+        with tempfile.TemporaryDirectory() as d:
+            shutil.copy(fn, d)
+            shutil.copy(os.path.join(os.path.dirname(fn), 'survey-bricks.fits.gz'), d)
+            plain = LegacySurveyData(survey_dir=d)
+            C1 = plain.get_ccds()
+            create_ccd_index([fn], os.path.join(d, 'survey-ccds-index'), False)
+            indexed = LegacySurveyData(survey_dir=d)
+            self.assertTrue(indexed.get_ccd_index())
+            C2 = indexed.get_ccds()
+            self.assertEqual(sorted(C1.get_columns()), sorted(C2.get_columns()))
+            for c in C1.get_columns():
+                self.assertTrue(np.all(C1.get(c) == C2.get(c)))
+            for e,n in zip(C1.expnum, C1.ccdname):
+                A = plain.find_ccds(expnum=e, ccdname=n)
+                B = indexed.find_ccds(expnum=e, ccdname=n)
+                self.assertEqual(list(A.image_hdu), list(B.image_hdu))
+            self.assertIsNone(indexed.find_ccds(expnum=-1))
+            B = indexed.get_bricks_readonly()
+            wcs = wcs_for_brick(B[np.argmin(np.hypot(B.ra - C1.ra[0], B.dec - C1.dec[0]))])
+            A = plain.ccds_touching_wcs(wcs)
+            B = indexed.ccds_touching_wcs(wcs)
+            self.assertEqual(sorted(zip(A.expnum, A.ccdname)), sorted(zip(B.expnum, B.ccdname)))
+            self.assertFalse('corner_ra' in B.get_columns())
+            # the corners are computed only for the candidate CCDs
+            self.assertFalse('corner_ra' in A.get_columns())
+            for T in [plain.get_ccds_readonly(), plain.find_ccds(expnum=C1.expnum[0]),
+                      indexed.find_ccds(expnum=C1.expnum[0])]:
+                self.assertFalse('corner_ra' in T.get_columns())
+
+    def test_filtered_survey(self):
+        import os
+        import gzip
+        import shutil
+        import tempfile
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.survey import LegacySurveyData, wcs_for_brick
+        from legacypipe.create_ccd_index import create_ccd_index
+
+        class DecamOnly(LegacySurveyData):
+            def filter_ccd_kd_files(self, fns):
+                return [fn for fn in fns if 'decam' in fn]
+            def filter_ccds_files(self, fns):
+                return [fn for fn in fns if 'decam' in fn]
+
+        class NoKd(LegacySurveyData):
+            def filter_ccd_kd_files(self, fns):
+                return []
+
+        tdir = os.path.join(os.path.dirname(__file__), 'testcase3')
+        with tempfile.TemporaryDirectory() as d:
+            shutil.copy(os.path.join(tdir, 'survey-bricks.fits.gz'), d)
+            fns = [os.path.join(d, 'survey-ccds-decam-1.fits.gz'),
+                   os.path.join(d, 'survey-ccds-mosaic-1.fits.gz')]
+            shutil.copy(os.path.join(tdir, 'survey-ccds-1.fits.gz'), fns[0])
+            # the same CCDs, as another camera's
+            T = fits_table(fns[0])
+            T.expnum += 10000000
+            tmpfn = os.path.join(d, 'mosaic.fits')
+            T.writeto(tmpfn)
+            with open(tmpfn, 'rb') as fin, gzip.open(fns[1], 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            os.remove(tmpfn)
+
+            C1 = DecamOnly(survey_dir=d).get_ccds()
+            create_ccd_index(fns, os.path.join(d, 'survey-ccds-index'), False)
+            self.assertEqual(len(LegacySurveyData(survey_dir=d).get_ccds()), 2 * len(C1))
+            survey = DecamOnly(survey_dir=d)
+            self.assertTrue(survey.get_ccd_index())
+            C2 = survey.get_ccds()
+            self.assertEqual(list(C1.expnum), list(C2.expnum))
+            C3 = survey.get_ccds(rows=np.array([1]))
+            self.assertEqual(C3.expnum[0], C1.expnum[1])
+            self.assertIsNone(survey.find_ccds(expnum=T.expnum[0]))
+            self.assertEqual(len(survey.find_ccds(camera=C1.camera[0])),
+                             np.sum(C1.camera == C1.camera[0]))
+            B = survey.get_bricks_readonly()
+            wcs = wcs_for_brick(B[np.argmin(np.hypot(B.ra - C1.ra[0], B.dec - C1.dec[0]))])
+            A = survey.ccds_touching_wcs(wcs)
+            self.assertTrue(np.all(A.expnum < 10000000))
+            # a survey that selects none of the files doesn't use the index
+            self.assertFalse(NoKd(survey_dir=d).get_ccd_index())
+
+class _FakeBlobSurvey(object):
+    def __init__(self, d, bricks):
+        self.d = d
+        self.bricks = bricks
+    def get_bricks_readonly(self):
+        return self.bricks
+    def find_file(self, filetype, brick=None):
+        import os
+        return os.path.join(self.d, 'blobs-%s.fits' % brick)
+
+class TestSkyMasks(unittest.TestCase):
+
+    def test_exposure_masks(self):
+        import os
+        import tempfile
+        import numpy as np
+        import fitsio
+        from astrometry.util.util import Tan
+        from astrometry.util.fits import fits_table
+        from astrometry.util.resample import resample_with_wcs
+        from legacypipe.reference import cut_reference_sources
+        from legacypipe.survey import wcs_for_brick
+        from legacypipe.skymasks import (exposure_wcs, get_blob_mask,
+                                         ExposureSkyMasks)
+
+        pixscale = 0.262
+        ps = pixscale / 3600.
+        W,H = 2046,4094
+        # a 3x2 mosaic of CCDs
+        wcslist = [Tan(150. + 0.3*i, 2. + 0.6*j, (W+1)/2., (H+1)/2.,
+                       -ps, 0., 0., ps, float(W), float(H))
+                   for i in range(3) for j in range(2)]
+        expwcs = exposure_wcs(wcslist, pixscale)
+        rng = np.random.RandomState(5)
+        n = 2000
+        refs = fits_table()
+        refs.ra = rng.uniform(149.6, 151.0, n)
+        refs.dec = rng.uniform(1.5, 3.5, n)
+        refs.radius = rng.uniform(0., 0.05, n)
+        refs.keep_radius = rng.uniform(0., 0.1, n)
+        refs.rowid = np.arange(n)
+        exprefs = refs.copy()
+        cut_reference_sources(exprefs, expwcs, pixscale)
+        for wcs in wcslist:
+            # the exposure footprint covers the CCD...
+            r,d = wcs.pixelxy2radec(np.array([1., W, 1., W]), np.array([1., 1., H, H]))
+            ok,x,y = expwcs.radec2pixelxy(r, d)
+            self.assertTrue(np.all((x > 1) * (x < expwcs.shape[1]) *
+                                   (y > 1) * (y < expwcs.shape[0])))
+            # ... and cutting its sources gives the CCD's own sources.
+            R1 = refs.copy()
+            cut_reference_sources(R1, wcs, pixscale)
+            R2 = exprefs.copy()
+            cut_reference_sources(R2, wcs, pixscale)
+            for c in ['rowid', 'ibx', 'iby', 'in_bounds', 'radius_pix']:
+                self.assertTrue(np.array_equal(R1.get(c), R2.get(c)))
+
+        # The parent sends each CCD only its own sources; cutting those
+        # to the CCD's good-pixel region gives the same sources.
+        masks = ExposureSkyMasks.__new__(ExposureSkyMasks)
+        masks.pixscale = pixscale
+        masks.wcs = expwcs
+        masks.refs = exprefs
+        for wcs in wcslist:
+            ccd = masks.for_ccd(wcs)
+            self.assertTrue(len(ccd.refs) < len(exprefs))
+            subwcs = wcs.get_subimage(100, 50, W-200, H-100)
+            R1 = masks.get_refs(subwcs)
+            R2 = ccd.get_refs(subwcs)
+            for c in ['rowid', 'ibx', 'iby', 'in_bounds', 'radius_pix']:
+                self.assertTrue(np.array_equal(R1.get(c), R2.get(c)))
+        self.assertTrue(masks.refs is exprefs)
+
+        # Blob masks from two bricks, read once and reused.
+        with tempfile.TemporaryDirectory() as d:
+            B = fits_table()
+            B.brickname = np.array(['1500p020', '1502p020'])
+            B.ra = np.array([150.0, 150.25])
+            B.dec = np.array([2.0, 2.0])
+            survey = _FakeBlobSurvey(d, B)
+            blobmaps = {}
+            for b in B:
+                blobs = rng.randint(-1, 3, size=(3600,3600)).astype(np.int32)
+                fitsio.write(survey.find_file('blobmap', brick=b.brickname),
+                             blobs, clobber=True)
+                blobmaps[b.brickname] = blobs
+            wcs = wcslist[0]
+            expected = np.zeros((H,W), bool)
+            for b in B:
+                Yo,Xo,Yi,Xi,_ = resample_with_wcs(wcs, wcs_for_brick(b))
+                expected[Yo,Xo] |= (blobmaps[b.brickname] >= 0)[Yi,Xi]
+            self.assertTrue(np.any(expected))
+            for i in range(2):
+                self.assertTrue(np.array_equal(get_blob_mask(wcs, survey), expected))
+
+class _FakeForcedSurvey(object):
+    def __init__(self, d, bricks, wcs):
+        self.d = d
+        self.bricks = bricks
+        self.wcs = wcs
+    def get_bricks_readonly(self):
+        return self.bricks
+    def get_approx_wcs(self, ccd):
+        return self.wcs
+    def find_file(self, filetype, brick=None, output=None):
+        import os
+        return os.path.join(self.d, '%s-%s.fits' % (filetype, brick))
+
+class _FakeImobj(object):
+    camera = 'decam'
+    expnum = 123456
+    ccdname = 'N4'
+
+class _FakeTim(object):
+    def __init__(self, x0, y0, h, w):
+        import numpy as np
+        self.x0 = x0
+        self.y0 = y0
+        self.shape = (h, w)
+        self.dq = np.zeros((h, w), np.int16)
+        self.inverr = np.ones((h, w), np.float32)
+        self.imobj = _FakeImobj()
+
+class TestForcedPhotInputs(unittest.TestCase):
+
+    def test_exposure_inputs(self):
+        import tempfile
+        import numpy as np
+        import fitsio
+        from astrometry.util.util import Tan
+        from astrometry.util.fits import fits_table
+        from legacypipe.forced_photom import read_exposure_inputs, get_catalog_in_wcs
+        from legacypipe.outliers import (read_outlier_mask_file, apply_outlier_mask,
+                                         unpack_outlier_mask)
+
+        ps = 0.262 / 3600.
+        W,H = 2046,4094
+        # a CCD straddling two bricks
+        wcs = Tan(150.125, 2., (W+1)/2., (H+1)/2., -ps, 0., 0., ps, float(W), float(H))
+        ccds = fits_table()
+        ccds.camera = np.array(['decam'])
+        ccds.expnum = np.array([123456])
+        ccds.ccdname = np.array(['N4'])
+        rng = np.random.RandomState(42)
+        with tempfile.TemporaryDirectory() as d:
+            B = fits_table()
+            B.brickname = np.array(['1500p020', '1502p020'])
+            B.ra = np.array([150.0, 150.25])
+            B.dec = np.array([2.0, 2.0])
+            B.ra1 = B.ra - 0.125
+            B.ra2 = B.ra + 0.125
+            B.dec1 = B.dec - 0.125
+            B.dec2 = B.dec + 0.125
+            survey = _FakeForcedSurvey(d, B, wcs)
+            for i,b in enumerate(B):
+                n = 1000
+                T = fits_table()
+                T.ra = rng.uniform(b.ra1, b.ra2, n)
+                T.dec = rng.uniform(b.dec1, b.dec2, n)
+                T.brick_primary = (rng.uniform(size=n) < 0.9)
+                T.type = np.array([['PSF', 'REX', 'DUP'][k] for k in rng.randint(0, 3, n)])
+                T.release = np.zeros(n, np.int16) + 9010
+                T.brickid = np.zeros(n, np.int32) + i
+                T.brickname = np.array([b.brickname] * n)
+                T.objid = np.arange(n, dtype=np.int32)
+                for c in ['flux_r', 'sersic', 'shape_r', 'shape_e1', 'shape_e2',
+                          'ref_epoch', 'pmra', 'pmdec', 'parallax']:
+                    T.set(c, rng.uniform(size=n).astype(np.float32))
+                T.writeto(survey.find_file('tractor', brick=b.brickname))
+
+                # as written by mask_outlier_pixels
+                F = fitsio.FITS(survey.find_file('outliers_mask', brick=b.brickname),
+                                'rw', clobber=True)
+                F.write(None)
+                for ccdname,x0,y0 in [('N4', 300 + 1000*i, 200), ('S5', 0, 0)]:
+                    mask = np.zeros((2000, 1000), np.uint8)
+                    mask[rng.uniform(size=mask.shape) < 0.05] = 1
+                    mask[rng.uniform(size=mask.shape) < 0.05] |= 2
+                    F.write(mask, extname='decam-123456-%s' % ccdname,
+                            header=dict(X0=x0, Y0=y0))
+                F.close()
+
+            (brick_catalogs, outlier_masks), = read_exposure_inputs(
+                ccds, survey, survey, None, None)
+
+            # the catalog of the (sub-)image from the pre-read bricks
+            # matches the one read brick by brick
+            subwcs = wcs.get_subimage(100, 50, W-200, H-100)
+            T1 = get_catalog_in_wcs(subwcs, survey)
+            T2 = get_catalog_in_wcs(subwcs, survey, brick_catalogs=brick_catalogs)
+            self.assertTrue(len(T1) > 0)
+            self.assertEqual(len(set(T1.brickname)), 2)
+            for c in ['brickname', 'objid', 'ra', 'dec', 'flux_r']:
+                self.assertTrue(np.array_equal(T1.get(c), T2.get(c)))
+
+            # ... and so does the outlier masking
+            tim1 = _FakeTim(100, 50, H-100, W-200)
+            tim2 = _FakeTim(100, 50, H-100, W-200)
+            for b in B:
+                self.assertTrue(read_outlier_mask_file(survey, [tim1], b.brickname,
+                                                       subimage=False, output=False))
+                masked,x0,y0 = unpack_outlier_mask(outlier_masks[b.brickname])
+                apply_outlier_mask(tim2, masked, x0, y0)
+            self.assertTrue(np.sum(tim1.inverr == 0) > 0)
+            self.assertTrue(np.array_equal(tim1.dq, tim2.dq))
+            self.assertTrue(np.array_equal(tim1.inverr, tim2.inverr))
+
+class TestTimSpill(unittest.TestCase):
+
+    def test_spill(self):
+        import os
+        import pickle
+        import tempfile
+        import numpy as np
+        from tractor import Image
+        from legacypipe.timspill import spill_tim, map_spilled_tim
+
+        rng = np.random.RandomState(11)
+        img = rng.normal(size=(400,300)).astype(np.float32)
+        inverr = rng.uniform(0.5, 1., size=img.shape).astype(np.float32)
+        dq = rng.randint(0, 4, size=img.shape).astype(np.int16)
+        tim = Image(data=img.copy(), inverr=inverr.copy())
+        tim.dq = dq.copy()
+        with tempfile.TemporaryDirectory() as d:
+            spill_tim(tim, d, 'decam-1-N4')
+            self.assertEqual(len(os.listdir(d)), 3)
+            # What a read_one_tim worker sends back is small...
+            s = pickle.dumps(tim)
+            self.assertLess(len(s), img.nbytes // 10)
+            tim = map_spilled_tim(pickle.loads(s))
+            # ... and the files are gone once mapped.
+            self.assertEqual(os.listdir(d), [])
+        self.assertEqual(tim.shape, img.shape)
+        self.assertTrue(np.array_equal(tim.getImage(), img))
+        self.assertTrue(np.array_equal(tim.getInvError(), inverr))
+        self.assertTrue(np.array_equal(tim.dq, dq))
+        self.assertTrue(np.array_equal(tim.getImage()[100:120, 50:60], img[100:120, 50:60]))
+        # In-place changes (as in outlier masking) work.
+        tim.inverr[tim.dq > 2] = 0.
+        self.assertTrue(np.all(tim.getInvError()[dq > 2] == 0))
+        # Pickling (as for checkpoints) writes the pixels themselves.
+        tim2 = pickle.loads(pickle.dumps(tim))
+        self.assertTrue(np.array_equal(tim2.getImage(), img))
+
+class _FakeCalibSurvey(object):
+    def __init__(self, d):
+        self.d = d
+    def get_calib_dir(self):
+        return self.d
+
+class _FakeCalibImage(object):
+    # Builds a "calib" file for one CCD, slowly, logging each time it does.
+    def __init__(self, d, expnum, ccdname):
+        self.camera = 'fake'
+        self.expnum = expnum
+        self.ccdname = ccdname
+        self.survey = _FakeCalibSurvey(d)
+    def run_calibs(self, **kwargs):
+        import os
+        import time
+        fn = os.path.join(self.survey.d, 'calib-%i-%s' % (self.expnum, self.ccdname))
+        if os.path.exists(fn):
+            return
+        time.sleep(0.02)
+        with open(os.path.join(self.survey.d, 'log'), 'a') as f:
+            f.write('%i %s\n' % (self.expnum, self.ccdname))
+        with open(fn + '.tmp', 'w') as f:
+            f.write('calib')
+        os.rename(fn + '.tmp', fn)
+
+def _run_brick_calibs(X):
+    # One "brick": two threads running the calibs for the same CCDs.
+    import threading
+    from legacypipe.survey import run_calibs
+    d,ccds = X
+    def run():
+        for e,n in ccds:
+            run_calibs((_FakeCalibImage(d, e, n), {}))
+    threads = [threading.Thread(target=run) for i in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+class TestCalibService(unittest.TestCase):
+
+    def test_once(self):
+        import os
+        import tempfile
+        import numpy as np
+        from multiprocessing import Pool
+        ccds = [(e, 'N%i' % i) for e in [100, 101, 102] for i in range(1, 9)]
+        rng = np.random.RandomState(3)
+        with tempfile.TemporaryDirectory() as d:
+            # eight overlapping bricks, each with a random 2/3 of the CCDs
+            bricks = []
+            for b in range(8):
+                I = rng.permutation(len(ccds))[:16]
+                bricks.append((d, [ccds[i] for i in I]))
+            pool = Pool(8)
+            pool.map(_run_brick_calibs, bricks)
+            pool.close()
+            pool.join()
+            with open(os.path.join(d, 'log')) as f:
+                done = [tuple(w.split()) for w in f.read().splitlines()]
+            wanted = set(['%i %s' % c for _,cc in bricks for c in cc])
+            self.assertEqual(sorted(['%s %s' % c for c in done]), sorted(wanted))
+
+class TestMergedCalibCache(unittest.TestCase):
+
+    def write_merged(self, fn, expnums, val, mtime):
+        import os
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        T = fits_table()
+        T.expnum = np.array(expnums)
+        T.ccdname = np.array(['N%i' % (i+1) for i in range(len(expnums))])
+        T.plver = np.array(['V4.8 '] * len(expnums))
+        T.plprocid = np.array(['abc1234'] * len(expnums))
+        T.val = np.arange(len(expnums)) + val
+        T.writeto(fn)
+        os.utime(fn, ns=(mtime, mtime))
+
+    def test_cache(self):
+        import os
+        import tempfile
+        from types import SimpleNamespace
+        from unittest import mock
+        from legacypipe import image
+        from legacypipe.image import LegacySurveyImage, merged_calib_cache
+
+        def read_row(fn, ccdname, plver='V4.8', expnum=100):
+            im = SimpleNamespace(camera='decam', expnum=expnum, ccdname=ccdname,
+                                 plver=plver, plprocid='abc1234')
+            return LegacySurveyImage.read_merged_calib_row(im, fn)
+
+        merged_calib_cache.clear()
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'merged.fits')
+            self.write_merged(fn, [100, 100, 100], 0, 10**18)
+            misses = merged_calib_cache.misses
+            hits = merged_calib_cache.hits
+            self.assertEqual(read_row(fn, 'N1').val, 0)
+            # the next CCD of the exposure is a hit
+            self.assertEqual(read_row(fn, 'N2').val, 1)
+            self.assertEqual(merged_calib_cache.misses, misses + 1)
+            self.assertEqual(merged_calib_cache.hits, hits + 1)
+            self.assertIsNone(read_row(fn, 'S1'))
+
+            # rewriting the file invalidates it
+            self.write_merged(fn, [100, 100, 100], 10, 10**18 + 10**9)
+            self.assertEqual(read_row(fn, 'N2').val, 11)
+            self.assertEqual(merged_calib_cache.misses, misses + 2)
+
+            # PLVER and EXPNUM mismatches fail validation, which is
+            # run once per file
+            with mock.patch.object(image, 'validate_version',
+                                   wraps=image.validate_version) as validate:
+                for i in range(2):
+                    self.assertIs(read_row(fn, 'N1', plver='V5.0'), False)
+                self.assertEqual(validate.call_count, 1)
+                fn2 = os.path.join(d, 'merged2.fits')
+                self.write_merged(fn2, [100, 100, 101], 0, 10**18)
+                for i in range(2):
+                    self.assertIs(read_row(fn2, 'N1'), False)
+                self.assertEqual(validate.call_count, 2)
+
+            # at most 16 entries, least-recently used evicted first
+            merged_calib_cache.clear()
+            for expnum in range(20):
+                merged_calib_cache.get(fn, 'decam', expnum, 'V4.8')
+            self.assertEqual(len(merged_calib_cache.entries), 16)
+            self.assertEqual([k[1] for k in merged_calib_cache.entries.keys()],
+                             list(range(4, 20)))
+            merged_calib_cache.get(fn, 'decam', 4, 'V4.8')
+            merged_calib_cache.get(fn, 'decam', 20, 'V4.8')
+            self.assertEqual([k[1] for k in merged_calib_cache.entries.keys()],
+                             list(range(6, 20)) + [4, 20])
+        merged_calib_cache.clear()
+
+class TestRefMap(unittest.TestCase):
+
+    def test_huge_radii(self):
+        import numpy as np
+        from astrometry.util.util import Tan
+        from legacypipe.reference import get_reference_map
+        from legacypipe.utils import region_batches
+        from bench_refmap import synthetic_refs, reference_map_loop
+        ps = 0.262 / 3600.
+        W = H = 200
+        wcs = Tan(100., 5., (W+1)/2., (H+1)/2., -ps, 0., 0., ps, float(W), float(H))
+        refs = synthetic_refs(wcs, 50, 5, 42)
+        # radii (much) larger than the brick, centred on and off it
+        refs.radius[:2] = 5000. * 0.262 / 3600.
+        refs.radius[-2:] = 20000. * 0.262 / 3600.
+        self.assertTrue(np.array_equal(get_reference_map(wcs, refs),
+                                       reference_map_loop(wcs, refs)))
+        # the boxes are clipped to the image
+        xx = np.array([100., -3000., 5000.])
+        yy = np.array([100., 50., 5000.])
+        rad = np.array([20000., 3010., 20.])
+        batches = list(region_batches(xx, yy, rad, shape=(H,W)))
+        self.assertEqual(sorted([i for I,_,_ in batches for i in I]), [0, 1])
+        for I,gx,gy in batches:
+            self.assertTrue(gx.shape[1] <= W and gy.shape[1] <= H)
+            self.assertTrue(gx.min() >= 0 and gx.max() < W)
+            self.assertTrue(gy.min() >= 0 and gy.max() < H)
+
+class TestUnwiseCells(unittest.TestCase):
+
+    def setUp(self):
+        import numpy as np
+        from astrometry.util.util import Tan
+        from legacypipe.unwise import UnwiseCells
+        ps = 0.262 / 3600.
+        self.wcs = Tan(180., 0., 50.5, 50.5, -ps, 0., 0., ps, 100., 100.)
+        self.cells = UnwiseCells(self.wcs, 2, 10.)
+        # (1-based) pixel positions; the last one is off the brick
+        x = np.array([11., 46., 56., 91., 52., -5.])
+        y = np.array([11., 46., 56., 91., 12., 60.])
+        self.ra,self.dec = self.wcs.pixelxy2radec(x, y)
+
+    def test_split(self):
+        import numpy as np
+        split = self.cells.split(self.ra, self.dec)
+        self.assertEqual(len(split), 4)
+        owners = np.zeros(len(self.ra), int)
+        for I,owned,_ in split:
+            owners[I[owned]] += 1
+        # each source is owned by exactly one cell
+        self.assertTrue(np.all(owners == 1))
+        I,owned,rect = split[0]
+        self.assertEqual(list(I[owned]), [0, 1])
+        # the sources in the halo are fit too
+        self.assertEqual(list(I), [0, 1, 2, 4, 5])
+        self.assertEqual(rect, (-10., 60., -10., 60.))
+        I,owned,_ = split[2]
+        # (the cells along the edges take the sources beyond the brick)
+        self.assertEqual(list(I[owned]), [5])
+        I,owned,_ = split[3]
+        self.assertEqual(list(I[owned]), [2, 3])
+
+    def test_task_args(self):
+        split = self.cells.split(self.ra, self.dec)
+        wcat = ['src%i' % i for i in range(len(self.ra))]
+        roiradec = [179.99, 180.01, -0.01, 0.01]
+        X = (wcat, 'tiles', 1, roiradec, True, True, False, None, None, False, None)
+        I,_,rect = split[1]
+        Y = self.cells.task_args(X, split[1])
+        self.assertEqual(Y[0], [wcat[i] for i in I])
+        # same cutout as the whole brick...
+        self.assertEqual(Y[1:11], X[1:11])
+        # ... fitting only the cell's pixels
+        self.assertEqual(len(Y), 12)
+        self.assertTrue(Y[11][0] is self.wcs)
+        self.assertEqual(Y[11][1:], rect)
+
+    def test_merge(self):
+        import numpy as np
+        from astrometry.util.fits import fits_table
+        from legacypipe.unwise import wphotduck
+        split = self.cells.split(self.ra, self.dec)
+        n = len(self.ra)
+        results = []
+        for icell,(I,_,_) in enumerate(split):
+            r = wphotduck()
+            r.phot = fits_table()
+            r.phot.wise_x = np.arange(len(I), dtype=np.float32) + 100 * icell
+            r.phot.flux_w1 = np.zeros(len(I), np.float32) + icell
+            r.maskmap = np.zeros((100,100), np.uint32)
+            r.maskmap[icell, :] = 1 << icell
+            dat = np.ones((100,100), np.float32)
+            ie = np.ones((100,100), np.float32) * 2
+            r.models = [('1800p000', 1, self.wcs, dat, dat * (icell + 1), ie)]
+            results.append(r)
+        R = self.cells.merge(split, results, n)
+        self.assertEqual(len(R.phot), n)
+        for icell,(I,owned,_) in enumerate(split):
+            self.assertTrue(np.all(R.phot.flux_w1[I[owned]] == icell))
+            self.assertTrue(np.all(R.phot.wise_x[I[owned]] ==
+                                   np.flatnonzero(owned) + 100 * icell))
+        self.assertTrue(np.all(R.maskmap[:4, 0] == [1, 2, 4, 8]))
+        # one model per tile, each pixel from the cell owning it
+        self.assertEqual(len(R.models), 1)
+        coadd_id,band,mwcs,dat,mod,ie = R.models[0]
+        self.assertEqual((coadd_id, band), ('1800p000', 1))
+        xx,yy = np.meshgrid(np.arange(100), np.arange(100))
+        self.assertTrue(np.all(mod == self.cells.cell_index(xx, yy) + 1))
+        self.assertTrue(np.all(ie == 2))
+        # a failed cell fails the merge
+        results[2] = None
+        self.assertTrue(self.cells.merge(split, results, n) is None)
+
+    def test_whole_brick(self):
+        import tempfile
+        import numpy as np
+        from bench_unwise_cells import (synthetic_brick, run_whole_and_cells,
+                                        flux_differences)
+        with tempfile.TemporaryDirectory() as d:
+            brickwcs,X = synthetic_brick(d, nsrcs=100, size=800)
+            R1,_,R2,_ = run_whole_and_cells(X, brickwcs, 2)
+        self.assertTrue(np.all(R1.phot.wise_coadd_id == R2.phot.wise_coadd_id))
+        self.assertTrue(np.all(R1.phot.wise_x == R2.phot.wise_x))
+        self.assertTrue(np.all(R1.phot.wise_y == R2.phot.wise_y))
+        self.assertTrue(np.median(flux_differences(R1, R2)) < 0.05)
+        self.assertEqual(len(R1.models), len(R2.models))
 
 if __name__ == '__main__':
     unittest.main()